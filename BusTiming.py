@@ -0,0 +1,186 @@
+"""
+Per-command timing of the serial link to the Keithley.
+
+SourceMeterServer.record_bus() puts a TimedConnection between the server and its VISA connection
+(or the simulator): every write, read and read_bytes is timed and counted in a BusStats under the
+SCPI headers of the command (':SOUR:VOLT:LEV 5;:READ?' counts as ':SOUR:VOLT:LEV;:READ?'), a read
+under the command it answers. Each command type keeps its count, bytes each way, total/max write
+and read time and a log-spaced latency histogram. Without record_bus() the server talks to the
+connection directly and nothing is timed.
+
+    stats = s.record_bus()
+    ... run ...
+    print(stats.summary())
+    stats.to_json('data/bus.json'); stats.to_csv('data/bus.csv')
+"""
+import csv
+import json
+import math
+import threading
+import time
+
+BINS_PER_DECADE = 10
+MIN_LATENCY = 1e-6 # shorter transfers go in the first bin
+
+
+def command_type(data):
+    """The SCPI headers of a (';'-joined) command, without their arguments"""
+    return ';'.join(cmd.split(None, 1)[0] for cmd in data.split(';') if cmd.strip())
+
+
+def latency_bin(seconds):
+    return int(math.floor(math.log10(max(seconds, MIN_LATENCY))*BINS_PER_DECADE))
+
+
+def bin_edge(b):
+    """Lower edge (s) of histogram bin b"""
+    return 10**(b/float(BINS_PER_DECADE))
+
+
+class CommandStats(object):
+    __slots__ = ('count', 'reads', 'bytes_out', 'bytes_in', 'write_s', 'read_s', 'write_max', 'read_max', 'write_hist', 'read_hist')
+
+    def __init__(self):
+        self.count = 0       # writes of this command type
+        self.reads = 0       # replies read for it
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.write_s = 0.0
+        self.read_s = 0.0
+        self.write_max = 0.0
+        self.read_max = 0.0
+        self.write_hist = {} # latency_bin -> count
+        self.read_hist = {}
+
+    def total_s(self):
+        return self.write_s + self.read_s
+
+    def record(self):
+        hist = lambda h: dict((round(bin_edge(b), 9), n) for b, n in sorted(h.items()))
+        return {
+            'count': self.count, 'reads': self.reads, 'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+            'write_s': self.write_s, 'read_s': self.read_s, 'total_s': self.total_s(),
+            'write_mean_s': self.write_s/self.count if self.count else None,
+            'read_mean_s': self.read_s/self.reads if self.reads else None,
+            'write_max_s': self.write_max, 'read_max_s': self.read_max,
+            'write_hist': hist(self.write_hist), 'read_hist': hist(self.read_hist),
+            }
+
+
+class BusStats(object):
+    """Timings of every transfer on one or more connections, by command type"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.commands = {} # command type -> CommandStats
+        self.started = self.clock()
+
+    def add_write(self, cmd, nbytes, seconds):
+        with self._lock:
+            c = self.commands.get(cmd)
+            if c is None:
+                c = self.commands[cmd] = CommandStats()
+            c.count += 1
+            c.bytes_out += nbytes
+            c.write_s += seconds
+            c.write_max = max(c.write_max, seconds)
+            b = latency_bin(seconds)
+            c.write_hist[b] = c.write_hist.get(b, 0) + 1
+
+    def add_read(self, cmd, nbytes, seconds):
+        with self._lock:
+            c = self.commands.get(cmd)
+            if c is None:
+                c = self.commands[cmd] = CommandStats()
+            c.reads += 1
+            c.bytes_in += nbytes
+            c.read_s += seconds
+            c.read_max = max(c.read_max, seconds)
+            b = latency_bin(seconds)
+            c.read_hist[b] = c.read_hist.get(b, 0) + 1
+
+    def bus_s(self):
+        return sum(c.total_s() for c in self.commands.values())
+
+    def totals(self):
+        """Wall time since reset(), the part of it spent on the bus, and the rest (dwelling, sleeping, processing)"""
+        wall = self.clock() - self.started
+        bus = self.bus_s()
+        return {'wall_s': wall, 'bus_s': bus, 'off_bus_s': wall - bus, 'bus_fraction': bus/wall if wall else None,
+                'transfers': sum(c.count + c.reads for c in self.commands.values())}
+
+    def slowest(self, n=10):
+        """The n command types with the most time on the bus, as (command type, CommandStats)"""
+        return sorted(self.commands.items(), key=lambda item: -item[1].total_s())[:n]
+
+    def summary(self, n=10):
+        t = self.totals()
+        lines = ["bus {bus_s:.3f} s of {wall_s:.3f} s ({pct:.1f}%), {off_bus_s:.3f} s off the bus, {transfers} transfers".format(
+                    pct=100*(t['bus_fraction'] or 0), **t),
+                 "{:>9} {:>7} {:>10} {:>10} {:>10}  {}".format('total s', 'count', 'write ms', 'read ms', 'max ms', 'command')]
+        for cmd, c in self.slowest(n):
+            lines.append("{:9.3f} {:7d} {:10.3f} {:10.3f} {:10.3f}  {}".format(
+                c.total_s(), c.count, 1e3*c.write_s/max(c.count, 1), 1e3*c.read_s/max(c.reads, 1),
+                1e3*max(c.write_max, c.read_max), cmd))
+        return '\n'.join(lines)
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'totals': self.totals(),
+                       'commands': dict((cmd, c.record()) for cmd, c in self.commands.items())}, f, indent=1, sort_keys=True)
+
+    def to_csv(self, path):
+        """One row per command type, the histograms left out"""
+        fields = ('count', 'reads', 'bytes_out', 'bytes_in', 'write_s', 'read_s', 'total_s',
+                  'write_mean_s', 'read_mean_s', 'write_max_s', 'read_max_s')
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(('command',) + fields)
+            for cmd, c in self.slowest(len(self.commands)):
+                record = c.record()
+                writer.writerow((cmd,) + tuple(record[k] for k in fields))
+
+
+class TimedConnection(object):
+    """Stands in for a VISA connection, timing its transfers into a BusStats"""
+
+    def __init__(self, cxn, stats, write_termination='', read_termination=''):
+        self.cxn = cxn
+        self.stats = stats
+        self.write_termination = write_termination
+        self.read_termination = read_termination
+        self.last = '' # command type of the last write, its replies are counted under it
+        self.clock = time.perf_counter
+
+    def write(self, data):
+        t0 = self.clock()
+        result = self.cxn.write(data)
+        self.last = command_type(data)
+        self.stats.add_write(self.last, len(data) + len(self.write_termination), self.clock() - t0)
+        return result
+
+    def write_raw(self, data):
+        t0 = self.clock()
+        result = self.cxn.write_raw(data)
+        self.last = '<raw>'
+        self.stats.add_write(self.last, len(data), self.clock() - t0)
+        return result
+
+    def read(self):
+        t0 = self.clock()
+        reply = self.cxn.read()
+        self.stats.add_read(self.last, len(reply) + len(self.read_termination), self.clock() - t0)
+        return reply
+
+    def read_bytes(self, count):
+        t0 = self.clock()
+        reply = self.cxn.read_bytes(count)
+        self.stats.add_read(self.last, len(reply), self.clock() - t0)
+        return reply
+
+    def __getattr__(self, name):
+        return getattr(self.cxn, name)
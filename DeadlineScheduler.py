@@ -0,0 +1,75 @@
+"""
+Absolute deadlines for periodic jobs, for loops that sleep until the next one is due.
+
+Each job runs on a fixed grid, first + k*interval, rather than an interval after it last ran, so
+the time a loop takes to wake up and do the work doesn't add up into drift. A loop that falls
+more than an interval behind runs the job once and skips the slots it missed (counted in missed,
+and in the LoopProfiler if one is given) instead of bunching them up.
+
+    schedule = DeadlineScheduler()
+    schedule.every('measurement', 1.0)
+    while running:
+        time.sleep(schedule.timeout())    # or queue.get(timeout=schedule.timeout())
+        for name in schedule.due():
+            ...
+"""
+import math
+import time
+
+
+class Deadline(object):
+    __slots__ = ('interval', 'next', 'missed')
+
+    def __init__(self, interval, first):
+        self.interval = interval
+        self.next = first    # absolute time the job is due
+        self.missed = 0      # slots skipped because the loop was too late for them
+
+
+class DeadlineScheduler(object):
+
+    def __init__(self, clock=time.time, profiler=None):
+        self.clock = clock
+        self.profiler = profiler
+        self.deadlines = {} # name -> Deadline
+
+    def every(self, name, interval, first=None):
+        """Runs name every interval seconds, first at first (default one interval from now)"""
+        if first is None:
+            first = self.clock() + interval
+        self.deadlines[name] = Deadline(interval, first)
+
+    def cancel(self, name):
+        self.deadlines.pop(name, None)
+
+    def restart(self, name):
+        """Moves name's grid to start one interval from now"""
+        d = self.deadlines[name]
+        d.next = self.clock() + d.interval
+
+    def set_interval(self, name, interval):
+        """Changes name's interval, the next deadline moves with it from the last one"""
+        d = self.deadlines[name]
+        d.next += interval - d.interval
+        d.interval = interval
+
+    def timeout(self):
+        """Seconds until the next deadline (0 if one is overdue), None with no deadlines"""
+        if not self.deadlines:
+            return None
+        return max(0.0, min(d.next for d in self.deadlines.values()) - self.clock())
+
+    def due(self):
+        """Names whose deadline has come, earliest first, each moved on to its next slot"""
+        now = self.clock()
+        due = sorted((d.next, name) for name, d in self.deadlines.items() if d.next <= now)
+        for _, name in due:
+            d = self.deadlines[name]
+            d.next += d.interval
+            if d.next <= now:
+                missed = int(math.floor((now - d.next)/d.interval)) + 1
+                d.next += missed*d.interval
+                d.missed += missed
+                if self.profiler is not None:
+                    self.profiler.missed(name, missed)
+        return [name for _, name in due]
@@ -0,0 +1,335 @@
+"""
+Storage for live IV data.
+
+IVBuffer keeps one float64 column per quantity (time, bias voltage, current, measured voltage)
+in a preallocated array that grows in chunks, so appending a reading never copies the history
+and plotting/saving work on views of it.
+
+IVLog streams the same rows to disk as they are taken, so a crash loses at most the last
+few seconds of a run.
+
+The .ivb binary run format: an 8 byte magic, a little-endian uint32 header length and a JSON
+header (columns, dtype, run metadata) padded to a multiple of 64 bytes, then the rows as
+little-endian float64, ncolumns per row, appended in chunks. open_ivb() memory-maps it, so a
+reader can slice any range of a long run without loading the file; a file cut short by a crash
+still opens, up to its last complete row. convert_text() turns IVdata_*.txt/data_*.txt archives
+into .ivb, export_text() writes the numpy.savetxt text back out.
+
+    python IVData.py convert data/*.txt
+    python IVData.py export data/data_2018_10_5_15_36_32.ivb
+"""
+import argparse
+import json
+import os
+import struct
+import time
+import numpy as np
+
+IV_COLUMNS = ('t', 'bias', 'I', 'V')   # time of measurement, bias voltage set, current measured, actual voltage measured
+CHUNK      = 4096                      # rows allocated at a time, the capacity at least doubles when it runs out
+
+
+class IVBuffer(object):
+
+    def __init__(self, columns=IV_COLUMNS, capacity=CHUNK):
+        self.columns = tuple(columns)
+        self._index  = dict((name, i) for i, name in enumerate(self.columns))
+        self._data   = np.empty((len(self.columns), max(capacity, 1)), dtype=np.float64)
+        self.n = 0
+        self.firstVoltageChangedIndex  = 0   # row of the first reading after the first voltage change
+        self.recentVoltageChangedIndex = 0   # row of the first reading after the latest voltage change
+        self._changed = False
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def capacity(self):
+        return self._data.shape[1]
+
+    def _grow(self, need):
+        capacity = max(self.capacity*2, need + CHUNK - need % CHUNK)
+        data = np.empty((len(self.columns), capacity), dtype=np.float64)
+        data[:, :self.n] = self._data[:, :self.n]
+        self._data = data
+
+    def append(self, *row):
+        """Adds one reading, one value per column"""
+        if self.n == self.capacity:
+            self._grow(self.n + 1)
+        self._data[:, self.n] = row
+        self.n += 1
+
+    def extend(self, rows):
+        """Adds a (n, ncolumns) block of readings"""
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.columns))
+        if self.n + len(rows) > self.capacity:
+            self._grow(self.n + len(rows))
+        self._data[:, self.n:self.n + len(rows)] = rows.T
+        self.n += len(rows)
+
+    def voltage_changed(self):
+        """Marks that readings from now on belong to a new bias voltage"""
+        if not self._changed:
+            self.firstVoltageChangedIndex = self.n
+            self._changed = True
+        self.recentVoltageChangedIndex = self.n
+
+    # Views, valid until the next append that has to grow the buffer
+    def column(self, name, start=0):
+        return self._data[self._index[name], start:self.n]
+
+    def since_first_change(self, name):
+        return self.column(name, self.firstVoltageChangedIndex)
+
+    def since_recent_change(self, name):
+        return self.column(name, self.recentVoltageChangedIndex)
+
+    def array(self):
+        """(n, ncolumns) view of all readings, rows in the order of columns (what numpy.savetxt wants)"""
+        return self._data[:, :self.n].T
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+
+class IVLog(object):
+    """Append-only text log of IV rows, in the numpy.savetxt format of the IVdata_*.txt files
+    (so numpy.loadtxt and dev.load_raw_data read it as it is). The run settings go in a '#'
+    header, later changes as '#' lines between the rows. Rows are buffered and flushed+fsynced
+    every fsync seconds; the log is written to path+'.part' and finalize() renames it, so an
+    unfinished .part file is the sign of a run that did not end cleanly"""
+    FMT = '%.18e'
+
+    def __init__(self, path, settings=None, columns=IV_COLUMNS, fsync=5.0, clock=time.time):
+        self.path = path + '.part'
+        self.columns = tuple(columns)
+        self.fsync = fsync
+        self.clock = clock
+        self.rows = 0
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(self.path, 'w', buffering=1 << 16)
+        self._row = ' '.join([self.FMT]*len(self.columns)) + '\n'
+        self.note('IV run started {}'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+        for key in sorted(settings or {}):
+            self.note('{} = {}'.format(key, settings[key]))
+        self.note('columns: ' + ' '.join(self.columns))
+        self.sync()
+
+    def write(self, *row):
+        self._file.write(self._row % row)
+        self.rows += 1
+        if self.clock() - self._synced >= self.fsync:
+            self.sync()
+
+    def note(self, text):
+        """Adds a '#' comment line, e.g. a setting changed during the run"""
+        self._file.write('# {}\n'.format(text))
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = self.clock()
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def finalize(self, path=None):
+        """Closes the log and renames it to path (default: the name it was opened with, without .part)"""
+        self.close()
+        path = path or self.path[:-len('.part')]
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        os.replace(self.path, path)
+        self.path = path
+        return path
+
+
+def minmax_indices(y, buckets):
+    """Indices (sorted) of the smallest and largest y in each of `buckets` runs of consecutive
+    points, so a line through y[indices] has the same envelope as y at that many pixels"""
+    n = len(y)
+    if n <= 2*buckets:
+        return np.arange(n)
+    k = -(-n // buckets)
+    m = n // k
+    rows = np.asarray(y[:m*k]).reshape(m, k)
+    base = np.arange(m)*k
+    idx = np.concatenate([base + rows.argmin(axis=1), base + rows.argmax(axis=1), np.arange(m*k, n)])
+    return np.unique(idx)
+
+
+class MinMaxDecimator(object):
+    """Min/max decimation of an append-only stream, updated incrementally: the points are cut into
+    buckets of k consecutive readings and only each bucket's min and max (in y) are kept. When the
+    buckets outnumber target, neighbouring pairs are merged and k doubles, so the output stays
+    between target and 2*target buckets whatever the length of the stream"""
+
+    def __init__(self, target=1000):
+        self.target = target
+        self.reset()
+
+    def reset(self):
+        self.k     = 1
+        self.pairs = np.empty((0, 2), dtype=np.intp)   # per complete bucket: index of its min and max, in index order
+        self.done  = 0                                 # points covered by the complete buckets
+
+    def indices(self, y):
+        """Indices to plot for the stream y (a view that only ever grew since the last call)"""
+        n = len(y)
+        m = (n - self.done) // self.k
+        if m:
+            rows = np.asarray(y[self.done:self.done + m*self.k]).reshape(m, self.k)
+            base = self.done + np.arange(m)*self.k
+            lo, hi = base + rows.argmin(axis=1), base + rows.argmax(axis=1)
+            self.pairs = np.concatenate([self.pairs, np.sort(np.column_stack([lo, hi]), axis=1)])
+            self.done += m*self.k
+        while len(self.pairs) > 2*self.target:
+            self._merge(y)
+        return np.unique(np.concatenate([self.pairs.ravel(), np.arange(self.done, n)]))
+
+    def _merge(self, y):
+        m = len(self.pairs) // 2
+        quads = self.pairs[:2*m].reshape(m, 4)
+        vals = np.asarray(y)[quads]
+        rows = np.arange(m)
+        merged = np.sort(np.column_stack([quads[rows, vals.argmin(axis=1)], quads[rows, vals.argmax(axis=1)]]), axis=1)
+        self.pairs = np.concatenate([merged, self.pairs[2*m:]])
+        self.k *= 2
+
+
+IVB_MAGIC   = b'IVBIN\x00\x01\n'
+IVB_DTYPE   = '<f8'
+IVB_ALIGN   = 64
+
+
+def _ivb_header(columns, metadata):
+    header = json.dumps({'columns': list(columns), 'dtype': IVB_DTYPE, 'metadata': metadata or {}}).encode('utf-8')
+    size = len(IVB_MAGIC) + 4 + len(header)
+    header += b' '*(-size % IVB_ALIGN)
+    return IVB_MAGIC + struct.pack('<I', len(header)) + header
+
+
+def read_ivb_header(path):
+    """(offset of the first row, header dict) of a .ivb file"""
+    with open(path, 'rb') as f:
+        if f.read(len(IVB_MAGIC)) != IVB_MAGIC:
+            raise ValueError("{} is not an .ivb file".format(path))
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return len(IVB_MAGIC) + 4 + size, header
+
+
+class IVBinaryWriter(object):
+    """Writes a .ivb file, buffering rows and appending them chunk rows at a time"""
+
+    def __init__(self, path, metadata=None, columns=IV_COLUMNS, chunk=CHUNK):
+        self.path = path
+        self.columns = tuple(columns)
+        self.rows = 0
+        self._chunk = np.empty((chunk, len(self.columns)), dtype=IVB_DTYPE)
+        self._n = 0
+        self._file = open(path, 'wb')
+        self._file.write(_ivb_header(self.columns, metadata))
+
+    def append(self, *row):
+        self._chunk[self._n] = row
+        self._n += 1
+        if self._n == len(self._chunk):
+            self.flush()
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=IVB_DTYPE).reshape(-1, len(self.columns))
+        if self._n + len(rows) <= len(self._chunk):
+            self._chunk[self._n:self._n + len(rows)] = rows
+            self._n += len(rows)
+        else:
+            self.flush()
+            self._file.write(rows.tobytes())
+            self.rows += len(rows)
+
+    def flush(self):
+        if self._n:
+            self._file.write(self._chunk[:self._n].tobytes())
+            self.rows += self._n
+            self._n = 0
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_ivb(path, mode='r'):
+    """Memory-maps a .ivb file as an (nrows, ncolumns) float64 array, returns (array, header).
+    mode='c' (copy on write) lets the caller scale columns in place without touching the file"""
+    offset, header = read_ivb_header(path)
+    ncolumns = len(header['columns'])
+    rows = (os.path.getsize(path) - offset) // (8*ncolumns)
+    if rows == 0:
+        return np.empty((0, ncolumns), dtype=header['dtype']), header
+    return np.memmap(path, dtype=header['dtype'], mode=mode, offset=offset, shape=(rows, ncolumns)), header
+
+
+def convert_text(path, out=None, metadata=None, chunk=CHUNK):
+    """Converts a numpy.savetxt IV text file (IVdata_*.txt, data_*.txt, an IVLog) to .ivb, reading
+    it chunk lines at a time. '#' lines end up in the metadata under 'comments'. Returns the .ivb path"""
+    out = out or os.path.splitext(path)[0] + '.ivb'
+    with open(path) as f:   # first pass only collects the comments, they go in the header
+        comments = [line[1:].strip() for line in f if line.startswith('#')]
+        f.seek(0)
+        rows = (line for line in f if line.strip() and not line.startswith('#'))
+        first = next(rows, None)
+        if first is None:
+            raise ValueError("No data rows in {}".format(path))
+        ncolumns = len(first.split())
+        columns = IV_COLUMNS if ncolumns == len(IV_COLUMNS) else ['c{}'.format(i) for i in range(ncolumns)]
+        metadata = dict(metadata or {}, source=os.path.basename(path), comments=comments)
+        with IVBinaryWriter(out + '.part', metadata, columns=columns, chunk=chunk) as writer:
+            lines = [first]
+            for line in rows:
+                lines.append(line)
+                if len(lines) == chunk:
+                    writer.extend(np.loadtxt(lines, ndmin=2))
+                    lines = []
+            if lines:
+                writer.extend(np.loadtxt(lines, ndmin=2))
+    os.replace(out + '.part', out)
+    return out
+
+
+def export_text(path, out=None, chunk=CHUNK):
+    """Writes a .ivb file back out as numpy.savetxt text, with its metadata as '#' lines. Returns the text path"""
+    out = out or os.path.splitext(path)[0] + '.txt'
+    data, header = open_ivb(path)
+    with open(out, 'w') as f:
+        for line in header['metadata'].get('comments', []):
+            f.write('# {}\n'.format(line))
+        for start in range(0, len(data), chunk):
+            np.savetxt(f, data[start:start + chunk])
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert IV runs between numpy.savetxt text and the .ivb binary format')
+    parser.add_argument('command', choices=('convert', 'export'), help='convert: text to .ivb, export: .ivb to text')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        print((convert_text if args.command == 'convert' else export_text)(path))
+
+
+if __name__ == '__main__':
+    main()
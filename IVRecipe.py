@@ -0,0 +1,110 @@
+"""
+Runs IV tests from recipe files, without the UI (no PyQt4 or matplotlib).
+
+A recipe is a JSON file: settings shared by its modules, then the modules, each overriding
+whatever it needs. Modules on the same port run one after the other, modules on different ports
+at once (see IVStation); every module writes its IVdata file like the UI does.
+
+    {
+        "safety":   {"max_voltage": 1000, "max_current": 1e-3},
+        "defaults": {"port": 13, "startV": 0, "stopV": 800, "step": 10, "waitT": 30, "maxI": 1e-6},
+        "modules": [
+            {"module": "M117"},
+            {"module": "M118", "stopV": 600, "down": false},
+            {"module": "M119", "port": 7, "settle": {"tol_rel": 0.01, "min_dwell": 2}}
+        ]
+    }
+
+Module settings are IVJob's: port, startV, stopV, step, waitT (dwell per step, s), maxI (compliance, A),
+rangeI, samples, sweep, down (measure the ramp back down too), settle (SettleDetector arguments)
+and output (data file, may contain {module}; default data/IVdata_<module>_<time>.txt).
+A module that trips the safety limits stops the others, "sweep": true ones included: their sweep
+is aborted on the instrument and the output stepped down (MakeIVCurve.sweep_volt). A sweep's
+readings only come back when it ends, so its own trip is seen then, not at the point it happened.
+
+    python IVRecipe.py recipes/production.json
+    python IVRecipe.py recipes/production.json --simulate     (every port a simulated instrument)
+    python IVRecipe.py recipes/*.json --check                 (print the queue and exit)
+"""
+import argparse
+import json
+import sys
+
+from Keithley2410 import SettleDetector, resource_name
+from Keithley2410Sim import SimulatedKeithley2410
+from IVStation import IVJob, IVStation, SafetyPolicy, result_line
+
+JOB_SETTINGS = ('port', 'startV', 'stopV', 'step', 'waitT', 'maxI', 'rangeI', 'samples', 'sweep', 'down', 'settle', 'output')
+SAFETY_SETTINGS = ('max_voltage', 'max_current', 'trip_fraction', 'trip_all', 'ramp_down_wait')
+
+
+def load_recipe(path):
+    with open(path) as f:
+        recipe = json.load(f)
+    unknown = set(recipe) - set(('safety', 'defaults', 'modules'))
+    if unknown:
+        raise ValueError("{}: unknown recipe sections {}".format(path, sorted(unknown)))
+    if not recipe.get('modules'):
+        raise ValueError("{}: no modules".format(path))
+    return recipe
+
+
+def recipe_jobs(recipe, simulate=False):
+    """The recipe's IVJobs in queue order. simulate=True puts a SimulatedKeithley2410 on every
+    port, modules on the same port sharing it"""
+    defaults = recipe.get('defaults', {})
+    simulators = {}
+    jobs = []
+    for entry in recipe['modules']:
+        settings = dict(defaults, **entry)
+        module = settings.pop('module', None)
+        if module is None:
+            raise ValueError("Recipe module without a 'module' name: {}".format(entry))
+        unknown = set(settings) - set(JOB_SETTINGS)
+        if unknown:
+            raise ValueError("Module {}: unknown settings {}".format(module, sorted(unknown)))
+        if settings.get('settle') is not None:
+            settings['settle'] = SettleDetector(**settings['settle'])   # one each, a detector follows one ramp
+        if settings.get('output') is not None:
+            settings['output'] = settings['output'].format(module=module)
+        if simulate:
+            key = resource_name(settings.get('port'))
+            settings['simulate'] = simulators.setdefault(key, SimulatedKeithley2410())
+        jobs.append(IVJob(module, **settings))
+    return jobs
+
+
+def recipe_policy(recipe):
+    safety = recipe.get('safety', {})
+    unknown = set(safety) - set(SAFETY_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown safety settings {}".format(sorted(unknown)))
+    return SafetyPolicy(**safety)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recipe', nargs='+', help='recipe file(s), run one after the other')
+    parser.add_argument('--simulate', action='store_true', help='simulated instruments instead of the ports')
+    parser.add_argument('--check', action='store_true', help='print the jobs and exit')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for path in args.recipe:
+        recipe = load_recipe(path)
+        jobs = recipe_jobs(recipe, simulate=args.simulate)
+        if args.check:
+            for job in jobs:
+                print("{}: {}".format(path, job.settings()))
+            continue
+        station = IVStation(recipe_policy(recipe))
+        for result in station.run(jobs):
+            print(result_line(result))
+        if station.policy.tripped:
+            failed = True
+            break   # a tripped station is for someone to look at before the next batch
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""
+Runs IV curves on several modules at once, one source meter each.
+
+Every module gets its own SourceMeterServer/MakeIVCurve on its own port, run on its own thread,
+so each ramp keeps its own timing and the station takes about as long as its slowest module.
+All of them answer to one SafetyPolicy: voltage and compliance ceilings, and a station-wide stop
+that ends every ramp up and brings every module back down when one trips. Each module writes its
+own IVdata_<module>_<time>.txt (IVLog rows t, bias, I, V; V is the programmed level, the ramps
+only read the current). Modules on the same port are queued, each one starting when the one
+before it has finished; IVRecipe.py builds the jobs from a recipe file.
+
+    python IVStation.py --simulate 4 --stop 100 --step 10 --dwell 0.5
+    python IVStation.py --port M117=6 --port M118=7 --stop 800
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+from Keithley2410 import SourceMeterServer, MakeIVCurve, StepMonitor, resource_name
+from Keithley2410Sim import SimulatedKeithley2410
+from IVData import IVLog
+
+
+class SafetyPolicy(object):
+    """Limits shared by every module of a station run.
+
+    max_voltage and max_current cap what any job may ask for (a job reaching its own compliance
+    just ends its ramp up, as in MakeIVCurve). A module reading more than trip_fraction of
+    max_current, asked to go above max_voltage or raising an error trips the policy; with trip_all
+    (the default) that stops the whole station: ramps up end, ramps down run with ramp_down_wait
+    instead of their dwell"""
+
+    def __init__(self, max_voltage=1000.0, max_current=1e-3, trip_fraction=1.0, trip_all=True, ramp_down_wait=0.5):
+        self.max_voltage    = max_voltage
+        self.max_current    = max_current
+        self.trip_fraction  = trip_fraction
+        self.trip_all       = trip_all
+        self.ramp_down_wait = ramp_down_wait
+        self.stopped  = threading.Event()
+        self.tripped  = [] # (module, voltage, current, reason)
+        self._lock = threading.Lock()
+
+    def limit(self, stopV, maxI):
+        """The stop voltage and compliance a job may use"""
+        return min(stopV, self.max_voltage), min(maxI, self.max_current)
+
+    def check(self, module, vStep, current):
+        if abs(current) > self.max_current*self.trip_fraction:
+            self.trip(module, vStep, current, "current above {:.3g} A".format(self.max_current*self.trip_fraction))
+
+    def trip(self, module, vStep, current, reason):
+        with self._lock:
+            self.tripped.append((module, vStep, current, reason))
+        print("SAFETY: module {} at {} V, {} A: {}".format(module, vStep, current, reason))
+        if self.trip_all:
+            self.stop()
+
+    def stop(self):
+        """Stops every module: no more steps up, ramps down without dwelling"""
+        self.stopped.set()
+
+
+class ModuleMonitor(StepMonitor):
+    """MakeIVCurve's StepMonitor for one station module: logs every step and applies the SafetyPolicy"""
+
+    def __init__(self, module, policy, log=None):
+        self.module = module
+        self.policy = policy
+        self.log    = log
+        self.t0     = time.time()
+
+    def allow(self, vStep):
+        if self.policy.stopped.is_set():
+            return False
+        if vStep > self.policy.max_voltage:
+            self.policy.trip(self.module, vStep, None, "voltage above {} V".format(self.policy.max_voltage))
+            return False
+        return True
+
+    def wait(self, seconds):
+        if self.policy.stopped.wait(seconds):   # stopped while waiting, don't sit at this voltage any longer
+            time.sleep(min(seconds, self.policy.ramp_down_wait))
+
+    def stopped(self):
+        return self.policy.stopped.is_set()
+
+    def step(self, vStep, current):
+        if self.log is not None:
+            self.log.write(time.time() - self.t0, vStep, current, vStep)
+        self.policy.check(self.module, vStep, current)
+
+
+class IVJob(object):
+    """One module's IV curve: port (COM number or VISA resource) or simulate, and the makeIVCurve settings"""
+
+    def __init__(self, module, port=None, simulate=False, startV=0, stopV=50, step=5, waitT=30, maxI=1e-6,
+                 rangeI=None, samples=1, settle=None, sweep=False, down=True, output=None):
+        self.module   = module
+        self.port     = port
+        self.simulate = simulate
+        self.startV   = startV
+        self.stopV    = stopV
+        self.step     = step
+        self.waitT    = waitT
+        self.maxI     = maxI
+        self.rangeI   = rangeI
+        self.samples  = samples
+        self.settle   = settle
+        self.sweep    = sweep
+        self.down     = down
+        self.output   = output   # data file, default data/IVdata_<module>_<time>.txt
+
+    def settings(self):
+        return dict((k, getattr(self, k)) for k in ('module', 'port', 'startV', 'stopV', 'step', 'waitT', 'maxI', 'rangeI', 'samples', 'sweep', 'down'))
+
+    def queue(self):
+        """Jobs with the same queue() share an instrument and run one after the other"""
+        return self.simulate if self.simulate else resource_name(self.port)
+
+
+def output_name(module):
+    t = time.localtime()
+    return os.sep.join(['data', "IVdata_{mod}_{y}-{m}-{d}_{h}-{n}-{s}.txt".format(mod=module, y=t[0], m=t[1], d=t[2], h=t[3], n=t[4], s=t[5])])
+
+
+def run_job(job, policy):
+    """Runs one module's IV curve start to end (up, then back down) and returns a result dict.
+    The output is brought down (stepped, or switched off if that fails too) and the connection
+    closed whatever happens"""
+    stopV, maxI = policy.limit(job.stopV, job.maxI)
+    log = IVLog(job.output or output_name(job.module), dict(job.settings(), stopV=stopV, maxI=maxI))
+    monitor = ModuleMonitor(job.module, policy, log)
+    result = {'module': job.module, 'output': None, 'error': None, 'curve': None}
+    server = None
+    ivc = None
+    t0 = time.time()
+    try:
+        server = SourceMeterServer(job.port, simulate=job.simulate)
+        ivc = MakeIVCurve(server, monitor=monitor)
+        result['curve'] = ivc.makeIVCurve(startV=job.startV, stopV=stopV, waitT=job.waitT, step=job.step, maxI=maxI,
+                                          rangeI=job.rangeI, samples=job.samples, settle=job.settle, sweep=job.sweep, down=job.down)
+    except Exception as e:
+        result['error'] = repr(e)
+        policy.trip(job.module, None, None, "error: {!r}".format(e))
+        try:
+            ivc.ramp_to_zero()
+        except Exception:
+            try:
+                server.output_off()
+            except Exception:
+                pass
+    finally:
+        result['elapsed'] = time.time() - t0
+        result['output'] = log.finalize()
+        if server is not None and server.isOpen:
+            server.close()
+    return result
+
+
+def result_line(result):
+    error = '' if result['error'] is None else ' ERROR ' + result['error']
+    return "{}: {} ({:.1f} s){}".format(result['module'], result['output'], result['elapsed'], error)
+
+
+class IVStation(object):
+    """Runs IVJobs concurrently, each on its own thread, under one SafetyPolicy"""
+
+    def __init__(self, policy=None):
+        self.policy = policy if policy is not None else SafetyPolicy()
+
+    def run(self, jobs):
+        """Runs jobs on different instruments at once and jobs on the same one in the order given,
+        returns their results in the order of jobs. Once the policy has stopped the station, queued
+        jobs don't start"""
+        modules = [job.module for job in jobs]
+        if len(set(modules)) != len(modules):
+            raise ValueError("Module names must be unique, got {}".format(modules))
+        queues = {}
+        for i, job in enumerate(jobs):
+            queues.setdefault(job.queue(), []).append(i)
+        results = [None]*len(jobs)
+        def run_queue(indices):
+            for i in indices:
+                if self.policy.stopped.is_set():
+                    results[i] = {'module': jobs[i].module, 'output': None, 'error': 'not run, station stopped', 'curve': None, 'elapsed': 0.0}
+                else:
+                    results[i] = run_job(jobs[i], self.policy)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(queues), 1)) as pool:
+            for future in [pool.submit(run_queue, indices) for indices in queues.values()]:
+                future.result()
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', action='append', default=[], metavar='MODULE=PORT', help='a module and its COM number or VISA resource, repeat for each')
+    parser.add_argument('--simulate', type=int, default=0, metavar='N', help='add N simulated modules')
+    parser.add_argument('--start', type=float, default=0)
+    parser.add_argument('--stop',  type=float, default=50)
+    parser.add_argument('--step',  type=float, default=5)
+    parser.add_argument('--dwell', type=float, default=30, help='wait at each step (s)')
+    parser.add_argument('--max-current', type=float, default=1e-6, help='compliance (A)')
+    parser.add_argument('--max-voltage', type=float, default=1000.0, help='station voltage ceiling (V)')
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for spec in args.port:
+        module, _, port = spec.partition('=')
+        jobs.append(IVJob(module, port=int(port) if port.isdigit() else port, startV=args.start, stopV=args.stop,
+                          step=args.step, waitT=args.dwell, maxI=args.max_current))
+    for i in range(args.simulate):
+        jobs.append(IVJob('sim{}'.format(i), simulate=SimulatedKeithley2410(), startV=args.start, stopV=args.stop,
+                          step=args.step, waitT=args.dwell, maxI=args.max_current))
+    if not jobs:
+        parser.error("No modules, give --port and/or --simulate")
+
+    station = IVStation(SafetyPolicy(max_voltage=args.max_voltage, max_current=args.max_current))
+    for result in station.run(jobs):
+        print(result_line(result))
+    return 1 if station.policy.tripped else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
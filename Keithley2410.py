@@ -1,18 +1,208 @@
-import visa
+import functools
+import threading
 import time
 import numpy as np
 
+try:
+    import visa
+except ImportError: # only needed for real hardware, the simulator runs without it
+    visa = None
+
+from BusTiming import BusStats, TimedConnection
+from Keithley2410Sim import SimulatedKeithley2410, LIST_MAX_POINTS, SWEEP_MAX_POINTS, TRACE_MAX_POINTS, OPER_IDLE, DATA_SIZES, OVERFLOW_READING, ELEMENT_ORDER
+
 READ_TERMINATION  = '\r\n'
 WRITE_TERMINATION = '\r\n'
 
+DEFAULT_RESOURCE  = "COM13" # used when no port is given
+
+# ranges the instrument picks itself after *RST (autorange on), only shadowed once written
+AUTORANGED = (":SOUR:VOLT:RANG",":SOUR:CURR:RANG",":SENS:CURR:RANG",":SENS:VOLT:RANG")
+
+def resource_name(port):
+    """VISA resource for a port: a COM number (6 -> "COM6"), a resource string as it is, None for DEFAULT_RESOURCE"""
+    if port is None:
+        return DEFAULT_RESOURCE
+    if isinstance(port, int):
+        return "COM{}".format(port)
+    return port
+
 #READ_TERMINATION  = '\r\n'
 #WRITE_TERMINATION = '\r\n'
 
+STAT_FIELDS = ('mean','std','min','max')
+
+def reading_stats(readings,elements=None):
+    """Mean, std, min and max of each element of a reading record array (all but TIME and STAT
+    by default), as one numpy record with fields n, CURR_mean, CURR_std, ..."""
+    if elements is None:
+        elements = [e for e in readings.dtype.names if e not in ('TIME','STAT')]
+    out = np.zeros((),dtype=[('n','i4')]+[('{}_{}'.format(e,f),'f8') for e in elements for f in STAT_FIELDS])
+    out['n'] = len(readings)
+    for e in elements:
+        col = readings[e].astype('f8')
+        out[e+'_mean'] = col.mean()
+        out[e+'_std']  = col.std(ddof=1) if len(col) > 1 else 0.0
+        out[e+'_min']  = col.min()
+        out[e+'_max']  = col.max()
+    return out[()]
+
+class SettleDetector(object):
+    """Decides when the current at a voltage step has settled, from readings taken during the dwell.
+
+    The readings since the step are fitted with I(t) = A exp(-B t) + C, the relaxation model of
+    dev.exponential_fn, using the closed form of dev.fit_exp_const_dx on the means of their first,
+    middle and last thirds. The step has settled once the drift still to come, |A| exp(-B t), is
+    below max(tol_abs, tol_rel*|C|), or, when the thirds are not monotonic (noise dominates the
+    relaxation), once their means agree within that tolerance. Never before min_dwell seconds or
+    min_points readings; max_dwell ends the step regardless (timedOut is then True)"""
+
+    def __init__(self, tol_rel=1e-3, tol_abs=1e-11, min_dwell=2.0, max_dwell=30.0, min_points=6, interval=0.5):
+        self.tol_rel    = tol_rel
+        self.tol_abs    = tol_abs
+        self.min_dwell  = min_dwell
+        self.max_dwell  = max_dwell
+        self.min_points = min_points
+        self.interval   = interval # seconds between readings when the detector paces them (MakeIVCurve.dwell)
+        self.reset()
+
+    def reset(self):
+        self.t = []
+        self.I = []
+        self.settled  = False
+        self.timedOut = False
+        self.tau      = None # 1/B of the last fit
+        self.settledI = None # C of the last fit, the predicted settled current
+        self.drift    = None # predicted change still to come
+
+    def add(self, t, I):
+        """Adds a reading taken t seconds after the step, returns whether the step has settled"""
+        self.t.append(t)
+        self.I.append(I)
+        if t >= self.max_dwell:
+            self.settled = self.timedOut = True
+        elif t >= self.min_dwell and len(self.t) >= self.min_points:
+            self.settled = self.check()
+        return self.settled
+
+    def check(self):
+        n = len(self.t)
+        k, r = n//3, n%3
+        m1, m2 = k + (r == 2), 2*k + (r >= 1)
+        t, I = np.asarray(self.t), np.asarray(self.I)
+        X1, X2, X3 = t[:m1].mean(), t[m1:m2].mean(), t[m2:].mean()
+        Y1, Y2, Y3 = I[:m1].mean(), I[m1:m2].mean(), I[m2:].mean()
+        tol = max(self.tol_abs, self.tol_rel*abs(Y3))
+        if not ((Y1 > Y2 > Y3) or (Y1 < Y2 < Y3)):
+            self.drift = abs(Y3 - Y1)
+            return self.drift < tol
+        B = np.log((Y1-Y2)/(Y2-Y3))/((X3-X1)/2.0)
+        if not B > 0:
+            return False # still diverging
+        A = (Y1-Y2)/(np.exp(-B*X1)-np.exp(-B*X2))
+        C = Y1 - A*np.exp(-B*X1)
+        self.tau, self.settledI = 1.0/B, C
+        self.drift = abs(A)*np.exp(-B*t[-1])
+        return self.drift < max(self.tol_abs, self.tol_rel*abs(C))
+
+class VisaSession(object):
+    """The connection to one instrument, shared by every SourceMeterServer opened on it, with the
+    shadow registers that go with it and a lock that keeps a command and its reply together"""
+
+    def __init__(self, key, cxn):
+        self.key      = key
+        self.cxn      = cxn
+        self.refs     = 0
+        self.lock     = threading.RLock()
+        self.shadow   = {}
+        self.readback = {}
+
+_sessions = {}                   # resource name (or simulator instance) -> its VisaSession
+_sessions_lock = threading.Lock()
+_resource_manager = None         # one visa.ResourceManager for the process
+
+def open_session(port=None, sim=None):
+    """The session for port (or for a simulator instance), opened by its first user"""
+    global _resource_manager
+    key = sim if sim is not None else resource_name(port)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            if sim is not None:
+                sim.isOpen = True
+                cxn = sim
+            else:
+                if visa is None:
+                    raise ValueError("pyvisa is not installed, only simulate=True is available")
+                if _resource_manager is None:
+                    _resource_manager = visa.ResourceManager()
+                cxn = _resource_manager.open_resource(
+                    key,
+                    read_termination=READ_TERMINATION,
+                    write_termination=WRITE_TERMINATION,
+                    )
+            session = _sessions[key] = VisaSession(key, cxn)
+        session.refs += 1
+        return session
+
+def close_session(session):
+    """Drops one user of the session, the last one closes the connection"""
+    with _sessions_lock:
+        session.refs -= 1
+        if session.refs == 0:
+            del _sessions[session.key]
+            session.cxn.close()
+
+def locked(method):
+    """Holds the session lock for the whole call, so another SourceMeterServer on the same
+    connection can't get a command in between this one's command and its reply"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._session.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class StepMonitor(object):
+    """Hooks MakeIVCurve calls while it ramps, this one changes nothing. A subclass can log every
+    step, end a ramp up early or wait on something other than time.sleep (see IVStation)"""
+
+    def allow(self, vStep):
+        """Called before stepping up to vStep, False ends the ramp up there"""
+        return True
+
+    def wait(self, seconds):
+        """Dwell at a step"""
+        time.sleep(seconds)
+
+    def stopped(self):
+        """True to abort a sweep running on the instrument and bring the output down"""
+        return False
+
+    def step(self, vStep, current):
+        """Called with the current read at every step"""
+        pass
+
 class SourceMeterServer(object):
 
-    def __init__(self,port):
+    def __init__(self,port,simulate=False,cache=True):
+        """simulate=True talks to a default SimulatedKeithley2410 instead of the COM port,
+        a SimulatedKeithley2410 instance can also be passed to control its latency and sensor model.
+        cache=False disables the shadow registers, every getter and setter then goes to the instrument.
+        Servers opened on the same port share one connection and its shadow registers (see open_session)"""
         self.port = port
+        self.cache = cache
+        self._session  = None # VisaSession shared with the other servers on this port
+        self._shadow   = {} # setting -> last command written for it
+        self._readback = {} # setting -> value the instrument returned for it since that write
+        self._batch    = None # SCPIBatch collecting writes, see batch()
+        self.bus       = None # BusStats timing the transfers, see record_bus()
         self.isOpen = False
+        if simulate is True:
+            self._sim = SimulatedKeithley2410()
+        elif simulate:
+            self._sim = simulate
+        else:
+            self._sim = None
         self.open()
 
         self.alias_sense = {
@@ -44,26 +234,51 @@ class SourceMeterServer(object):
     #  Opening and closing visa connections  #
     ##########################################
     def close(self):
-        """Closes the connection to the COM port"""
+        """Closes the connection to the COM port, once no other server is using it"""
         if self.isOpen:
-            self._cxn.close()
+            close_session(self._session)
+            self._session = None
             self.isOpen = False
         else:
             raise ValueError("Connection already closed")
     def open(self):
         if not(self.isOpen):
-            self._rm  = visa.ResourceManager()
-            self._cxn = self._rm.open_resource(
-                "COM13",
-                read_termination=READ_TERMINATION,
-                write_termination=WRITE_TERMINATION,
-                )
+            self._session = open_session(self.port, self._sim)
+            self._connect()
+            self._shadow = self._session.shadow
+            self._readback = self._session.readback
+            if self._session.refs == 1:
+                self.invalidate_cache() # someone else may have changed the settings while we were closed
             self.isOpen = True # wheter or not the connection is open
         else:
             raise ValueError("Connection already open")
+
+    def record_bus(self,stats=None):
+        """Times every transfer from now on into stats (a new BusStats if None) and returns it,
+        record_bus(False) stops timing (see BusTiming)"""
+        if stats is False:
+            self.bus = None
+        else:
+            self.bus = stats if stats is not None else BusStats()
+        if self.isOpen:
+            self._connect()
+        return self.bus
+
+    def _connect(self):
+        """Talks to the session's connection directly, or through a TimedConnection when recording"""
+        if self.bus is None:
+            self._cxn = self._session.cxn
+        else:
+            self._cxn = TimedConnection(self._session.cxn, self.bus, WRITE_TERMINATION, READ_TERMINATION)
+
+    def transaction(self):
+        """Lock to hold around a command and the read of its reply when other servers may share the
+        connection (with s.transaction(): s.meas(); s.read()); the built in queries hold it already"""
+        return self._session.lock
        
 
     def rstFlags(self,default=False):
+            self.invalidate_cache()
             self.Vout=False
             self.Iout=False
             
@@ -78,6 +293,11 @@ class SourceMeterServer(object):
                 self.Isense=False
                 self.Rsense=False
 
+    def invalidate_cache(self):
+        """Forgets every shadowed setting, the next getter/setter goes to the instrument"""
+        self._shadow.clear()
+        self._readback.clear()
+
 
     ##########################
     #  LOW-LEVEL READ/WRITE  #
@@ -86,7 +306,7 @@ class SourceMeterServer(object):
 
     def write(self,data):
         if self.isOpen:
-            self._cxn.write(data)
+            self._send(data)
             self.rstFlags()
         else:
             raise ValueError("Connection is closed")
@@ -94,6 +314,8 @@ class SourceMeterServer(object):
     
     def write_raw(self,data):
         if self.isOpen:
+            if self._batch is not None:
+                self._batch.flush()
             self._cxn.write_raw(data)
             self.rstFlags()
         else:
@@ -102,17 +324,89 @@ class SourceMeterServer(object):
     
     def read(self):
         if self.isOpen:
+            if self._batch is not None:
+                self._batch.flush() # a query queued in a batch has to go out before its reply can come back
             return self._cxn.read()
         else:
             raise ValueError("Connection is closed")
 
+    def read_bytes(self,count):
+        """Reads exactly count bytes, for binary replies that may contain the termination characters"""
+        if self.isOpen:
+            if self._batch is not None:
+                self._batch.flush()
+            return self._cxn.read_bytes(count)
+        else:
+            raise ValueError("Connection is closed")
+
     ###the private write method should be used if the flags are taken care of by the method calling it
     def __write(self,data):
         if self.isOpen:
-            self._cxn.write(data)
+            self._send(data)
         else:
             raise ValueError("Connection is closed")
 
+    @locked
+    def query(self,cmd,convert=str):
+        """Writes the query cmd and returns its reply parsed by convert, as one transaction.
+        Unlike write() it leaves the mode flags and the shadow registers alone"""
+        self.__write(cmd)
+        return convert(self.read())
+
+    def _send(self,data):
+        if self._batch is not None:
+            self._batch.commands.append(data)
+        else:
+            self._cxn.write(data)
+
+    def batch(self):
+        """Context manager that joins every command written inside it into one ';'-separated write
+
+        with s.batch() as b:
+            s.source_voltage_level(100)
+            s.meas()
+            b.query(":SOUR:VOLT:RANG?",float)
+        b.result # parsed reply of the query, b.results if several were queued
+        """
+        if self._batch is not None:
+            raise ValueError("Batch already open")
+        return SCPIBatch(self)
+
+
+    ###shadow registers: setters skip a write that repeats the last command for that setting,
+    ###getters answer from the last reply until the setting is written again.
+    ###write(), write_raw() and reset() clear them through rstFlags()
+    def _set(self,key,cmd):
+        """Writes cmd for setting key unless it was the last thing written to it, returns True if written"""
+        if self.cache and self._shadow.get(key) == cmd:
+            return False
+        self._forget(key)
+        self.__write(cmd)
+        self._shadow[key] = cmd
+        return True
+
+    def _forget(self,key):
+        """Drops setting key from the shadow registers, its next write and read go to the instrument"""
+        self._shadow.pop(key,None)
+        self._readback.pop(key,None)
+
+    def _cacheable(self,key):
+        """Whether the reply to key? stays valid until key is written again"""
+        if not self.cache:
+            return False
+        if key not in self._shadow:
+            return key not in AUTORANGED # *RST leaves these ranges to the instrument
+        return not self._shadow[key].endswith(":AUTO ON") # auto ranging, the range follows the readings
+
+    @locked
+    def _query(self,key,convert=str):
+        if key in self._readback and self._cacheable(key):
+            return self._readback[key]
+        self.__write(key+"?")
+        value = convert(self.read())
+        if self._cacheable(key):
+            self._readback[key] = value
+        return value
 
 
     ############################
@@ -123,10 +417,10 @@ class SourceMeterServer(object):
         self.__write("*RST")
         self.rstFlags(default=True) 
     def remote_on(self):
-        self.__write(":SYST:RSEN ON")
+        self._set(":SYST:RSEN",":SYST:RSEN ON")
         self.remoteOn=True
     def remote_off(self):
-        self.__write(":SYST:RSEN OFF")
+        self._set(":SYST:RSEN",":SYST:RSEN OFF")
         self.remoteOn=False
 
 
@@ -138,11 +432,10 @@ class SourceMeterServer(object):
 
     def source_mode(self,setto=None):
         if setto == None:
-            self.__write(":SOUR:FUNC:MODE?")
-            return self.read()
+            return self._query(":SOUR:FUNC:MODE")
         else:
             if setto in self.alias_source.keys():
-                self.__write(":SOUR:FUNC {setto}".format(setto=self.alias_source[setto]))
+                self._set(":SOUR:FUNC:MODE",":SOUR:FUNC {setto}".format(setto=self.alias_source[setto]))
                 #print (":SOUR:FUNC {setto}".format(setto=self.alias_source[setto]))
                 if self.alias_source[setto]=='VOLT': 
                     self.Vout=True
@@ -155,42 +448,39 @@ class SourceMeterServer(object):
 
     def source_voltage_range(self,setto=None):
         if setto == None:
-            self.__write(":SOUR:VOLT:RANG?")
-            return float(self.read())
+            return self._query(":SOUR:VOLT:RANG",float)
         else:
             if self.Vout==True:
-                self.__write(":SOUR:VOLT:RANG {setto}".format(setto=setto))
+                if self._set(":SOUR:VOLT:RANG",":SOUR:VOLT:RANG {setto}".format(setto=setto)):
+                    self._forget(":SOUR:VOLT:LEV") # a level the old range refused is written again
             else:
                 raise ValueError("Not in voltage source mode")
 
     def source_current_range(self,setto=None):
         if setto == None:
-
-            self.__write(":SOUR:CURR:RANG?")
-            return float(self.read())
+            return self._query(":SOUR:CURR:RANG",float)
         else:
             if self.Iout==True:
-                self.__write(":SOUR:CURR:RANG {setto}".format(setto=setto))
+                if self._set(":SOUR:CURR:RANG",":SOUR:CURR:RANG {setto}".format(setto=setto)):
+                    self._forget(":SOUR:CURR:LEV") # a level the old range refused is written again
             else:
                 raise ValueError("Not in current source mode")
 
     def source_voltage_level(self,setto=None):
         if setto == None:
-            self.__write(":SOUR:VOLT:LEV?")
-            return float(self.read())
+            return self._query(":SOUR:VOLT:LEV",float)
         else:
             if self.Vout==True:
-                self.__write(":SOUR:VOLT:LEV {setto}".format(setto=setto))
+                self._set(":SOUR:VOLT:LEV",":SOUR:VOLT:LEV {setto}".format(setto=setto))
             else:
                 raise ValueError("Not in voltage source mode")
 
     def source_current_level(self,setto=None):
         if setto == None:
-            self.__write(":SOUR:CURR:LEV?")
-            return float(self.read())
+            return self._query(":SOUR:CURR:LEV",float)
         else:
             if self.Iout==True:
-                self.__write(":SOUR:CURR:LEV {setto}".format(setto=setto))
+                self._set(":SOUR:CURR:LEV",":SOUR:CURR:LEV {setto}".format(setto=setto))
             else:
                 raise ValueError("Not in current source mode")
 
@@ -202,10 +492,10 @@ class SourceMeterServer(object):
     # OUTPUT (OUTP) FUNCTIONS #
     ###########################
     def output_on(self):
-        self.__write(":OUTP ON")
+        self._set(":OUTP",":OUTP ON")
         self.outpOn=True
     def output_off(self):
-        self.__write(":OUTP OFF")
+        self._set(":OUTP",":OUTP OFF")
         self.outpOn=False
 
 
@@ -216,12 +506,16 @@ class SourceMeterServer(object):
 
     def sense_off_all(self):
         self.__write(":SENS:FUNC:OFF:ALL")
+        for which in ('VOLT','CURR','RES'):
+            self._shadow[":SENS:FUNC:"+which] = "OFF"
         self.Vsense=False
         self.Isense=False
         self.Rsense=False
     
     def sense_on_all(self):
         self.__write(":SENS:FUNC:ON:ALL")
+        for which in ('VOLT','CURR','RES'):
+            self._shadow[":SENS:FUNC:"+which] = "ON"
         self.Vsense=True
         self.Isense=True
         self.Rsense=True
@@ -229,8 +523,8 @@ class SourceMeterServer(object):
     def sense_on(self,which):
         if not (which in self.alias_sense.keys()):
             raise ValueError("Invalid sense setting")
-        self.__write(":SENS:FUNC:ON '{which}'".format(which=self.alias_sense[which]))
-        if self.alias_sense[which]=='VOlT':
+        self._set_sense(self.alias_sense[which],"ON")
+        if self.alias_sense[which]=='VOLT':
             self.Vsense=True
         if self.alias_sense[which]=='CURR':
             self.Isense=True
@@ -240,14 +534,21 @@ class SourceMeterServer(object):
     def sense_off(self,which):
         if not (which in self.alias_sense.keys()):
             raise ValueError("Invalid sense setting")
-        self.__write(":SENS:FUNC:OFF '{which}'".format(which=self.alias_sense[which]))
-        if self.alias_sense[which]=='VOlT':
+        self._set_sense(self.alias_sense[which],"OFF")
+        if self.alias_sense[which]=='VOLT':
             self.Vsense=False
         if self.alias_sense[which]=='CURR':
             self.Isense=False
         if self.alias_sense[which]=='RES':
             self.Rsense=False
          
+    def _set_sense(self,which,state):
+        if self.cache and self._shadow.get(":SENS:FUNC:"+which) == state:
+            return
+        self.__write(":SENS:FUNC:{state} '{which}'".format(state=state,which=which))
+        self._shadow[":SENS:FUNC:"+which] = state
+
+    @locked
     def get_active_sense_functions(self):
         self.__write(":SENS:FUNC:ON?")
         ans = self.read()
@@ -260,6 +561,7 @@ class SourceMeterServer(object):
         active.append(ans)
         return active
 
+    @locked
     def get_inactive_sense_functions(self):
         self.__write(":SENS:FUNC:OFF?")
         ans=self.read()
@@ -272,48 +574,298 @@ class SourceMeterServer(object):
         inactive.append(ans)
         return inactive
 
+    @locked
     def sense_current_range(self,setto=None):
         if setto == None:
-            self.__write(":SENS:CURR:RANG?")
-            return self.read()
+            return self._query(":SENS:CURR:RANG")
         if setto=='AUTO':
-            self.__write(":SENS:CURR:RANG:AUTO ON")
+            self._set(":SENS:CURR:RANG",":SENS:CURR:RANG:AUTO ON")
         else:
-            print ("setting I range")
-            print ("\nrange\n",self.sense_current_range())
-            self.__write(":SENS:CURR:RANG {setto}".format(setto=setto))
-            print ("\nrange\n",self.sense_current_range())
+            if self._set(":SENS:CURR:RANG",":SENS:CURR:RANG {setto}".format(setto=setto)):
+                print ("setting I range to",setto)
     def sense_current_prot(self,setto=None):
         if setto == None:
-            self.__write(":SENS:CURR:PROT?")
-            return self.read()
+            return self._query(":SENS:CURR:PROT")
         else:
-            self.__write(":SENS:CURR:PROT {setto}".format(setto=setto))
+            self._set(":SENS:CURR:PROT",":SENS:CURR:PROT {setto}".format(setto=setto))
     
     def sense_voltage_range(self,setto=None):
         if setto == None:
-            self.__write(":SENS:VOLT:RANG?")
-            return self.read()
+            return self._query(":SENS:VOLT:RANG")
         else:
-            self.__write(":SENS:VOLT:RANG {setto}".format(setto=setto))
+            self._set(":SENS:VOLT:RANG",":SENS:VOLT:RANG {setto}".format(setto=setto))
     
     def sense_voltage_prot(self,setto=None):
         if setto == None:
-            self.__write(":SENS:VOLT:PROT?")
-            return self.read()
+            return self._query(":SENS:VOLT:PROT")
         else:
-            self.__write(":SENS:VOLT:PROT {setto}".format(setto=setto))
+            self._set(":SENS:VOLT:PROT",":SENS:VOLT:PROT {setto}".format(setto=setto))
+
+    def sense_average(self,setto=None,tcontrol='REP'):
+        """Averaging filter, each reading becomes the average of setto conversions (1-100, REPeat or
+        MOVing), 0 turns it off. Without setto returns the count, 0 when the filter is off"""
+        if setto == None:
+            if not int(float(self._query(":SENS:AVER"))):
+                return 0
+            return int(float(self._query(":SENS:AVER:COUN")))
+        if not setto:
+            self._set(":SENS:AVER",":SENS:AVER OFF")
+            return
+        if not 1 <= setto <= 100:
+            raise ValueError("Averaging count must be 1 to 100")
+        if tcontrol not in ('REP','MOV'):
+            raise ValueError("Invalid averaging type")
+        self._set(":SENS:AVER:TCON",":SENS:AVER:TCON {}".format(tcontrol))
+        self._set(":SENS:AVER:COUN",":SENS:AVER:COUN {}".format(int(setto)))
+        self._set(":SENS:AVER",":SENS:AVER ON")
 
     def format_data(self, setto=None):
         if setto == None:
-            self.__write(":FORM:ELEM?")
-            return self.read()
+            return self._query(":FORM:ELEM")
         else:
-            self.__write(":FORM:ELEM {setto}".format(setto=setto))
+            self._set(":FORM:ELEM",":FORM:ELEM {setto}".format(setto=setto))
+
+    def format_data_type(self,setto=None):
+        """ASC (default), or SRE/DRE for 4/8 byte IEEE754 binary readings"""
+        if setto == None:
+            return self._query(":FORM:DATA").partition(',')[0][:3]
+        setto = setto.upper()[:3]
+        if setto not in DATA_SIZES:
+            raise ValueError("Invalid data format")
+        self._set(":FORM:DATA",":FORM:DATA {setto}".format(setto=setto))
+
+    def format_byte_order(self,setto=None):
+        """Byte order of binary readings, NORM (big-endian) or SWAP (little-endian)"""
+        if setto == None:
+            return self._query(":FORM:BORD")[:4]
+        setto = setto.upper()[:4]
+        if setto not in ('NORM','SWAP'):
+            raise ValueError("Invalid byte order")
+        self._set(":FORM:BORD",":FORM:BORD {setto}".format(setto=setto))
+
+    def record_elements(self):
+        """Elements of each reading record (set by format_data), in the order the instrument sends them:
+        always VOLT,CURR,RES,TIME,STAT, whatever order format_data listed them in"""
+        if self.cache and ":FORM:ELEM" in self._shadow:
+            elements = self._shadow[":FORM:ELEM"].partition(' ')[2]
+        else:
+            elements = self.format_data()
+        elements = [e.strip().strip('"').partition(':')[0].upper() for e in elements.split(',')]
+        return [o for o in ELEMENT_ORDER if any(e.startswith(o) for e in elements)] # long or short form
+
+    def record_dtype(self):
+        """numpy dtype of one reading record, one field per element"""
+        data_type = self.format_data_type()
+        if data_type == 'ASC':
+            value = 'f8'
+        else:
+            value = ('>' if self.format_byte_order() == 'NORM' else '<') + 'f{}'.format(DATA_SIZES[data_type])
+        return np.dtype([(e,value) for e in self.record_elements()])
+
+    def record_format(self):
+        """(dtype, binary) for read_array, it has to be looked up before the query whose reply it decodes"""
+        return self.record_dtype(), self.format_data_type() != 'ASC'
+
+    def read_array(self,fmt=None,count=None):
+        """Reads a reply of reading records into a numpy record array (fields named after the elements).
+        Binary replies are decoded in place with numpy.frombuffer, count is the number of records
+        they hold. fmt is record_format(), only optional when the format settings are cached"""
+        dtype,binary = self.record_format() if fmt is None else fmt
+        if not binary:
+            return np.fromstring(self.read(), sep=',').view(dtype)
+        if count is None:
+            raise ValueError("Binary readings need the number of records")
+        raw = self.read_bytes(2 + count*dtype.itemsize + len(READ_TERMINATION))
+        if raw[:2] != b'#0':
+            raise ValueError("Not a binary reading block")
+        return np.frombuffer(raw, dtype=dtype, count=count, offset=2)
 
     def meas(self):
         return self.__write(":READ?")
 
+    @locked
+    def meas_samples(self,n=1):
+        """n readings taken on one trigger (:TRIG:COUN n) as a record array, one transfer each way.
+        The trigger count goes back to what it was in the same write, after the :READ?"""
+        fmt = self.record_format()
+        written = self._shadow.get(":TRIG:COUN")
+        previous = int(written.split()[-1]) if written is not None else self.trigger_count()
+        with self.batch():
+            self.trigger_count(n)
+            self.meas()
+            if previous != n:
+                self.trigger_count(previous)
+            return self.read_array(fmt,n)
+
+    @locked
+    def meas_array(self):
+        """meas() and its readings as a record array"""
+        fmt = self.record_format()
+        count = self.trigger_count() if fmt[1] else None
+        self.meas()
+        return self.read_array(fmt,count)
+
+
+
+    ###########################################
+    # SWEEP, TRIGGER and TRACE (TRAC) buffer  #
+    ###########################################
+
+    def source_voltage_mode(self,setto=None):
+        """FIX for a fixed level, SWE for the staircase sweep, LIST for the source_voltage_list levels"""
+        if setto == None:
+            return self._query(":SOUR:VOLT:MODE")
+        if setto not in ('FIX','SWE','LIST'):
+            raise ValueError("Invalid voltage source mode")
+        self._set(":SOUR:VOLT:MODE",":SOUR:VOLT:MODE {setto}".format(setto=setto))
+
+    def source_voltage_sweep(self,start,stop,points):
+        """Linear staircase from start to stop in points steps, on the best fixed range for the whole sweep"""
+        if not 1 <= points <= SWEEP_MAX_POINTS:
+            raise ValueError("A sweep has 1 to {} points".format(SWEEP_MAX_POINTS))
+        self._set(":SOUR:SWE:RANG",":SOUR:SWE:RANG BEST")
+        self._set(":SOUR:SWE:SPAC",":SOUR:SWE:SPAC LIN")
+        self._set(":SOUR:VOLT:STAR",":SOUR:VOLT:STAR {}".format(start))
+        self._set(":SOUR:VOLT:STOP",":SOUR:VOLT:STOP {}".format(stop))
+        self._set(":SOUR:SWE:POIN",":SOUR:SWE:POIN {}".format(points))
+
+    def source_voltage_list(self,levels):
+        if not 1 <= len(levels) <= LIST_MAX_POINTS:
+            raise ValueError("A source list has 1 to {} points".format(LIST_MAX_POINTS))
+        self._set(":SOUR:LIST:VOLT",":SOUR:LIST:VOLT "+",".join(str(float(v)) for v in levels))
+
+    def source_delay(self,setto=None):
+        """Settling time between sourcing each level and measuring it, in seconds"""
+        if setto == None:
+            return self._query(":SOUR:DEL",float)
+        self._set(":SOUR:DEL",":SOUR:DEL {setto}".format(setto=setto))
+
+    def sweep_compliance_abort(self,setto=None):
+        """NEV, or EARL/LATE to stop a sweep as soon as a reading is in compliance"""
+        if setto == None:
+            return self._query(":SOUR:SWE:CAB")
+        if setto not in ('NEV','EARL','LATE'):
+            raise ValueError("Invalid compliance abort setting")
+        self._set(":SOUR:SWE:CAB",":SOUR:SWE:CAB {setto}".format(setto=setto))
+
+    def trigger_count(self,setto=None):
+        """Number of source-delay-measure cycles per :INIT or :READ?"""
+        if setto == None:
+            return int(self._query(":TRIG:COUN",float))
+        self._set(":TRIG:COUN",":TRIG:COUN {}".format(int(setto)))
+
+    def trace_buffer(self,points):
+        """Clears the trace buffer and arms it to store the next points readings"""
+        if not 1 <= points <= TRACE_MAX_POINTS:
+            raise ValueError("The trace buffer holds 1 to {} readings".format(TRACE_MAX_POINTS))
+        self.__write(":TRAC:CLE")
+        self._set(":TRAC:POIN",":TRAC:POIN {}".format(points))
+        self._set(":TRAC:FEED",":TRAC:FEED SENS")
+        self.__write(":TRAC:FEED:CONT NEXT")
+
+    @locked
+    def trace_count(self):
+        self.__write(":TRAC:POIN:ACT?")
+        return int(self.read())
+
+    @locked
+    def trace_data(self):
+        self.__write(":TRAC:DATA?")
+        return self.read()
+
+    @locked
+    def trace_array(self):
+        """Trace buffer contents as a record array"""
+        fmt = self.record_format()
+        count = self.trace_count()
+        self.__write(":TRAC:DATA?")
+        return self.read_array(fmt,count)
+
+    def initiate(self):
+        """Starts the trigger model without waiting for it, the readings are collected with fetch() or trace_data()"""
+        self.__write(":INIT")
+        if self._shadow.get(":SOUR:VOLT:MODE",":SOUR:VOLT:MODE FIX") != ":SOUR:VOLT:MODE FIX":
+            self._shadow.pop(":SOUR:VOLT:LEV",None) # a sweep leaves the output away from the bias level
+            self._readback.pop(":SOUR:VOLT:LEV",None)
+
+    @locked
+    def fetch(self):
+        self.__write(":FETC?")
+        return self.read()
+
+    @locked
+    def fetch_array(self):
+        fmt = self.record_format()
+        count = self.trigger_count() if fmt[1] else None
+        self.__write(":FETC?")
+        return self.read_array(fmt,count)
+
+    def abort(self):
+        self.__write(":ABOR")
+
+    @locked
+    def is_idle(self):
+        """True once the trigger model has finished (or was never started)"""
+        self.__write(":STAT:OPER:COND?")
+        return bool(int(float(self.read())) & OPER_IDLE)
+
+
+
+
+
+class SCPIBatch(object):
+    """Commands queued by SourceMeterServer.batch(), sent as a single write when the block exits"""
+
+    def __init__(self,server):
+        self.s = server
+        self.commands = []
+        self.queries  = [] # (query, convert) sent at the end of the write
+        self.results  = []
+        self.result   = None
+
+    def query(self,cmd,convert=str):
+        """Queues cmd (e.g. ':SENS:CURR:PROT?') to end the batch, its reply is parsed by convert into results"""
+        self.queries.append((cmd,convert))
+
+    def flush(self):
+        """Sends the commands queued so far as one write"""
+        if self.commands:
+            data = ";".join(self.commands)
+            self.commands = []
+            self.s._cxn.write(data)
+
+    def __enter__(self):
+        self.s._session.lock.acquire() # the batch and the replies to its queries go as one transaction
+        self.s._batch = self
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        try:
+            return self._exit(exc_type)
+        finally:
+            self.s._session.lock.release()
+
+    def _exit(self,exc_type):
+        self.s._batch = None
+        if exc_type is not None:
+            # the shadow registers already hold the unsent commands
+            self.commands = []
+            self.s.invalidate_cache()
+            return False
+        self.commands += [cmd for cmd,_ in self.queries]
+        self.flush()
+        if self.queries:
+            # earlier queries left unread in the batch come back in front of ours
+            replies = self.s.read().split(';')[-len(self.queries):]
+            for (cmd,convert),reply in zip(self.queries,replies):
+                value = convert(reply)
+                key = cmd.rstrip('?')
+                if self.s._cacheable(key):
+                    self.s._readback[key] = value
+                self.results.append(value)
+            self.result = self.results[-1]
+        return False
+
 
 
 
@@ -321,9 +873,19 @@ class SourceMeterServer(object):
     # Routines for IV curves, pedestal, etc #
     #########################################
 class MakeIVCurve(object):
-
-    def __init__(self, sourceMeterServer):
-        self.s=sourceMeterServer
+    ramp_down_step = 5   # volts per step when bringing the output down without measuring
+    ramp_down_wait = 0.5
+
+    def __init__(self, sourceMeterServer, simulate=False, monitor=None):
+        """sourceMeterServer is an open SourceMeterServer, or a port to open one on (optionally simulated).
+        monitor is a StepMonitor that sees every step and does the dwelling"""
+        if isinstance(sourceMeterServer, SourceMeterServer):
+            self.s=sourceMeterServer
+        else:
+            self.s=SourceMeterServer(sourceMeterServer, simulate=simulate)
+        self.monitor=monitor if monitor is not None else StepMonitor()
+        self.stepStats=[] # (voltage, reading_stats record) of every step measured with samples>1
+        self.dwellTimes=[] # (voltage, seconds waited, settled current estimate) of every step dwelled with a SettleDetector
 
     
 
@@ -332,11 +894,11 @@ class MakeIVCurve(object):
         
 
     def set_V_out_I_sense(self,setto=None, protI=None, rangeI=None):
-        self.s.sense_off('VOLT')
-        self.s.sense_off('RES')
         if setto==None:
             raise ValueError("No voltage value specified")
-        else:
+        with self.s.batch():
+            self.s.sense_off('VOLT')
+            self.s.sense_off('RES')
 
             #if self.remoteOn==False:
             #    self.remote_on()
@@ -355,13 +917,52 @@ class MakeIVCurve(object):
             self.s.source_voltage_level(setto)
 
             if self.s.Isense==False:
-               self.s.sens_on('CURR')
+               self.s.sense_on('CURR')
 
    
             if self.s.outpOn==False:
                 self.s.output_on()    
 
-    def ramp_volt_up(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None ):
+    def dwell(self, vStep, waitT, settle=None):
+        """Waits at a step: waitT seconds, or with a SettleDetector until the current has settled
+        (at most waitT, which overrides the detector's max_dwell)"""
+        if settle is None:
+            self.monitor.wait(waitT)
+            return waitT
+        settle.reset()
+        maxDwell=settle.max_dwell
+        settle.max_dwell=min(maxDwell, waitT) # for this step only, the detector may be used again with a longer waitT
+        try:
+            t0=time.time()
+            while True:
+                currentReading=float(self.s.meas_samples(1)['CURR'][0])
+                t=time.time()-t0
+                if settle.add(t, currentReading):
+                    break
+                self.monitor.wait(settle.interval)
+        finally:
+            settle.max_dwell=maxDwell
+        self.dwellTimes.append((vStep, t, settle.settledI))
+        return t
+
+    def read_step(self, vStep, samples=1):
+        """Current at this step: one reading, or the mean of samples readings taken on one trigger,
+        whose statistics are added to stepStats"""
+        readings=self.s.meas_samples(samples)
+        if samples==1:
+            return readings['CURR'][0]
+        stats=reading_stats(readings,('CURR',))
+        self.stepStats.append((vStep,stats))
+        return stats['CURR_mean']
+
+    def step_stats(self):
+        """stepStats as one record array with the step voltage in field v"""
+        if not self.stepStats:
+            return None
+        dtype=np.dtype([('v','f8')]+[(name,self.stepStats[0][1].dtype[name]) for name in self.stepStats[0][1].dtype.names])
+        return np.array([(v,)+tuple(stats) for v,stats in self.stepStats],dtype=dtype)
+
+    def ramp_volt_up(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, samples=1, settle=None ):
 
         measCurrent=[]
 
@@ -371,22 +972,25 @@ class MakeIVCurve(object):
         measPoints=[]
         for vStep in vPoints:
 
+            if not self.monitor.allow(vStep):
+                print ("Ramp up stopped at {} V".format(vStep))
+                break
+
             if vStep==startV:
                 self.set_V_out_I_sense(setto=vStep, protI=maxI, rangeI=rangeI)
-                time.sleep(waitT)
-                self.s.meas()
-                currentReading=self.s.read()
+                self.dwell(vStep, waitT, settle)
+                currentReading=self.read_step(vStep,samples)
                 measCurrent.append(currentReading)
                 measPoints.append(vStep)
             else:
                 self.set_V_out_I_sense(setto=vStep, protI=maxI, rangeI='AUTO')
-                time.sleep(waitT)
-                self.s.meas()
-                currentReading=self.s.read()
+                self.dwell(vStep, waitT, settle)
+                currentReading=self.read_step(vStep,samples)
                 measCurrent.append(currentReading)
                 measPoints.append(vStep)
                 
             print (vStep,currentReading)
+            self.monitor.step(vStep,currentReading)
             
             if float(currentReading)>maxI*0.95:
                 print ("Max current reached before reaching the max set voltage")
@@ -399,7 +1003,7 @@ class MakeIVCurve(object):
         
 
 
-    def ramp_volt_down(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None):
+    def ramp_volt_down(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, samples=1, settle=None):
         measCurrent=[]
 
         self.s.format_data("CURR")
@@ -409,29 +1013,136 @@ class MakeIVCurve(object):
 
             if vStep==startV:
                 self.set_V_out_I_sense(setto=vStep, protI=maxI, rangeI=rangeI)
-                time.sleep(waitT)
-                self.s.meas()
-                currentReading=self.s.read()
+                self.dwell(vStep, waitT, settle)
+                currentReading=self.read_step(vStep,samples)
                 measCurrent.append(currentReading)
             else:
                 self.set_V_out_I_sense(setto=vStep, protI=maxI, rangeI='AUTO')
-                time.sleep(waitT)
-                self.s.meas()
-                currentReading=self.s.read()
+                self.dwell(vStep, waitT, settle)
+                currentReading=self.read_step(vStep,samples)
                 measCurrent.append(currentReading)
 
             print (vStep,currentReading)
+            self.monitor.step(vStep,currentReading)
 
 
         measCurrent=np.array(measCurrent)
         return np.array([vPoints,measCurrent])
 
-    def makeIVCurve(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None):
+    def sweep_volt(self, vPoints, waitT=30, maxI=1*10**(-6), rangeI=None, abort=True, poll=0.05):
+        """Steps through vPoints with the 2410's own sweep instead of python sleeps.
+
+        The instrument sources each level, waits waitT (source delay) and measures into the trace
+        buffer, which is fetched in one transfer at the end. Evenly spaced points run as a staircase
+        sweep, anything else as a source list. With abort=True the sweep stops at compliance (maxI)
+        and, like ramp_volt_up, the returned curve ends at the first reading above 95% of maxI;
+        abort=False runs every point like ramp_volt_down.
+        The current range can't change between the points of one sweep, so the sweep autoranges
+        (the python ramps only hold rangeI for their first step); an overflowed reading comes back
+        as nan, not as a current above compliance. A monitor that reports stopped() aborts the
+        sweep, the output is brought down with ramp_to_zero and the points measured so far returned.
+        Returns np.array([voltages, currents])"""
+        vPoints=np.asarray(vPoints, dtype=float)
+        n=len(vPoints)
+        if n > min(SWEEP_MAX_POINTS, TRACE_MAX_POINTS):
+            raise ValueError("Too many points for one sweep")
+        linear = n < 3 or np.allclose(np.diff(vPoints), vPoints[1]-vPoints[0])
+
+        with self.s.batch():
+            self.s.sense_off('VOLT')
+            self.s.sense_off('RES')
+            self.s.source_mode('VOLT')
+            self.s.sense_on('CURR')
+            self.s.sense_current_prot(maxI)
+            self.s.sense_current_range('AUTO')
+            self.s.format_data("CURR")
+            self.s.source_voltage_mode('FIX')
+            self.s.source_voltage_range(np.abs(vPoints).max())
+            self.s.source_voltage_level(vPoints[0]) # bias level, arming the sweep doesn't move the output away from the first point
+            if linear:
+                self.s.source_voltage_sweep(vPoints[0], vPoints[-1], n)
+                self.s.source_voltage_mode('SWE')
+            else:
+                self.s.source_voltage_list(vPoints)
+                self.s.source_voltage_mode('LIST')
+            self.s.sweep_compliance_abort('EARL' if abort else 'NEV')
+            self.s.source_delay(waitT)
+            self.s.trigger_count(n)
+            self.s.trace_buffer(n)
+            self.s.output_on()
+            self.s.initiate()
+
+        # one status query per pause keeps the bus quiet while the instrument times the sweep, and
+        # a sweep that ends early at compliance or is stopped is seen within a pause, not after n*waitT
+        pause=max(poll, min(waitT, 1.0))
+        stopped=False
+        while not self.s.is_idle():
+            if self.monitor.stopped():
+                self.s.abort()
+                stopped=True
+                break
+            self.monitor.wait(pause)
+        currents=self.s.trace_array()['CURR'].astype(float)
+        currents[currents >= OVERFLOW_READING]=np.nan # over range, not a current (nan > maxI is False)
+
+        done=len(currents)
+        over=np.nonzero(currents > maxI*0.95)[0]
+        if abort and len(over):
+            print ("Max current reached before reaching the max set voltage")
+            done=over[0]+1
+        vPoints=vPoints[:done]
+        currents=currents[:done]
+
+        with self.s.batch():
+            if done:
+                self.s.source_voltage_level(vPoints[-1]) # hold the last level reached once back in FIX mode
+            self.s.source_voltage_mode('FIX')
+            self.s.trigger_count(1)
+
+        for vStep,currentReading in zip(vPoints,currents):
+            print (vStep,currentReading)
+            self.monitor.step(vStep,currentReading)
+        if stopped:
+            print ("Sweep stopped after {} of {} points".format(done,n))
+            self.ramp_to_zero()
+        return np.array([vPoints,currents])
+
+    def ramp_to_zero(self):
+        """Steps the output down to 0 V without measuring and turns it off, like ivServer.close"""
+        V=float(self.s.source_voltage_level())
+        while V > self.ramp_down_step:
+            V-=self.ramp_down_step
+            self.s.source_voltage_level(V)
+            self.monitor.wait(self.ramp_down_wait)
+        self.s.source_voltage_level(0)
+        self.s.output_off()
+
+    def makeIVCurve(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, sweep=False, samples=1, settle=None, down=True):
+        """sweep=True times the ramps on the instrument (see sweep_volt) instead of in python.
+        samples>1 (python ramps) takes that many readings per step on one trigger, their statistics end up in stepStats.
+        settle, a SettleDetector (python ramps), ends each step once the current has settled, waitT becoming the longest dwell.
+        down=False only measures the ramp up, the output then comes down through ramp_to_zero and rampDown is empty"""
         self.s.reset()
-        rampUp=self.ramp_volt_up(startV=startV, stopV=stopV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI )
-        downStart=float(rampUp[0][-1])
+        self.stepStats=[]
+        self.dwellTimes=[]
+        if sweep:
+            rampUp=self.sweep_volt(np.arange(startV, stopV+step, step), waitT=waitT, maxI=maxI, rangeI=rangeI)
+            downStart=float(rampUp[0][-1]) if len(rampUp[0]) else startV # the sweep can abort on its first point
+            if not down or self.monitor.stopped():
+                self.ramp_to_zero()
+                return(np.array([[],[]]),rampUp)
+
+            rampDown=self.sweep_volt(np.arange(startV, downStart+step, step)[::-1], waitT=waitT, maxI=maxI, rangeI=rangeI, abort=False)
+            self.s.output_off()
+            return(rampDown,rampUp)
+
+        rampUp=self.ramp_volt_up(startV=startV, stopV=stopV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI, samples=samples, settle=settle )
+        downStart=float(rampUp[0][-1]) if len(rampUp[0]) else startV # the monitor can stop the ramp before its first step
+        if not down:
+            self.ramp_to_zero()
+            return(np.array([[],[]]),rampUp)
         
-        rampDown=self.ramp_volt_down(startV=downStart, stopV=startV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI)
+        rampDown=self.ramp_volt_down(startV=downStart, stopV=startV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI, samples=samples, settle=settle)
         self.s.output_off()
         return(rampDown,rampUp)
 
@@ -0,0 +1,204 @@
+"""
+asyncio front end for SourceMeterServer and MakeIVCurve.
+
+VISA calls block, so every AsyncSourceMeterServer runs its instrument's calls on a thread of its
+own, one call after the other, and hands back awaitables: while one instrument waits on the serial
+link or dwells at a step, the event loop is free for the other instruments, the live display and
+file writing. Each call has a timeout (asyncio.TimeoutError) and can be cancelled; a call already
+on the wire can't be interrupted, it finishes on the instrument's thread and its reply is dropped,
+so the next command still finds the link in order. Every SourceMeterServer method is available
+awaitable under the same name:
+
+    async def main():
+        s = AsyncSourceMeterServer(6)
+        await s.sense_current_prot(1.05e-3)
+        v = await s.query(":SOUR:VOLT:RANG?", float)
+        down, up = await AsyncMakeIVCurve(s).makeIVCurve(stopV=100, waitT=10)
+        await s.close()
+
+Runs on Python 3.6 (the station's version) and later, get_event_loop() rather than the 3.7
+asyncio.run()/get_running_loop().
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import time
+
+import numpy as np
+
+from Keithley2410 import SourceMeterServer, MakeIVCurve
+from Keithley2410Sim import SimulatedKeithley2410
+
+DEFAULT_TIMEOUT = 10.0 # seconds a call may take before asyncio.TimeoutError, dwells are not calls
+
+
+class AsyncSourceMeterServer(object):
+
+    def __init__(self, port=None, simulate=False, server=None, timeout=DEFAULT_TIMEOUT):
+        """Opens a SourceMeterServer on port (see SourceMeterServer), or wraps server if given"""
+        self.s = server if server is not None else SourceMeterServer(port, simulate=simulate)
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) # one thread: calls reach the instrument in order
+
+    async def call(self, fn, *args, timeout=None, **kwargs):
+        """Runs fn(*args, **kwargs), a blocking call on the instrument, on its thread"""
+        future = asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        # shield: a timeout or cancel only stops the waiting, the call itself runs to the end
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout if timeout is None else timeout)
+
+    def __getattr__(self, name):
+        attr = getattr(self.s, name)
+        if not callable(attr):
+            return attr
+        async def method(*args, **kwargs):
+            return await self.call(attr, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+    async def write(self, cmd, timeout=None):
+        await self.call(self.s.write, cmd, timeout=timeout)
+
+    async def query(self, cmd, convert=str, timeout=None):
+        """SourceMeterServer.query: cmd and its reply in one call, under the session lock"""
+        return await self.call(self.s.query, cmd, convert, timeout=timeout)
+
+    async def meas(self, samples=1, timeout=None):
+        """meas_samples() readings record array"""
+        return await self.call(self.s.meas_samples, samples, timeout=timeout)
+
+    async def close(self):
+        await self.call(self.s.close)
+        self._executor.shutdown(wait=False)
+
+
+class AsyncMakeIVCurve(object):
+    """MakeIVCurve's ramps on an AsyncSourceMeterServer: the dwells are asyncio.sleep and the
+    instrument calls are awaited, so many of these can run on one event loop. A ramp that is
+    cancelled or fails brings the output down in ramp_down_step volt steps before the cancel or
+    the error goes on"""
+    ramp_down_step = 5
+    ramp_down_wait = 0.5
+
+    def __init__(self, server, monitor=None):
+        self.a = server
+        self.ivc = MakeIVCurve(server.s, monitor=monitor)
+        self.monitor = self.ivc.monitor
+
+    @property
+    def stepStats(self):
+        return self.ivc.stepStats
+
+    @property
+    def dwellTimes(self):
+        return self.ivc.dwellTimes
+
+    async def dwell(self, vStep, waitT, settle=None):
+        if settle is None:
+            await asyncio.sleep(waitT)
+            return waitT
+        settle.reset()
+        maxDwell=settle.max_dwell
+        settle.max_dwell=min(maxDwell, waitT) # for this step only, as in MakeIVCurve.dwell
+        try:
+            t0=time.time()
+            while True:
+                currentReading=float((await self.a.meas())['CURR'][0])
+                t=time.time()-t0
+                if settle.add(t, currentReading):
+                    break
+                await asyncio.sleep(settle.interval)
+        finally:
+            settle.max_dwell=maxDwell
+        self.ivc.dwellTimes.append((vStep, t, settle.settledI))
+        return t
+
+    async def step_to(self, vStep, waitT, maxI, rangeI, samples, settle):
+        await self.a.call(self.ivc.set_V_out_I_sense, setto=vStep, protI=maxI, rangeI=rangeI)
+        await self.dwell(vStep, waitT, settle)
+        currentReading=await self.a.call(self.ivc.read_step, vStep, samples)
+        print (vStep,currentReading)
+        self.monitor.step(vStep,currentReading)
+        return currentReading
+
+    async def ramp_volt_up(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, samples=1, settle=None):
+        await self.a.format_data("CURR")
+        measPoints=[]
+        measCurrent=[]
+        for vStep in np.arange(startV, stopV+step, step):
+            if not self.monitor.allow(vStep):
+                print ("Ramp up stopped at {} V".format(vStep))
+                break
+            currentReading=await self.step_to(vStep, waitT, maxI, rangeI if vStep==startV else 'AUTO', samples, settle)
+            measPoints.append(vStep)
+            measCurrent.append(currentReading)
+            if float(currentReading)>maxI*0.95:
+                print ("Max current reached before reaching the max set voltage")
+                break
+        return np.array([np.array(measPoints),np.array(measCurrent)])
+
+    async def ramp_volt_down(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, samples=1, settle=None):
+        await self.a.format_data("CURR")
+        vPoints=np.arange(stopV, startV+step, step)[::-1]
+        measCurrent=[]
+        for vStep in vPoints:
+            measCurrent.append(await self.step_to(vStep, waitT, maxI, rangeI if vStep==startV else 'AUTO', samples, settle))
+        return np.array([vPoints,np.array(measCurrent)])
+
+    async def ramp_to_zero(self):
+        """Steps the output down to 0 V and turns it off, like ivServer.close"""
+        V=await self.a.source_voltage_level()
+        while V > self.ramp_down_step:
+            V-=self.ramp_down_step
+            await self.a.source_voltage_level(V)
+            await asyncio.sleep(self.ramp_down_wait)
+        await self.a.source_voltage_level(0)
+        await self.a.output_off()
+
+    async def makeIVCurve(self, startV=0, stopV=50, waitT=30, step=5, maxI=1*10**(-6), rangeI=None, samples=1, settle=None):
+        """MakeIVCurve.makeIVCurve (python ramps), returns (rampDown, rampUp)"""
+        await self.a.reset()
+        self.ivc.stepStats=[]
+        self.ivc.dwellTimes=[]
+        try:
+            rampUp=await self.ramp_volt_up(startV=startV, stopV=stopV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI, samples=samples, settle=settle)
+            downStart=float(rampUp[0][-1]) if len(rampUp[0]) else startV
+            rampDown=await self.ramp_volt_down(startV=downStart, stopV=startV, waitT=waitT, step=step, maxI=maxI, rangeI=rangeI, samples=samples, settle=settle)
+        except BaseException:
+            # cancelled, a timed out call or an instrument error: the bias comes down before it propagates
+            try:
+                await asyncio.shield(self.ramp_to_zero())
+            except Exception:
+                try:
+                    await asyncio.shield(self.a.output_off())
+                except Exception:
+                    pass
+            raise
+        await self.a.output_off()
+        return (rampDown,rampUp)
+
+
+async def run_simulated(n, **kwargs):
+    """makeIVCurve on n simulated instruments at once, on one event loop"""
+    servers = [AsyncSourceMeterServer(simulate=SimulatedKeithley2410()) for _ in range(n)]
+    curves = await asyncio.gather(*[AsyncMakeIVCurve(s).makeIVCurve(**kwargs) for s in servers])
+    for s in servers:
+        await s.close()
+    return curves
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IV curves on simulated instruments, all on one asyncio event loop')
+    parser.add_argument('--simulate', type=int, default=2, metavar='N')
+    parser.add_argument('--stop',  type=float, default=20)
+    parser.add_argument('--step',  type=float, default=5)
+    parser.add_argument('--dwell', type=float, default=0.5)
+    args = parser.parse_args(argv)
+    t0 = time.time()
+    asyncio.get_event_loop().run_until_complete(run_simulated(args.simulate, stopV=args.stop, step=args.step, waitT=args.dwell, maxI=1e-3))
+    print("{} instruments in {:.1f} s".format(args.simulate, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,800 @@
+"""
+Simulated Keithley 2410 SourceMeter.
+
+SimulatedKeithley2410 stands in for the pyvisa resource that SourceMeterServer
+normally opens on the RS-232 port. It understands the SCPI subset that
+Keithley2410.py sends, charges a configurable latency for every transfer and
+answers :READ? from a SensorModel, so the acquisition code can be exercised and
+timed without a bench.
+"""
+import time
+import math
+import numpy as np
+
+OVERFLOW_READING = 9.9e37    # returned when a reading overflows a fixed range
+NAN_READING      = 9.91e37   # returned for an element that is not being measured
+
+VOLT_RANGES = (0.21, 2.1, 21.0, 1100.0)
+CURR_RANGES = (1.05e-6, 1.05e-5, 1.05e-4, 1.05e-3, 1.05e-2, 1.05e-1, 1.05)
+
+STATUS_COMPLIANCE = 8        # bit 3 of the status word: in compliance
+OPER_IDLE         = 1024     # bit 10 of the operation condition register: trigger model idle
+
+# :FORM:ELEM elements, in the order every reading sends them whatever order they were listed in
+ELEMENT_ORDER     = ('VOLT', 'CURR', 'RES', 'TIME', 'STAT')
+
+# :FORM:DATA -> bytes per value, binary blocks start with the indefinite-length header #0
+DATA_SIZES        = {'ASC':None, 'SRE':4, 'DRE':8}
+
+LIST_MAX_POINTS   = 100
+SWEEP_MAX_POINTS  = 2500
+TRACE_MAX_POINTS  = 2500
+
+# long form -> short form of every SCPI mnemonic the simulator understands
+SCPI_SHORT = {
+    'SOURCE':'SOUR', 'SENSE':'SENS', 'FUNCTION':'FUNC', 'VOLTAGE':'VOLT',
+    'CURRENT':'CURR', 'RESISTANCE':'RES', 'RANGE':'RANG', 'LEVEL':'LEV',
+    'PROTECTION':'PROT', 'OUTPUT':'OUTP', 'FORMAT':'FORM', 'ELEMENTS':'ELEM',
+    'SYSTEM':'SYST', 'TRIGGER':'TRIG', 'COUNT':'COUN', 'RSENSE':'RSEN',
+    'ERROR':'ERR', 'STATE':'STAT', 'MODE':'MODE', 'DELAY':'DEL', 'SWEEP':'SWE',
+    'START':'STAR', 'POINTS':'POIN', 'SPACING':'SPAC', 'TRACE':'TRAC',
+    'CLEAR':'CLE', 'CONTROL':'CONT', 'INITIATE':'INIT', 'FETCH':'FETC',
+    'ABORT':'ABOR', 'STATUS':'STAT', 'OPERATION':'OPER', 'CONDITION':'COND',
+    'ACTUAL':'ACT', 'RANGING':'RANG', 'BORDER':'BORD', 'AVERAGE':'AVER',
+    'TCONTROL':'TCON',
+    }
+
+# optional nodes that can be left out of a header without changing its meaning
+SCPI_OPTIONAL = ('IMM', 'IMMEDIATE', 'AMPL', 'AMPLITUDE', 'DC', 'STAT', 'STATE', 'NEXT')
+
+
+def _fmt(x):
+    return '{:+.6E}'.format(x)
+
+def _pick_range(ranges, value):
+    """Smallest range that holds value, the way the 2410 rounds a range request up"""
+    for r in ranges:
+        if abs(value) <= r:
+            return r
+    return None
+
+def _on_off(arg):
+    arg = arg.strip().upper()
+    if arg in ('ON', '1'):
+        return True
+    if arg in ('OFF', '0'):
+        return False
+    raise ValueError(arg)
+
+
+
+
+class SensorModel(object):
+    """
+    Leakage current of a reverse-biased silicon sensor.
+
+    The settled current Iss(V) is a bulk term growing as sqrt(V) up to full
+    depletion, an ohmic shunt and an exponential breakdown knee. After every
+    change of the applied voltage the current relaxes towards Iss(V) as
+    A*exp(-(t-t0)/tau), the same form as dev.exponential_fn.
+    """
+
+    def __init__(self, bulk=50e-9, vdep=300.0, rshunt=5e9, vbd=900.0, bdwidth=15.0, ibd=1e-8,
+                 tau=20.0, overshoot=2e-10, noise=1e-10, seed=0):
+        self.bulk      = bulk       # bulk generation current at full depletion (A)
+        self.vdep      = vdep       # full depletion voltage (V)
+        self.rshunt    = rshunt     # surface/shunt resistance (ohm)
+        self.vbd       = vbd        # breakdown knee (V), None for no breakdown
+        self.bdwidth   = bdwidth    # voltage for the breakdown current to grow by e (V)
+        self.ibd       = ibd        # breakdown current at vbd (A)
+        self.tau       = tau        # relaxation time constant (s)
+        self.overshoot = overshoot  # transient amplitude per volt stepped (A/V)
+        self.noise     = noise      # rms reading noise (A)
+        self.rng       = np.random.RandomState(seed)
+
+        self.v   = 0.0
+        self.t0  = 0.0
+        self.amp = 0.0
+
+    def steady_state(self, v):
+        """Settled current at bias v"""
+        av = abs(v)
+        if av == 0:
+            return 0.0
+        i = self.bulk*math.sqrt(min(av, self.vdep)/self.vdep) + av/self.rshunt
+        if self.vbd is not None:
+            i += self.ibd*math.exp(min((av - self.vbd)/self.bdwidth, 50.0))
+        return math.copysign(i, v)
+
+    def _current(self, t):
+        return self.steady_state(self.v) + self.amp*math.exp(-max(t - self.t0, 0.0)/self.tau)
+
+    def step(self, v, t):
+        """Applies bias v at time t, starting a new relaxation from the present current"""
+        if v == self.v:
+            return
+        self.amp = self._current(t) - self.steady_state(v) + self.overshoot*(v - self.v)
+        self.v   = v
+        self.t0  = t
+
+    def current(self, t):
+        """Current drawn at time t, including reading noise"""
+        return self._current(t) + self.rng.normal(0.0, self.noise)
+
+
+
+
+class SimulatedKeithley2410(object):
+    """
+    Drop-in replacement for the pyvisa resource used by SourceMeterServer.
+
+    latency is a fixed turnaround charged to every write and read, baud sets the
+    per-byte cost of the serial link (10 bits per byte) and nplc/line_freq the
+    integration time of each reading. Queries are answered on the next read(),
+    several replies from one write are joined with ';' like the real unit.
+    """
+
+    def __init__(self, model=None, latency=0.0, baud=None, nplc=1.0, line_freq=60.0,
+                 clock=time.time, sleep=time.sleep):
+        self.model     = SensorModel() if model is None else model
+        self.latency   = latency
+        self.baud      = baud
+        self.nplc      = nplc
+        self.line_freq = line_freq
+        self.clock     = clock
+        self.sleep     = sleep
+
+        # traffic counters, read by the benchmarks
+        self.nwrites       = 0
+        self.nreads        = 0
+        self.bytes_written = 0
+        self.bytes_read    = 0
+        self.commands      = 0
+
+        self.outbuf  = bytearray()   # replies waiting to be read, each ended by the read termination
+        self.errors  = []
+        self.isOpen  = True
+        self.reset_state()
+
+    ######################
+    #  Instrument state  #
+    ######################
+    def reset_state(self):
+        """*RST defaults of the settings the simulator models"""
+        self.source_func  = 'VOLT'
+        self.source_level = {'VOLT':0.0, 'CURR':0.0}
+        self.source_range = {'VOLT':21.0, 'CURR':1.05e-4}
+        self.source_auto  = {'VOLT':True, 'CURR':True}   # source autorange, ON after *RST
+        self.sense_funcs  = ['CURR']
+        self.sense_range  = {'VOLT':21.0, 'CURR':1.05e-4}
+        self.sense_auto   = {'VOLT':True, 'CURR':True}
+        self.sense_prot   = {'VOLT':21.0, 'CURR':1.05e-4}
+        self.elements     = list(ELEMENT_ORDER)
+        self.data_type    = 'ASC'
+        self.byte_order   = 'NORM'   # NORM is big-endian, SWAP little-endian
+        self.output       = False
+        self.remote_sense = False
+        self.trig_count   = 1
+        self.aver_on      = False    # averaging filter
+        self.aver_count   = 10
+        self.aver_tcon    = 'REP'
+        self.source_delay = 0.0
+        self.volt_mode    = 'FIX'
+        self.sweep_start  = 0.0
+        self.sweep_stop   = 0.0
+        self.sweep_step   = None     # set by :SOUR:VOLT:STEP, otherwise sweep_points is used
+        self.sweep_points = 2500
+        self.sweep_cab    = 'NEV'
+        self.volt_list    = [0.0]
+        self.sweep_level  = None     # level the last sweep left the output at, until a new bias level is set
+        self.acq          = None     # running trigger model, see _init
+        self.samples      = []       # readings of the last :INIT
+        self.trace        = []
+        self.trace_points = 100
+        self.trace_feed   = 'SENS'
+        self.trace_cont   = 'NEV'
+        self.tstamp0      = self.clock()
+        self.model.step(0.0, self.tstamp0)
+
+    def applied_voltage(self):
+        if self.output and self.source_func == 'VOLT':
+            if self.sweep_level is not None:
+                return self.sweep_level
+            return self.source_level['VOLT']
+        return 0.0
+
+    def _apply(self):
+        self.model.step(self.applied_voltage(), self.clock())
+
+    ######################
+    #  Transport (VISA)  #
+    ######################
+    def _wait(self, nbytes):
+        dt = self.latency
+        if self.baud:
+            dt += nbytes*10.0/self.baud
+        if dt > 0:
+            self.sleep(dt)
+
+    def write(self, data):
+        self.write_raw(data.encode('ascii') + b'\r\n')
+
+    def write_raw(self, data):
+        if not self.isOpen:
+            raise ValueError("Simulated instrument is closed")
+        if isinstance(data, bytes):
+            data = data.decode('ascii')
+        self.nwrites += 1
+        self.bytes_written += len(data)
+        self._wait(len(data))
+        self.process(data.strip())
+
+    def read_bytes(self, count):
+        """Exactly count bytes of the output buffer, termination characters included"""
+        if not self.isOpen:
+            raise ValueError("Simulated instrument is closed")
+        if len(self.outbuf) < count:
+            raise ValueError("Read timed out: no reply queued by the simulated instrument")
+        data = bytes(self.outbuf[:count])
+        del self.outbuf[:count]
+        self.nreads += 1
+        self.bytes_read += count
+        self._wait(count)
+        return data
+
+    def read_raw(self):
+        """Output buffer up to and including the next line feed"""
+        end = self.outbuf.find(b'\n')
+        if end < 0:
+            raise ValueError("Read timed out: no reply queued by the simulated instrument")
+        return self.read_bytes(end + 1)
+
+    def read(self):
+        return self.read_raw().decode('ascii').rstrip('\r\n')
+
+    def query(self, data):
+        self.write(data)
+        return self.read()
+
+    def close(self):
+        self.isOpen = False
+
+    ##################
+    #  SCPI parsing  #
+    ##################
+    def error(self, code, msg):
+        self.errors.append('{},"{}"'.format(code, msg))
+
+    @staticmethod
+    def normalize(header):
+        """Upper-case short-form header with optional nodes removed, e.g. 'SENS:CURR:PROT'"""
+        nodes = [n for n in header.upper().lstrip(':*').split(':') if n]
+        nodes = [SCPI_SHORT.get(n, n) for n in nodes]
+        keep = nodes[:1] + [n for n in nodes[1:] if n not in SCPI_OPTIONAL]
+        return ':'.join(keep)
+
+    def process(self, data):
+        """Executes one line of ';'-separated commands and queues the joined replies"""
+        replies = []
+        for cmd in data.split(';'):
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            self.commands += 1
+            header, _, arg = cmd.partition(' ')
+            query = header.endswith('?')
+            key = ('*' if header.startswith('*') else '') + self.normalize(header.rstrip('?'))
+            handler = self.HANDLERS.get(key)
+            if handler is None:
+                self.error(-113, "Undefined header")
+                continue
+            try:
+                ans = getattr(self, handler)(arg.strip(), query)
+            except ValueError:
+                self.error(-104, "Data type error")
+                continue
+            if query and ans is not None:
+                replies.append(ans if isinstance(ans, bytes) else ans.encode('ascii'))
+        if replies:
+            self.outbuf += b';'.join(replies) + b'\r\n'
+
+    ##############
+    #  Handlers  #
+    ##############
+    def _rst(self, arg, query):
+        self.reset_state()
+
+    def _cls(self, arg, query):
+        self.errors = []
+
+    def _idn(self, arg, query):
+        return 'KEITHLEY INSTRUMENTS INC.,MODEL 2410,SIMULATED,C00'
+
+    def _syst_err(self, arg, query):
+        return self.errors.pop(0) if self.errors else '0,"No error"'
+
+    def _syst_rsen(self, arg, query):
+        if query:
+            return '1' if self.remote_sense else '0'
+        self.remote_sense = _on_off(arg)
+
+    def _sour_func(self, arg, query):
+        if query:
+            return self.source_func
+        func = self.normalize(arg)
+        if func not in ('VOLT', 'CURR'):
+            raise ValueError(arg)
+        self.source_func = func
+        self._apply()
+
+    def _sour_rang(self, func, arg, query):
+        if query:
+            return _fmt(self.source_range[func])
+        r = _pick_range(VOLT_RANGES if func == 'VOLT' else CURR_RANGES, float(arg))
+        if r is None:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.source_range[func] = r
+        self.source_auto[func]  = False   # a fixed range turns source autorange off, as on the 2410
+
+    def _sour_rang_auto(self, func, arg, query):
+        if query:
+            return '1' if self.source_auto[func] else '0'
+        self.source_auto[func] = _on_off(arg)
+        if self.source_auto[func]:
+            self.source_range[func] = _pick_range(VOLT_RANGES if func == 'VOLT' else CURR_RANGES, self.source_level[func])
+
+    def _sour_lev(self, func, arg, query):
+        if query:
+            return _fmt(self.source_level[func])
+        level = float(arg)
+        if self.source_auto[func]:
+            r = _pick_range(VOLT_RANGES if func == 'VOLT' else CURR_RANGES, level)
+            if r is None:
+                self.error(-222, "Parameter data out of range")
+                return
+            self.source_range[func] = r   # autorange follows the level, up and down
+        elif abs(level) > self.source_range[func]:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.source_level[func] = level
+        self.sweep_level = None
+        self._apply()
+
+    def _sour_volt_rang(self, arg, query):
+        return self._sour_rang('VOLT', arg, query)
+
+    def _sour_curr_rang(self, arg, query):
+        return self._sour_rang('CURR', arg, query)
+
+    def _sour_volt_rang_auto(self, arg, query):
+        return self._sour_rang_auto('VOLT', arg, query)
+
+    def _sour_curr_rang_auto(self, arg, query):
+        return self._sour_rang_auto('CURR', arg, query)
+
+    def _sour_volt_lev(self, arg, query):
+        return self._sour_lev('VOLT', arg, query)
+
+    def _sour_curr_lev(self, arg, query):
+        return self._sour_lev('CURR', arg, query)
+
+    def _outp(self, arg, query):
+        if query:
+            return '1' if self.output else '0'
+        self.output = _on_off(arg)
+        self._apply()
+
+    def _sense_list(self, funcs):
+        if not funcs:
+            return '""'
+        return ','.join('"{}:DC"'.format(f) if f != 'RES' else '"RES"' for f in funcs)
+
+    def _parse_funcs(self, arg):
+        funcs = []
+        for f in arg.split(','):
+            f = self.normalize(f.strip().strip('\'"'))
+            if f not in ('VOLT', 'CURR', 'RES'):
+                raise ValueError(arg)
+            funcs.append(f)
+        return funcs
+
+    def _sens_func_on(self, arg, query):
+        if query:
+            return self._sense_list(self.sense_funcs)
+        for f in self._parse_funcs(arg):
+            if f not in self.sense_funcs:
+                self.sense_funcs.append(f)
+
+    def _sens_func_off(self, arg, query):
+        if query:
+            return self._sense_list([f for f in ('VOLT', 'CURR', 'RES') if f not in self.sense_funcs])
+        for f in self._parse_funcs(arg):
+            if f in self.sense_funcs:
+                self.sense_funcs.remove(f)
+
+    def _sens_func_on_all(self, arg, query):
+        self.sense_funcs = ['VOLT', 'CURR', 'RES']
+
+    def _sens_func_off_all(self, arg, query):
+        self.sense_funcs = []
+
+    def _sens_rang(self, func, arg, query):
+        if query:
+            return _fmt(self.sense_range[func])
+        r = _pick_range(VOLT_RANGES if func == 'VOLT' else CURR_RANGES, float(arg))
+        if r is None:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.sense_range[func] = r
+        self.sense_auto[func]  = False
+
+    def _sens_rang_auto(self, func, arg, query):
+        if query:
+            return '1' if self.sense_auto[func] else '0'
+        self.sense_auto[func] = _on_off(arg)
+
+    def _sens_prot(self, func, arg, query):
+        if query:
+            return _fmt(self.sense_prot[func])
+        self.sense_prot[func] = abs(float(arg))
+
+    def _sens_curr_rang(self, arg, query):
+        return self._sens_rang('CURR', arg, query)
+
+    def _sens_volt_rang(self, arg, query):
+        return self._sens_rang('VOLT', arg, query)
+
+    def _sens_curr_rang_auto(self, arg, query):
+        return self._sens_rang_auto('CURR', arg, query)
+
+    def _sens_volt_rang_auto(self, arg, query):
+        return self._sens_rang_auto('VOLT', arg, query)
+
+    def _sens_curr_prot(self, arg, query):
+        return self._sens_prot('CURR', arg, query)
+
+    def _sens_volt_prot(self, arg, query):
+        return self._sens_prot('VOLT', arg, query)
+
+    def _form_elem(self, arg, query):
+        if query:
+            return ','.join(self.elements)
+        elements = [self.normalize(e.strip()) for e in arg.split(',')]
+        for e in elements:
+            if e not in ELEMENT_ORDER:
+                raise ValueError(arg)
+        self.elements = [e for e in ELEMENT_ORDER if e in elements]
+
+    def _form_data(self, arg, query):
+        if query:
+            return self.data_type
+        data_type = self.normalize(arg.partition(',')[0])[:3]
+        if data_type not in DATA_SIZES:
+            raise ValueError(arg)
+        self.data_type = data_type
+
+    def _form_bord(self, arg, query):
+        if query:
+            return self.byte_order
+        order = self.normalize(arg)[:4]
+        if order not in ('NORM', 'SWAP'):
+            raise ValueError(arg)
+        self.byte_order = order
+
+    def _sens_aver(self, arg, query):
+        if query:
+            return '1' if self.aver_on else '0'
+        self.aver_on = _on_off(arg)
+
+    def _sens_aver_coun(self, arg, query):
+        if query:
+            return _fmt(self.aver_count)
+        count = int(float(arg))
+        if not 1 <= count <= 100:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.aver_count = count
+
+    def _sens_aver_tcon(self, arg, query):
+        if query:
+            return self.aver_tcon
+        tcon = self.normalize(arg)[:3]
+        if tcon not in ('REP', 'MOV'):
+            raise ValueError(arg)
+        self.aver_tcon = tcon
+
+    def _trig_coun(self, arg, query):
+        if query:
+            return _fmt(self.trig_count)
+        self.trig_count = int(float(arg))
+
+    def _sour_volt_mode(self, arg, query):
+        if query:
+            return self.volt_mode
+        mode = self.normalize(arg)
+        if mode not in ('FIX', 'SWE', 'LIST'):
+            raise ValueError(arg)
+        self.volt_mode   = mode
+        self.sweep_level = None
+        self._apply()
+
+    def _sour_volt_star(self, arg, query):
+        if query:
+            return _fmt(self.sweep_start)
+        self.sweep_start = float(arg)
+
+    def _sour_volt_stop(self, arg, query):
+        if query:
+            return _fmt(self.sweep_stop)
+        self.sweep_stop = float(arg)
+
+    def _sour_volt_step(self, arg, query):
+        if query:
+            return _fmt(self.sweep_step or 0.0)
+        self.sweep_step = abs(float(arg))
+
+    def _sour_swe_poin(self, arg, query):
+        if query:
+            return str(self.sweep_levels().shape[0])
+        points = int(float(arg))
+        if not 1 <= points <= SWEEP_MAX_POINTS:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.sweep_points = points
+        self.sweep_step   = None
+
+    def _sour_swe_cab(self, arg, query):
+        if query:
+            return self.sweep_cab
+        cab = self.normalize(arg)[:4]
+        if cab not in ('NEV', 'EARL', 'LATE'):
+            raise ValueError(arg)
+        self.sweep_cab = cab
+
+    def _ignore(self, arg, query):
+        # accepted settings the simulator doesn't model (:SOUR:SWE:RANG, :SOUR:SWE:SPAC)
+        return None
+
+    def _sour_list_volt(self, arg, query):
+        if query:
+            return ','.join(_fmt(v) for v in self.volt_list)
+        levels = [float(v) for v in arg.split(',')]
+        if not 1 <= len(levels) <= LIST_MAX_POINTS:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.volt_list = levels
+
+    def _sour_del(self, arg, query):
+        if query:
+            return _fmt(self.source_delay)
+        self.source_delay = float(arg)
+
+    def _trac_cle(self, arg, query):
+        self.trace = []
+
+    def _trac_poin(self, arg, query):
+        if query:
+            return str(self.trace_points)
+        points = int(float(arg))
+        if not 1 <= points <= TRACE_MAX_POINTS:
+            self.error(-222, "Parameter data out of range")
+            return
+        self.trace_points = points
+
+    def _trac_poin_act(self, arg, query):
+        self._advance(self.clock())
+        return str(len(self.trace))
+
+    def _trac_feed(self, arg, query):
+        if query:
+            return self.trace_feed
+        self.trace_feed = self.normalize(arg.strip('\'"'))
+
+    def _trac_feed_cont(self, arg, query):
+        if query:
+            return self.trace_cont
+        self.trace_cont = self.normalize(arg)[:4]
+
+    def _trac_data(self, arg, query):
+        self._finish()
+        return self.format_readings(self.trace)
+
+    def _init(self, arg, query):
+        """Starts the trigger model: trig_count source-delay-measure cycles, stepping through
+        the sweep or list levels when the voltage source isn't in FIX mode"""
+        if not self.output:
+            self.error(803, "Output disabled")
+            return None
+        levels = None
+        if self.source_func == 'VOLT' and self.volt_mode != 'FIX':
+            levels = self.sweep_levels()
+            levels = np.resize(levels, max(self.trig_count, 1))
+        self.samples = []
+        self.acq = {'levels':levels, 'k':0, 'n':self.trig_count, 't':self.clock()}
+
+    def _abor(self, arg, query):
+        self._advance(self.clock())
+        self.acq = None
+
+    def _fetc(self, arg, query):
+        self._finish()
+        return self.format_readings(self.samples)
+
+    def _read(self, arg, query):
+        if not self.output:
+            self.error(803, "Output disabled")
+            return None
+        self._init(arg, query)
+        return self._fetc(arg, query)
+
+    def _stat_oper_cond(self, arg, query):
+        self._advance(self.clock())
+        return str(OPER_IDLE if self.acq is None else 0)
+
+    def _opc(self, arg, query):
+        self._finish()
+        return '1' if query else None
+
+    HANDLERS = {
+        '*RST'               : '_rst',
+        '*CLS'               : '_cls',
+        '*IDN'               : '_idn',
+        '*OPC'               : '_opc',
+        'SYST:ERR'           : '_syst_err',
+        'SYST:RSEN'          : '_syst_rsen',
+        'SOUR:FUNC'          : '_sour_func',
+        'SOUR:FUNC:MODE'     : '_sour_func',
+        'SOUR:VOLT'          : '_sour_volt_lev',
+        'SOUR:VOLT:LEV'      : '_sour_volt_lev',
+        'SOUR:VOLT:RANG'     : '_sour_volt_rang',
+        'SOUR:VOLT:RANG:AUTO': '_sour_volt_rang_auto',
+        'SOUR:CURR'          : '_sour_curr_lev',
+        'SOUR:CURR:LEV'      : '_sour_curr_lev',
+        'SOUR:CURR:RANG'     : '_sour_curr_rang',
+        'SOUR:CURR:RANG:AUTO': '_sour_curr_rang_auto',
+        'OUTP'               : '_outp',
+        'SENS:FUNC'          : '_sens_func_on',
+        'SENS:FUNC:ON'       : '_sens_func_on',
+        'SENS:FUNC:OFF'      : '_sens_func_off',
+        'SENS:FUNC:ON:ALL'   : '_sens_func_on_all',
+        'SENS:FUNC:OFF:ALL'  : '_sens_func_off_all',
+        'SENS:CURR:RANG'     : '_sens_curr_rang',
+        'SENS:CURR:RANG:AUTO': '_sens_curr_rang_auto',
+        'SENS:CURR:PROT'     : '_sens_curr_prot',
+        'SENS:CURR:PROT:LEV' : '_sens_curr_prot',
+        'SENS:VOLT:RANG'     : '_sens_volt_rang',
+        'SENS:VOLT:RANG:AUTO': '_sens_volt_rang_auto',
+        'SENS:VOLT:PROT'     : '_sens_volt_prot',
+        'SENS:VOLT:PROT:LEV' : '_sens_volt_prot',
+        'FORM:ELEM'          : '_form_elem',
+        'FORM:DATA'          : '_form_data',
+        'FORM:BORD'          : '_form_bord',
+        'TRIG:COUN'          : '_trig_coun',
+        'SENS:AVER'          : '_sens_aver',
+        'SENS:AVER:COUN'     : '_sens_aver_coun',
+        'SENS:AVER:TCON'     : '_sens_aver_tcon',
+        'SOUR:VOLT:MODE'     : '_sour_volt_mode',
+        'SOUR:VOLT:STAR'     : '_sour_volt_star',
+        'SOUR:VOLT:STOP'     : '_sour_volt_stop',
+        'SOUR:VOLT:STEP'     : '_sour_volt_step',
+        'SOUR:SWE:POIN'      : '_sour_swe_poin',
+        'SOUR:SWE:CAB'       : '_sour_swe_cab',
+        'SOUR:SWE:RANG'      : '_ignore',
+        'SOUR:SWE:SPAC'      : '_ignore',
+        'SOUR:LIST:VOLT'     : '_sour_list_volt',
+        'SOUR:DEL'           : '_sour_del',
+        'TRAC:CLE'           : '_trac_cle',
+        'TRAC:POIN'          : '_trac_poin',
+        'TRAC:POIN:ACT'      : '_trac_poin_act',
+        'TRAC:FEED'          : '_trac_feed',
+        'TRAC:FEED:CONT'     : '_trac_feed_cont',
+        'TRAC:DATA'          : '_trac_data',
+        'INIT'               : '_init',
+        'ABOR'               : '_abor',
+        'FETC'               : '_fetc',
+        'READ'               : '_read',
+        'STAT:OPER:COND'     : '_stat_oper_cond',
+        }
+
+    ##############
+    #  Readings  #
+    ##############
+    def reading_time(self):
+        """Time per reading, a repeat filter integrates aver_count conversions for each one"""
+        dt = self.nplc/self.line_freq
+        if self.aver_on and self.aver_tcon == 'REP':
+            dt *= self.aver_count
+        return dt
+
+    def sweep_levels(self):
+        """Source levels of one pass through the staircase sweep or the list"""
+        if self.volt_mode == 'LIST':
+            return np.array(self.volt_list)
+        points = self.sweep_points
+        if self.sweep_step:
+            points = int(round(abs(self.sweep_stop - self.sweep_start)/self.sweep_step)) + 1
+        return np.linspace(self.sweep_start, self.sweep_stop, min(points, SWEEP_MAX_POINTS))
+
+    def format_readings(self, readings):
+        """Reply to :READ?/:FETC?/:TRAC:DATA? in the :FORM:DATA format"""
+        if self.data_type == 'ASC':
+            return ','.join(','.join(_fmt(x) for x in r) for r in readings)
+        dtype = '{}f{}'.format('>' if self.byte_order == 'NORM' else '<', DATA_SIZES[self.data_type])
+        return b'#0' + np.array(readings, dtype=dtype).tobytes()
+
+    def _store(self, values):
+        self.samples.append(values)
+        if self.trace_feed == 'SENS' and self.trace_cont == 'NEXT':
+            self.trace.append(values)
+            if len(self.trace) >= self.trace_points:
+                self.trace_cont = 'NEV'
+
+    def _advance(self, now):
+        """Runs the trigger model up to time now, one source-delay-measure cycle at a time"""
+        acq = self.acq
+        while acq is not None:
+            if acq['k'] >= acq['n']:
+                self.acq = None
+                break
+            tmeas = acq['t'] + self.source_delay + self.reading_time()
+            if tmeas > now:
+                break
+            if acq['levels'] is not None:
+                self.sweep_level = float(acq['levels'][acq['k']])
+                self.model.step(self.applied_voltage(), acq['t'])
+            values, status = self.reading(tmeas)
+            self._store(values)
+            acq['t'] = tmeas
+            acq['k'] += 1
+            if status & STATUS_COMPLIANCE and acq['levels'] is not None and self.sweep_cab != 'NEV':
+                self.acq = None
+                break
+
+    def _finish(self):
+        """Blocks until the trigger model is idle, the way a query waits behind a running sweep"""
+        if self.acq is None:
+            return
+        acq = self.acq
+        self._advance(float('inf'))
+        dt = acq['t'] - self.clock()
+        if dt > 0:
+            self.sleep(dt)
+
+    def take_reading(self):
+        """One reading as the list of values selected by :FORM:ELEM"""
+        dt = self.reading_time()
+        if dt > 0:
+            self.sleep(dt)
+        return self.reading(self.clock())[0]
+
+    def reading(self, t):
+        """Reading taken at time t, returns (values selected by :FORM:ELEM, status word)"""
+        status = 0
+        if self.source_func == 'VOLT':
+            v = self.applied_voltage()
+            if self.aver_on:
+                i = sum(self.model.current(t) for _ in range(self.aver_count))/self.aver_count
+            else:
+                i = self.model.current(t)
+            limit = self.sense_prot['CURR']
+            if abs(i) > limit:
+                i = math.copysign(limit, i)
+                status |= STATUS_COMPLIANCE
+            if not self.sense_auto['CURR'] and abs(i) > self.sense_range['CURR']:
+                i = OVERFLOW_READING
+        else:
+            i = self.source_level['CURR'] if self.output else 0.0
+            v = min(abs(i)*self.model.rshunt, self.sense_prot['VOLT'])
+            if v == self.sense_prot['VOLT']:
+                status |= STATUS_COMPLIANCE
+            v = math.copysign(v, i)
+
+        values = {
+            'VOLT': v if 'VOLT' in self.sense_funcs or self.source_func == 'VOLT' else NAN_READING,
+            'CURR': i if 'CURR' in self.sense_funcs or self.source_func == 'CURR' else NAN_READING,
+            'RES' : (v/i if i else NAN_READING) if 'RES' in self.sense_funcs else NAN_READING,
+            'TIME': t - self.tstamp0,
+            'STAT': float(status),
+            }
+        return [values[e] for e in self.elements], status
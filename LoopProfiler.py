@@ -0,0 +1,167 @@
+"""
+Where the time goes in TestStandUI's loops.
+
+A LoopProfiler times named phases (with profiler.phase('refreshPlots'): ...) from any thread and
+compares intervals that should be regular with what they were asked to be (profiler.interval(
+'measurement', requested, actual)): jitter is the spread of actual-requested, drift their sum, i.e.
+how far behind the requested schedule the loop has fallen since it started, and missed(name, n)
+counts deadlines a scheduler had to skip (see DeadlineScheduler). window() gives the
+share of wall time each phase took since the last call, for a live readout; summary() the whole
+run. With a trace file every phase is also written as it ends, in the Chrome trace event format
+(open it in chrome://tracing or https://ui.perfetto.dev), one thread per row.
+
+    profiler = LoopProfiler(trace='data/trace.json')
+    with profiler.phase('doMeasurement'):
+        ...
+    print(profiler.summary())
+    profiler.close()
+"""
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+
+class PhaseStats(object):
+    __slots__ = ('count', 'total', 'max', 'window')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.window = 0.0 # seconds since the last LoopProfiler.window()
+
+
+class IntervalStats(object):
+    __slots__ = ('count', 'requested', 'actual', 'error', 'error2', 'worst', 'window', 'window_actual')
+
+    def __init__(self):
+        self.count = 0
+        self.requested = 0.0
+        self.actual = 0.0
+        self.error = 0.0   # sum of actual-requested, the drift
+        self.error2 = 0.0
+        self.worst = 0.0
+        self.window = 0
+        self.window_actual = 0.0
+
+    def jitter(self):
+        if self.count < 2:
+            return 0.0
+        mean = self.error/self.count
+        return math.sqrt(max(self.error2/self.count - mean*mean, 0.0))
+
+
+class LoopProfiler(object):
+
+    def __init__(self, trace=None, clock=time.perf_counter):
+        """trace: path of a Chrome trace event file to write every phase to, None for none"""
+        self.clock = clock
+        self.phases = {}     # name -> PhaseStats
+        self.intervals = {}  # name -> IntervalStats
+        self.misses = {} # name -> deadlines skipped
+        self.started = self._window_started = clock()
+        self._lock = threading.Lock()
+        self._trace = None
+        if trace is not None:
+            directory = os.path.dirname(trace)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._trace = open(trace, 'w', buffering=1 << 16)
+            self._trace.write('[\n') # the closing ] is optional in this format, a crashed run's trace still loads
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, t0, self.clock())
+
+    def add(self, name, t0, t1):
+        dt = t1 - t0
+        with self._lock:
+            p = self.phases.get(name)
+            if p is None:
+                p = self.phases[name] = PhaseStats()
+            p.count += 1
+            p.total += dt
+            p.window += dt
+            p.max = max(p.max, dt)
+            if self._trace is not None:
+                self._trace.write('{{"name":{},"ph":"X","pid":0,"tid":{},"ts":{:.1f},"dur":{:.1f}}},\n'.format(
+                    json.dumps(name), json.dumps(threading.current_thread().name), 1e6*(t0 - self.started), 1e6*dt))
+
+    def interval(self, name, requested, actual):
+        """An interval that was asked to last requested seconds and lasted actual"""
+        error = actual - requested
+        with self._lock:
+            i = self.intervals.get(name)
+            if i is None:
+                i = self.intervals[name] = IntervalStats()
+            i.count += 1
+            i.requested += requested
+            i.actual += actual
+            i.error += error
+            i.error2 += error*error
+            i.worst = max(i.worst, abs(error))
+            i.window += 1
+            i.window_actual += actual
+
+    def missed(self, name, n=1):
+        """n deadlines of name passed before the loop could run them"""
+        with self._lock:
+            self.misses[name] = self.misses.get(name, 0) + n
+
+    def window(self):
+        """Share of the wall time each phase took, and the mean of each interval, since the last call:
+        ({phase: fraction}, {interval: mean seconds}, wall seconds)"""
+        with self._lock:
+            now = self.clock()
+            wall = now - self._window_started
+            self._window_started = now
+            busy = {}
+            for name, p in self.phases.items():
+                busy[name] = p.window/wall if wall > 0 else 0.0
+                p.window = 0.0
+            means = {}
+            for name, i in self.intervals.items():
+                if i.window:
+                    means[name] = i.window_actual/i.window
+                i.window = 0
+                i.window_actual = 0.0
+        return busy, means, wall
+
+    def readout(self):
+        """One line for the window: busy % per phase and actual intervals, since the last readout"""
+        busy, means, wall = self.window()
+        text = '  '.join('{} {:.1f}%'.format(name, 100*fraction) for name, fraction in sorted(busy.items()))
+        for name, mean in sorted(means.items()):
+            i = self.intervals[name]
+            text += '  {} {:.3f} s (drift {:+.2f} s, jitter {:.1f} ms)'.format(name, mean, i.error, 1e3*i.jitter())
+        for name, n in sorted(self.misses.items()):
+            text += '  {} missed {}'.format(name, n)
+        return text
+
+    def summary(self):
+        wall = self.clock() - self.started
+        lines = ["{:.1f} s profiled".format(wall),
+                 "{:>9} {:>7} {:>7} {:>9} {:>9}  {}".format('total s', '% wall', 'count', 'mean ms', 'max ms', 'phase')]
+        for name, p in sorted(self.phases.items(), key=lambda item: -item[1].total):
+            lines.append("{:9.3f} {:7.2f} {:7d} {:9.3f} {:9.3f}  {}".format(
+                p.total, 100*p.total/wall if wall else 0.0, p.count, 1e3*p.total/p.count, 1e3*p.max, name))
+        for name, i in sorted(self.intervals.items()):
+            lines.append("{}: {} intervals, requested {:.3f} s, actual {:.3f} s mean, jitter {:.1f} ms, worst {:.1f} ms, drift {:+.3f} s".format(
+                name, i.count, i.requested/i.count, i.actual/i.count, 1e3*i.jitter(), 1e3*i.worst, i.error))
+        for name, n in sorted(self.misses.items()):
+            lines.append("{}: {} deadlines missed".format(name, n))
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.write('{"name":"end","ph":"i","pid":0,"tid":"end","ts":%.1f}\n]\n' % (1e6*(self.clock() - self.started)))
+                self._trace.close()
+                self._trace = None
@@ -6,9 +6,18 @@ from interface.mainWindow import Ui_MainWindow
 import sys
 import os
 import time
+import math
+import threading
 import numpy
+try:
+        import queue
+except ImportError:   # python 2
+        import Queue as queue
 
-from Keithley2410 import SourceMeterServer
+from Keithley2410 import SourceMeterServer, SettleDetector, reading_stats
+from IVData import IVBuffer, IVLog, MinMaxDecimator, minmax_indices
+from LoopProfiler import LoopProfiler
+from DeadlineScheduler import DeadlineScheduler
 
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg    as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
@@ -20,14 +29,21 @@ VOLTSTOP = 800             # Bias voltage stop point, max value reached
 TIMESTEP = 1               # Interval in seconds between voltage steps
 
 # Other globals
-TIMERINTERVAL     = 50     # Interval in milliseconds between timer_event calls while the UI is running
 DISPLAY_PRECISION = 6      # Number of decimal points to use on displays
 
 MAX_CURRENT = 1.0e-3
 
-KEITHLEY_COM = 6
+SAMPLES_PER_MEASUREMENT = 1   # readings per measurement taken on one trigger, >1 also logs mean/std/min/max
+AVERAGE_FILTER          = 0   # Keithley averaging filter count (1-100) applied to every reading, 0 for off
 
-MEAS_ACTUAL_MODIFIER = 0.8
+SETTLE_TOLERANCE = None    # relative drift still expected at which auto-step moves on before sbAutoStepInterval is up, None always waits the full interval
+SETTLE_MIN_DWELL = 2.0     # seconds auto-step waits at a voltage at least, when SETTLE_TOLERANCE is set
+
+KEITHLEY_COM = 13        # COM port number (or VISA resource) of the Keithley; SourceMeterServer used to open COM13 whatever this said
+SIMULATE     = False   # True runs against Keithley2410Sim instead of the instrument on KEITHLEY_COM
+BUS_TIMING   = False   # True times every command on the serial link, saved as data/IVbus_<time>.json/.csv at exit
+PROFILE_TRACE = False  # True writes every timed phase of the GUI and acquisition loops to data/IVtrace_<time>.json (chrome://tracing)
+PROFILE_READOUT_INTERVAL = 1.0   # seconds between updates of the loop timing readout in the status bar
 
 t = time.localtime()
 
@@ -36,48 +52,74 @@ f = "IVdata_{y}-{m}-{d}_{h}-{n}-{s}.txt".format(y=t[0],m=t[1],d=t[2],h=t[3],n=t[
 dpath = ""
 
 class ivServer(object):
-        def __init__(self,port):
-                self.s = SourceMeterServer(port)
+        def __init__(self,port,simulate=False,average=0):
+                self.s = SourceMeterServer(port,simulate=simulate)
                 #self.s.reset()
-                self.s.sense_off_all()
-                self.s.sense_on("CURR")
-                self.s.sense_on("VOLT")                                                                                                                                                                                                                                                                                                                                                                 
-                self.s.sense_current_prot(1.05e-3); print('I cpl',self.s.sense_current_prot())
-                self.s.sense_current_range(1.05e-3); print('I rng',self.s.sense_current_range())
-                self.s.source_mode('v')
-                self.s.output_on()
-                
-                self.source_voltage_range = None
-                self.set_source_voltage_range(21); print('v',self.s.source_voltage_range())
+                with self.s.batch() as b:   # whole setup and its readback in one transfer
+                        self.s.sense_off_all()
+                        self.s.sense_on("CURR")
+                        self.s.sense_on("VOLT")
+                        self.s.sense_current_prot(1.05e-3)
+                        self.s.sense_current_range(1.05e-3)
+                        self.s.source_mode('v')
+                        self.s.output_on()
+                        self.s.source_voltage_range(21)
+                        self.s.sense_average(average)
+                        b.query(":SENS:CURR:PROT?")
+                        b.query(":SENS:CURR:RANG?")
+                        b.query(":SOUR:VOLT:RANG?",float)
+                print('I cpl',b.results[0])
+                print('I rng',b.results[1])
+
+                self.source_voltage_range = b.results[2]
+                print("SOURCE_VOLTAGE_RANGE \t\tFirst range set to "+str(self.source_voltage_range)); print('v',self.source_voltage_range)
                 
-        def set_source_voltage_range(self,setto):
+        def set_source_voltage_range(self,setto,level=None):
+                """Sets the source range, and the level if given, in one transfer"""
+                if setto == self.source_voltage_range:
+                        if level is not None:
+                                self.s.source_voltage_level(level)
+                        return
+                with self.s.batch() as b:
+                        if level is not None and self.source_voltage_range is not None and setto < self.source_voltage_range:
+                                self.s.source_voltage_level(level)   # come down inside the smaller range before switching to it
+                                self.s.source_voltage_range(setto)
+                        else:
+                                self.s.source_voltage_range(setto)
+                                if level is not None:
+                                        self.s.source_voltage_level(level)
+                        b.query(":SOUR:VOLT:RANG?",float)
                 if self.source_voltage_range is None:
-                        self.s.source_voltage_range(setto)
-                        self.source_voltage_range = self.s.source_voltage_range()
-                        print("SOURCE_VOLTAGE_RANGE \t\tFirst range set to "+str(self.source_voltage_range))
-                elif setto != self.source_voltage_range:
-                        self.s.source_voltage_range(setto)
-                        self.source_voltage_range = self.s.source_voltage_range()
-                        print("SOURCE_VOLTAGE_RANGE \t\tSet range to "+str(self.source_voltage_range))
+                        print("SOURCE_VOLTAGE_RANGE \t\tFirst range set to "+str(b.result))
+                else:
+                        print("SOURCE_VOLTAGE_RANGE \t\tSet range to "+str(b.result))
+                self.source_voltage_range = b.result
                         
         def meas(self):
-                self.s.meas()
-                v,a=self.s.read().replace(',','\n').splitlines()[:2]
-                return float(v),float(a)
+                r=self.s.meas_samples(1)[0]
+                return float(r['VOLT']),float(r['CURR'])
+        def meas_stats(self,n):   #n readings on one trigger, returns mean V, mean I and the reading_stats record
+                stats=reading_stats(self.s.meas_samples(n),('VOLT','CURR'))
+                return float(stats['VOLT_mean']),float(stats['CURR_mean']),stats
         def setv(self,v):
                 if v>21:
-                        self.set_source_voltage_range(1100)
+                        self.set_source_voltage_range(1100,level=v)
                 else:
-                        self.set_source_voltage_range(21)
-
+                        self.set_source_voltage_range(21,level=v)
 
+                # answered from SourceMeterServer's shadow registers, no serial traffic
                 print('v range',self.s.source_voltage_range())
-                
-                        
-                self.s.source_voltage_level(v)
-
                 print('I cpl',self.s.sense_current_prot())
                 print('I rng',self.s.sense_current_range())
+
+        def set_compliance(self,current):   #compliance and current range on the open connection, one transfer
+                with self.s.batch() as b:
+                        self.s.sense_current_prot(current)
+                        self.s.sense_current_range(current)
+                        b.query(":SENS:CURR:PROT?")
+                        b.query(":SENS:CURR:RANG?")
+                print('I cpl',b.results[0])
+                print('I rng',b.results[1])
                 
         def close(self):   #steps voltage down to 0 and turns output off before closing connection
                 V,I = self.meas()
@@ -98,16 +140,321 @@ def checkv(voltage):
 
 ran = lambda:random.random() - 0.5
 
+class livePlot(object):
+        """One persistent line on a matplotlib canvas, updated with set_data and blitted over a cached
+        background, so a refresh costs the same however many points there are. The full canvas draw
+        (axes, ticks) only happens when the data leaves the limits last set here; those are padded
+        with headroom so a growing axis doesn't force a full draw on every refresh. Zoom/pan from the
+        NavigationToolbar redraws the canvas, which re-caches the background; a zoom is kept until
+        new data falls outside the last autoscaled limits.
+        Only a min/max decimation of the points is handed to matplotlib, about two per horizontal
+        pixel: the full range is decimated incrementally as points arrive, a zoomed/panned view is
+        re-decimated from the visible points once, when the toolbar redraws"""
+        MARGIN   = 0.05   # fraction of the data span left around the points
+        HEADROOM = 0.25   # extra fraction of the span left for the data to grow into
+
+        def __init__(self,canvas,ax,style='ro'):
+                self.canvas = canvas
+                self.ax     = ax
+                self.line,  = ax.plot([],[],style,animated=True)
+                self.background = None
+                self.bounds = None   # data bounds (xmin,xmax,ymin,ymax) of the points seen since reset
+                self.limits = None   # limits last set by rescale()
+                self.seen   = 0
+                self.start  = None
+                self.x = self.y = numpy.empty(0)
+                self.decimator = MinMaxDecimator(self.pixels())
+                self.zoomed = None   # indices shown while the view is not the autoscaled one
+                canvas.mpl_connect('draw_event',self.on_draw)
+
+        def pixels(self):
+                try:
+                        return max(int(self.ax.bbox.width),100)
+                except (AttributeError,TypeError):
+                        return 1000
+
+        def view(self):
+                return tuple(self.ax.get_xlim())+tuple(self.ax.get_ylim())
+
+        def on_draw(self,event):
+                self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+                if self.limits is not None and not numpy.allclose(self.view(),self.limits):
+                        self.zoom()
+                elif self.zoomed is not None:
+                        self.zoomed = None
+                        self.show(self.decimator.indices(self.y))
+                self.ax.draw_artist(self.line)
+
+        def zoom(self):
+                """Re-decimates the points inside the current view, for when the toolbar zoomed or panned"""
+                x0,x1,y0,y1 = self.view()
+                inview = numpy.nonzero((self.x >= min(x0,x1)) & (self.x <= max(x0,x1)) & (self.y >= min(y0,y1)) & (self.y <= max(y0,y1)))[0]
+                self.zoomed = inview[minmax_indices(self.y[inview],self.pixels())]
+                self.zoomSeen = len(self.x)
+                self.show(self.zoomed)
+
+        def show(self,idx):
+                self.line.set_data(self.x[idx],self.y[idx])
+
+        def update(self,x,y,start=0):
+                """x,y: the points to show, start: where x[0] sits in the data store (a new start resets the scaling)"""
+                if start != self.start or len(x) < self.seen:
+                        self.start = start; self.seen = 0; self.bounds = None
+                        self.decimator.reset(); self.zoomed = None
+                self.x,self.y = x,y
+                if self.zoomed is None:
+                        self.show(self.decimator.indices(y))
+                else:   # new points inside the zoomed view are few, show them as they are
+                        self.zoomed = numpy.concatenate([self.zoomed,numpy.arange(self.zoomSeen,len(x))])
+                        self.zoomSeen = len(x)
+                        self.show(self.zoomed)
+                if len(x) > self.seen:
+                        new = (numpy.min(x[self.seen:]),numpy.max(x[self.seen:]),numpy.min(y[self.seen:]),numpy.max(y[self.seen:]))
+                        if self.bounds is None:
+                                self.bounds = new
+                        else:
+                                self.bounds = (min(self.bounds[0],new[0]),max(self.bounds[1],new[1]),min(self.bounds[2],new[2]),max(self.bounds[3],new[3]))
+                        self.seen = len(x)
+                if self.bounds is not None and not self.inside(self.bounds):
+                        self.rescale()
+                        self.canvas.draw()   # on_draw caches the new background and draws the line
+                elif self.background is None:
+                        self.canvas.draw()
+                else:
+                        self.canvas.restore_region(self.background)
+                        self.ax.draw_artist(self.line)
+                        self.canvas.blit(self.ax.bbox)
+
+        def inside(self,bounds):
+                if self.limits is None:
+                        return False
+                return (self.limits[0] <= bounds[0] and bounds[1] <= self.limits[1] and
+                        self.limits[2] <= bounds[2] and bounds[3] <= self.limits[3])
+
+        def rescale(self):
+                limits = []
+                for lo,hi in (self.bounds[0:2],self.bounds[2:4]):
+                        span = (hi - lo) or abs(hi) or 1.0
+                        pad  = span*(self.MARGIN + self.HEADROOM)
+                        limits += [lo - pad, hi + pad]
+                self.limits = tuple(limits)
+                self.ax.set_xlim(limits[0],limits[1])
+                self.ax.set_ylim(limits[2],limits[3])
+
+class acquisitionWorker(threading.Thread):
+        """Owns the ivServer and runs measurements and auto-step on its own thread, so plot redraws
+        and a busy GUI never delay a reading. The GUI only talks to it through two queues: send()
+        posts a command ('setv', 'step', 'interval', 'stepsize', 'autostep', 'autostepsettings', 'stop'),
+        events() hands back what happened since the last call as (kind, args) tuples:
+                ('reading',  (t, bias, I, V, stats))   stats is None unless samples > 1
+                ('voltage',  (v,))                      bias voltage changed
+                ('autostep', (on,))                     auto-step switched itself on/off
+                ('error',    (message,))                the instrument raised, the worker has stopped
+        Every reading is also written to log (an IVLog) as soon as it is taken, if one is set.
+        With a SettleDetector as settle, auto-step moves on as soon as the readings at a voltage have
+        settled, the auto-step interval becoming the longest it waits.
+        profiler (a LoopProfiler) times doMeasurement, stepUp and stepDown and the measurement interval.
+        Measurements and auto-steps keep absolute deadlines (a DeadlineScheduler), the worker sleeps
+        until the next one or the next command; notify, if given, is called after each post().
+        """
+        def __init__(self,server,measurementInterval=1.0,stepSize=VOLTSTEP,samples=1,maxCurrent=MAX_CURRENT,log=None,settle=None,profiler=None,notify=None):
+                super(acquisitionWorker,self).__init__()
+                self.daemon = True
+                self.s = server
+                self.log = log
+                self.commands = queue.Queue()
+                self.readings = queue.Queue()
+                self.running  = False
+                self.notify   = notify
+
+                self.measurementInterval = measurementInterval
+                self.samples    = samples
+                self.maxCurrent = maxCurrent
+                self.stepSize   = stepSize
+
+                self.autoStepInterval = None
+                self.autoStep = False
+                self.autoStepMode = None
+                self.autoStepMaxCurrent = None
+                self.autoStepVoltageStop = None
+
+                self.biasVoltage = 0
+                self.firstMeasurementTime = None
+                self.settle = settle
+                self.stepTime = time.time()
+                self.profiler = profiler if profiler is not None else LoopProfiler()
+                self.schedule = DeadlineScheduler(profiler=self.profiler)   # 'measurement', and 'autostep' while auto-stepping
+                self.lastMeasurementTime = None
+
+        # GUI side
+        def send(self,name,*args):
+                self.commands.put((name,args))
+        def events(self):
+                while True:
+                        try:
+                                yield self.readings.get_nowait()
+                        except queue.Empty:
+                                return
+        def stop(self):
+                if self.is_alive():
+                        self.send('stop')
+                        self.join()
+
+        # worker side
+        def post(self,kind,*args):
+                self.readings.put((kind,args))
+                if self.notify is not None:
+                        self.notify()
+
+        def start(self):
+                self.running = True
+                self.schedule.every('measurement',self.measurementInterval)
+                super(acquisitionWorker,self).start()
+
+        def run(self):
+                try:
+                        while self.running:
+                                try:   # sleep until the next deadline unless a command comes in, then take every pending one
+                                        name,args = self.commands.get(timeout=self.schedule.timeout())
+                                        while True:
+                                                getattr(self,'do_'+name)(*args)
+                                                name,args = self.commands.get_nowait()
+                                except queue.Empty:
+                                        pass
+                                if self.running:
+                                        self.tick()
+                except Exception as e:
+                        self.running = False
+                        self.post('error',repr(e))
+                        self.note('acquisition stopped: {}'.format(repr(e)))
+
+        def tick(self):
+                due = self.schedule.due()
+                if 'measurement' in due:
+                        with self.profiler.phase('doMeasurement'):
+                                self.doMeasurement()
+
+                if self.autoStep:
+                        settled = self.settle is not None and self.settle.settled
+                        if settled:
+                                print("current settled after {:.1f} s".format(time.time() - self.stepTime))
+                                self.schedule.restart('autostep')   # the next interval counts from this step
+                        if 'autostep' in due or settled:
+                                if self.autoStepMode == 'up':
+                                        with self.profiler.phase('stepUp'):
+                                                self.do_step(self.stepSize)
+                                elif self.autoStepMode == 'down':
+                                        with self.profiler.phase('stepDown'):
+                                                self.do_step(-self.stepSize)
+
+        def doMeasurement(self):
+                now = time.time()
+                if self.lastMeasurementTime is not None:
+                        self.profiler.interval('measurement',self.measurementInterval,now - self.lastMeasurementTime)
+                self.lastMeasurementTime = now
+                if self.firstMeasurementTime is None:
+                        t = 0.0
+                        self.firstMeasurementTime = time.time()
+                else:
+                        t = time.time() - self.firstMeasurementTime
+
+                if self.samples > 1:
+                        V,I,stats = self.s.meas_stats(self.samples)
+                        Imax = stats['CURR_max']
+                else:
+                        V,I = self.s.meas()
+                        Imax = I; stats = None
+                self.post('reading',t,self.biasVoltage,I,V,stats)
+                if self.log is not None:
+                        self.log.write(t,self.biasVoltage,I,V)
+                if self.autoStep and self.settle is not None:
+                        self.settle.add(time.time() - self.stepTime,I)
+
+                if Imax > self.maxCurrent:
+                        print("WARNING: CURRENT EXCEEDS MAX_CURRENT")
+                        print("PERFORMING IMMEDIATE STEP DOWN")
+                        self.do_step(-self.stepSize)
+
+                elif self.autoStep:
+                        if not (self.autoStepMaxCurrent is None):
+                                if I > self.autoStepMaxCurrent*1e-6:
+                                        print("Current exceeds autoStepMaxCurrent")
+                                        print("Ceasing autoStep")
+                                        self.do_autostep(False)
+
+        def note(self,text):
+                if self.log is not None:
+                        self.log.note(text)
+                        self.log.sync()
+
+        # commands
+        def do_stop(self):
+                self.running = False
+        def do_interval(self,interval):
+                if interval != self.measurementInterval:
+                        self.note('measurement interval = {}'.format(interval))
+                        self.lastMeasurementTime = None   # the first interval at the new setting isn't one of them
+                        if self.running:
+                                self.schedule.set_interval('measurement',interval)
+                self.measurementInterval = interval
+        def do_stepsize(self,stepSize):
+                self.stepSize = stepSize
+        def do_autostepsettings(self,interval,voltageStop,maxCurrent,mode):
+                self.autoStepInterval    = interval
+                self.autoStepVoltageStop = voltageStop
+                self.autoStepMaxCurrent  = maxCurrent
+                self.autoStepMode        = mode
+                if self.autoStep:
+                        self.schedule.set_interval('autostep',interval)
+        def do_autostep(self,on):
+                if on:
+                        self.schedule.every('autostep',self.autoStepInterval)
+                else:
+                        self.schedule.cancel('autostep')
+                self.autoStep = on
+                if self.settle is not None:
+                        self.settle.reset()
+                self.post('autostep',on)
+                self.note('auto step {}'.format('on' if on else 'off'))
+
+        def do_compliance(self,current):
+                self.s.set_compliance(current)
+                self.note('compliance = {}'.format(current))
+
+        def do_setv(self,voltage):
+                voltage = checkv(voltage)
+                print("SET VOLTAGE TO {voltage}".format(voltage=voltage))
+                self.s.setv(voltage)
+                self.biasVoltage = voltage
+                self.stepTime = time.time()
+                if self.settle is not None:
+                        self.settle.reset()
+                self.post('voltage',voltage)
+
+        def do_step(self,delta):
+                self.do_setv(self.biasVoltage + delta)
+                if self.autoStep and self.autoStepMode == 'up' and delta > 0:
+                        if self.biasVoltage >= self.autoStepVoltageStop:
+                                print("autoStepVoltageStop reached")
+                                print("stopping autoStep")
+                                self.do_autostep(False)
+                elif self.autoStep and self.autoStepMode == 'down' and delta < 0:
+                        if self.biasVoltage <= self.autoStepVoltageStop:
+                                print("autoStepVoltageStop reached")
+                                print("stopping autoStep")
+                                self.do_autostep(False)
+
 class mainDesigner(gui.QMainWindow,Ui_MainWindow):
+        eventsPosted = core.pyqtSignal()   # emitted by the worker thread, delivered on the GUI thread
+
         def __init__(self):
                 super(mainDesigner,self).__init__(None)
                 self.setupUi(self,VOLTSTEP,VOLTSTOP,TIMESTEP)
 
-                self.lastTime = None
-                self.measurementInterval = None; self.measurementTimer = 0.0
-                self.plotRefreshInterval = None; self.plotRefreshTimer = 0.0
+                self.measurementInterval = None
+                self.plotRefreshInterval = None
 
-                self.autoStepInterval = None; self.autoStepTimer = None
+                self.autoStepInterval = None
                 self.autoStep = False
                 self.autoStepMode = None
                 self.autoStepMaxCurrent = None
@@ -115,12 +462,17 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
 
                 self.biasVoltage = 0
 
-                self.firstVoltageChangedIndex = 0
-                self.recentVoltageChangedIndex = 0
-                self.firstMeasurementTime = None
-                self.data = [[],[],[],[]]
+                self.data = IVBuffer()   # columns t, bias, I, V; also tracks the first/most recent voltage change
+                self.stats = []   # (time, bias voltage, reading_stats fields...) when SAMPLES_PER_MEASUREMENT > 1
 
-                self.s = ivServer(KEITHLEY_COM)
+                self.s = ivServer(KEITHLEY_COM,simulate=SIMULATE,average=AVERAGE_FILTER)
+                self.bus = self.s.s.record_bus() if BUS_TIMING else None
+                self.profiler = LoopProfiler(trace=os.sep.join(['data',f.replace("IVdata_","IVtrace_").replace(".txt",".json")]) if PROFILE_TRACE else None)
+                self.schedule = DeadlineScheduler(profiler=self.profiler)   # 'refreshPlots' and 'readout' on the GUI thread
+                self.schedule.every('readout',PROFILE_READOUT_INTERVAL)
+                settle = None if SETTLE_TOLERANCE is None else SettleDetector(tol_rel=SETTLE_TOLERANCE,min_dwell=SETTLE_MIN_DWELL,max_dwell=float('inf'))
+                self.worker = acquisitionWorker(self.s,samples=SAMPLES_PER_MEASUREMENT,settle=settle,profiler=self.profiler,notify=self.eventsPosted.emit)
+                self.eventsPosted.connect(self.events_posted)   # all instrument I/O from here on goes through the worker
 
                 self.rig()
                 self.start()
@@ -128,29 +480,47 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
         def start(self):
                 self.setWindowTitle("Test Stand User Interface")
                 self.timer = core.QTimer(self)               # Create timer object
-                self.timer.setInterval(TIMERINTERVAL)        # Set timer interval to global TIMERINTERVAL, defined at the top of this file
+                self.timer.setSingleShot(True)               # timer_event sets it for the next deadline, nothing runs in between
                 self.timer.timeout.connect(self.timer_event) # Connect timer to the timer_event function
-                self.timer.start()                           # Start the timer
+                self.arm_timer()                             # Start the timer
+                self.worker.log = IVLog(os.sep.join(['data',f]),self.runSettings())   # data/<f>.part until the run is finalized
+                self.worker.start()                          # Measurements and auto-step run on the worker thread
+
+        def runSettings(self):
+                return {
+                        'step'                 : self.sbStepSize.value(),
+                        'stop'                 : self.sbAutoVoltageStop.value(),
+                        'auto step interval'   : self.sbAutoStepInterval.value(),
+                        'measurement interval' : self.sbMeasurementInterval.value(),
+                        'compliance'           : self.s.s.sense_current_prot(),
+                        'max current'          : MAX_CURRENT,
+                        'samples'              : SAMPLES_PER_MEASUREMENT,
+                        'average filter'       : AVERAGE_FILTER,
+                        'settle tolerance'     : SETTLE_TOLERANCE,
+                        }
+
+        def sendAutoStepSettings(self):
+                self.worker.send('autostepsettings',self.autoStepInterval,self.autoStepVoltageStop,self.autoStepMaxCurrent,self.autoStepMode)
 
         def updateAutoStepInterval(self,*args,**kwargs):
                 self.autoStepInterval = self.sbAutoStepInterval.value()
+                self.sendAutoStepSettings()
         def updateAutoStepVoltageStop(self,*args,**kwargs):
                 self.autoStepVoltageStop = self.sbAutoVoltageStop.value()
+                self.sendAutoStepSettings()
         def updateAutoStepMaxCurrent(self,*args,**kwargs):
                 if self.cbAutoMaxCurrent.isChecked():
                         self.autoStepMaxCurrent = self.sbAutoMaxCurrent.value()
                 else:
                         self.autoStepMaxCurrent = None
+                self.sendAutoStepSettings()
                         
-        def updateComplianceMaxCurrent(self,port):
+        def updateComplianceMaxCurrent(self,checked=False):
+                # goes through the worker on the connection it already has, no second session on KEITHLEY_COM
                 if self.btnSetSRangeCompliance.isChecked():
-                        self.s2 = SourceMeterServer(port)
-                        self.s2.sense_current_prot(20.05e-3); 
-                        self.s2.sense_current_range(20.05e-3);
+                        self.worker.send('compliance',20.05e-3)
                 else:
-                        self.s2 = SourceMeterServer(port)
-                        self.s2.sense_current_prot(1.05e-3); 
-                        self.s2.sense_current_range(1.05e-3); 
+                        self.worker.send('compliance',1.05e-3)
 
 #        def updateOutFileName(self):
 #               if self.cbSetOutFileName.isChecked():
@@ -190,6 +560,7 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
         
         def updateAutoStepMode(self,*args,**kwargs):
                 self.autoStepMode = str(self.ddAutoDir.currentText())
+                self.sendAutoStepSettings()
         def updateAutoStep(self,*args,**kwargs):
                 if self.cbAutoStep.isChecked():
                         self.autoStepOn()
@@ -201,76 +572,59 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
                 self.updateAutoStepVoltageStop()
                 self.updateAutoStepMaxCurrent()
                 self.updateAutoStepMode()
-                self.autoStepTimer = 0.0
                 self.autoStep = True
                 self.cbAutoStep.setChecked(True)
+                self.worker.send('autostep',True)
 
         def autoStepOff(self):
-                self.autoStepTimer = None
                 self.autoStep = False
                 self.cbAutoStep.setChecked(False)
+                self.worker.send('autostep',False)
 
-        def timer_event(self):
-                """Runs each time the timer times out"""
-                
-                if self.lastTime is None:
-                        self.lastTime = time.time()
-                        dt = 0.0
-                else:
-                        newTime = time.time()
-                        dt = newTime - self.lastTime
-                        self.lastTime = newTime
-
-                self.measurementTimer += dt
-                if self.measurementTimer >= self.measurementInterval * MEAS_ACTUAL_MODIFIER:
-                        self.measurementTimer = 0.0
-                        self.doMeasurement()
-
-                self.plotRefreshTimer += dt
-                if self.plotRefreshTimer >= self.plotRefreshInterval:
-                        self.plotRefreshTimer = 0.0
-                        self.refreshPlots()
-
-                if self.autoStep:
-
-                        self.autoStepTimer += dt
-                        #print(self.autoStepTimer,self.autoStepInterval)
-                        if self.autoStepTimer >= self.autoStepInterval:
-                                self.autoStepTimer = 0.0
-                                #print(self.autoStepMode)
-                                if self.autoStepMode == 'up':
-                                        self.stepUp()
-                                elif self.autoStepMode == 'down':
-                                        self.stepDown()
-
+        def arm_timer(self):
+                """Sets the timer for the next GUI deadline"""
+                timeout = self.schedule.timeout()
+                self.timerRequested = timeout
+                self.timerArmed = time.time()
+                self.timer.start(int(math.ceil(1000*timeout)))
 
-
-        def doMeasurement(self):
-                if self.firstMeasurementTime is None:
-                        t = 0.0
-                        self.firstMeasurementTime = time.time()
+        def timer_event(self):
+                """Runs when the next GUI deadline comes: plot refresh and the loop timing readout"""
+                self.profiler.interval('timer',self.timerRequested,time.time() - self.timerArmed)   # how late Qt woke us
+                for name in self.schedule.due():
+                        if name == 'refreshPlots':
+                                with self.profiler.phase('refreshPlots'):
+                                        self.refreshPlots()
+                        elif name == 'readout':
+                                self.statusBar().showMessage(self.profiler.readout())   # live loop overhead, see LoopProfiler
+                self.arm_timer()
+
+        def events_posted(self):
+                """The worker posted events, picks them up as they come instead of polling"""
+                with self.profiler.phase('collect'):
+                        self.collect()
+
+        def collect(self):
+                """Drains the acquisition worker's events into the data and the readouts"""
+                for kind,args in self.worker.events():
+                        if kind == 'reading':
+                                self.addMeasurement(*args)
+                        elif kind == 'voltage':
+                                self.voltageChanged(*args)
+                        elif kind == 'autostep':
+                                self.autoStep = args[0]
+                                self.cbAutoStep.setChecked(args[0])
+                        elif kind == 'error':
+                                print("ACQUISITION STOPPED: {e}".format(e=args[0]))
+
+        def addMeasurement(self,t,biasVoltage,I,V,stats):
+                self.data.append(t,biasVoltage,I,V) # time, bias voltage, current measured, actual voltage measured
+
+                if stats is None:
+                        self.lblCurrentMeasurement.setText(str(I))
                 else:
-                        t = time.time() - self.firstMeasurementTime
-
-                V,I = self.s.meas()
-
-                self.data[0].append(t                ) # time of measurement
-                self.data[1].append(self.biasVoltage ) # bias voltage of measurement
-                self.data[2].append(I                ) # current measured
-                self.data[3].append(V                ) # actual voltage measured
-                self.lblCurrentMeasurement.setText(str(I))
-
-                if I > MAX_CURRENT:
-                        print("WARNING: CURRENT EXCEEDS MAX_CURRENT")
-                        print("PERFORMING IMMEDIATE STEP DOWN")
-                        self.stepDown()
-
-                elif self.autoStep:
-                        if not (self.autoStepMaxCurrent is None):
-                                if I > self.autoStepMaxCurrent*1e-6:
-                                        print("Current exceeds autoStepMaxCurrent")
-                                        print("Ceasing autoStep")
-                                        self.autoStepOff()
+                        self.stats.append((t,biasVoltage)+tuple(stats))
+                        self.lblCurrentMeasurement.setText("{} +- {}".format(I,stats['CURR_std']))
                 
 
         def refreshPlots(self):
@@ -279,18 +633,14 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
                         return
 
                 # plot all data
-                self.axAll.clear()
-                self.axAll.plot(self.data[1][self.firstVoltageChangedIndex:],self.data[2][self.firstVoltageChangedIndex:],'ro')
-                self.fcAll.draw()
+                self.plotAll.update(self.data.since_first_change('bias'),self.data.since_first_change('I'),self.data.firstVoltageChangedIndex)
 
                 # plot recent data
-                if len(self.data[0]) > self.recentVoltageChangedIndex:
-                        self.axLatest.clear()
-                        self.axLatest.plot(
-                                self.data[0][self.recentVoltageChangedIndex:],
-                                self.data[2][self.recentVoltageChangedIndex:],
-                                'ro')
-                        self.fcLatest.draw()
+                if len(self.data) > self.data.recentVoltageChangedIndex:
+                        self.plotLatest.update(
+                                self.data.since_recent_change('t'),
+                                self.data.since_recent_change('I'),
+                                self.data.recentVoltageChangedIndex)
 
 
 
@@ -321,62 +671,38 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
                 self.tbLatest  = NavigationToolbar(self.fcLatest,self)
                 self.vlGraphLatestV.addWidget(self.tbLatest)
                 self.vlGraphLatestV.addWidget(self.fcLatest)
+                self.plotLatest = livePlot(self.fcLatest,self.axLatest)
 
                 self.figAll    = Figure(); self.axAll = self.figAll.add_subplot(111)
                 self.fcAll     = FigureCanvas(self.figAll)
                 self.tbAll     = NavigationToolbar(self.fcAll,self)
                 self.vlGraphAllV.addWidget(self.tbAll)
                 self.vlGraphAllV.addWidget(self.fcAll)
+                self.plotAll   = livePlot(self.fcAll,self.axAll)
 
                 self.cbSetOutFileName.clicked.connect(self.updateOutFileName)
                 #self.cbSetOutDirectory.clicked.connect(self.updateOutDirName)
 
 
-        def _changeVoltage(self,voltage):
-                print("SET VOLTAGE TO {voltage}".format(voltage=voltage))
-                self.s.setv(voltage)
-                if self.recentVoltageChangedIndex == 0:
-                        self.firstVoltageChangedIndex = len(self.data[0])
-                self.recentVoltageChangedIndex = len(self.data[0])
-                self.measurementTimer = 0.0
-
-        def setVoltage(self,*args,**kwargs):
-                voltage = checkv(self.sbSetVoltage.value())
-                self._changeVoltage(voltage)
+        def voltageChanged(self,voltage):   #the worker has set a new bias, readings after this one belong to it
+                self.data.voltage_changed()
                 self.biasVoltage = voltage
                 self.lblBiasVoltage.setText(str(voltage))
                 self.updateStepToReadouts()
 
-        def stepUp(self,*args,**kwargs):
-                voltage = checkv(self.biasVoltage + self.sbStepSize.value())
-                self._changeVoltage(voltage)
-                self.biasVoltage = voltage
-                self.lblBiasVoltage.setText(str(voltage))
-                self.updateStepToReadouts()
-
-                if self.autoStep and self.autoStepMode == 'up':
-                        if voltage >= self.autoStepVoltageStop:
-                                print("autoStepVoltageStop reached")
-                                print("stopping autoStep")
-                                self.autoStepOff()
+        def setVoltage(self,*args,**kwargs):
+                self.worker.send('setv',checkv(self.sbSetVoltage.value()))
 
+        def stepUp(self,*args,**kwargs):
+                self.worker.send('step',self.sbStepSize.value())
 
         def stepDown(self,*args,**kwargs):
-                voltage = checkv(self.biasVoltage - self.sbStepSize.value())
-                self._changeVoltage(voltage)
-                self.biasVoltage = voltage
-                self.lblBiasVoltage.setText(str(voltage))
-                self.updateStepToReadouts()
-
-                if self.autoStep and self.autoStepMode == 'down':
-                        if voltage <= self.autoStepVoltageStop:
-                                print("autoStepVoltageStop reached")
-                                print("stopping autoStep")
-                                self.autoStepOff()
+                self.worker.send('step',-self.sbStepSize.value())
 
 
         def updateStepToReadouts(self,*args,**kwargs):
                 stepSize = self.sbStepSize.value()
+                self.worker.send('stepsize',stepSize)
                 vUp   = checkv(self.biasVoltage + stepSize)
                 vDown = checkv(self.biasVoltage - stepSize)
                 self.lblStepUp.setText("to {v} volts".format(v=str(vUp)))
@@ -385,9 +711,16 @@ class mainDesigner(gui.QMainWindow,Ui_MainWindow):
         def changeMeasurementInterval(self,*args,**kwargs):
                 newInterval = self.sbMeasurementInterval.value()
                 self.measurementInterval = newInterval
+                self.worker.send('interval',newInterval)
         def changePlotRefreshInterval(self,*args,**kwargs):
                 newInterval = self.sbPlotRefreshInterval.value()
                 self.plotRefreshInterval = newInterval
+                if 'refreshPlots' in self.schedule.deadlines:
+                        self.schedule.set_interval('refreshPlots',newInterval)
+                else:
+                        self.schedule.every('refreshPlots',newInterval)
+                if hasattr(self,'timer'):
+                        self.arm_timer()   # the next refresh may now be sooner than the timer is set for
 
 
 
@@ -403,14 +736,27 @@ if __name__ == '__main__':
         m.show()
         app.exec_()
         m.timer.stop()
-        data = numpy.array(m.data)
-        data = data.swapaxes(0,1)
+        m.worker.stop()
+        m.collect()   #readings taken since the last timer event
         CHECK_FOLDER=os.path.isdir(dpath)
-        if not CHECK_FOLDER:
+        if dpath and not CHECK_FOLDER:
                 os.makedirs(dpath)
-        numpy.savetxt(os.sep.join(['data',f]),data)
+        m.worker.log.finalize(os.sep.join(['data',f]))   #the rows are already on disk, this only renames the log
         print("Saved data as {f}".format(f=f))
+        if m.stats:
+                fstats = f.replace("IVdata_","IVstats_")
+                header = ' '.join(('t','bias')+reading_stats(numpy.zeros(1,[('VOLT','f8'),('CURR','f8')])).dtype.names)
+                numpy.savetxt(os.sep.join(['data',fstats]),numpy.array(m.stats),header=header)
+                print("Saved per-measurement statistics as {f}".format(f=fstats))
         m.s.close()   #safely disconnects from the Keithley before exiting
+        m.profiler.close()
+        print(m.profiler.summary())
+        if m.bus is not None:
+                fbus = f.replace("IVdata_","IVbus_").replace(".txt","")
+                m.bus.to_json(os.sep.join(['data',fbus+'.json']))
+                m.bus.to_csv(os.sep.join(['data',fbus+'.csv']))
+                print(m.bus.summary())
+                print("Saved serial link timing as {f}.json/.csv".format(f=fbus))
         sys.exit()
 
 
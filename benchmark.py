@@ -0,0 +1,161 @@
+"""
+Acquisition throughput benchmarks.
+
+Drives SourceMeterServer, ivServer and MakeIVCurve against a SimulatedKeithley2410
+and prints one JSON record per benchmark: readings/second, time per step spent
+outside the intended dwell, and serial transfers/bytes per IV point. Run it
+before and after a change and compare the records, e.g.
+
+    python benchmark.py --label before > before.json
+
+The ivServer benchmark needs TestStandUI's imports (PyQt4, matplotlib), without
+them its record only says it was skipped. Ramp records taken before the simulator
+modelled source autorange only went up to 20 V whatever --stop said, don't
+compare them with later ones.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from Keithley2410 import SourceMeterServer, MakeIVCurve
+from Keithley2410Sim import SimulatedKeithley2410
+
+
+def make_server(args):
+    sim = SimulatedKeithley2410(latency=args.latency, baud=args.baud, nplc=args.nplc)
+    return SourceMeterServer(None, simulate=sim), sim
+
+def traffic(sim):
+    return sim.nwrites, sim.nreads, sim.bytes_written + sim.bytes_read
+
+def record(name, args, sim, before, elapsed, points, readings, dwell=0.0):
+    """Builds the result record from the traffic counted since before=traffic(sim)"""
+    nwrites, nreads, nbytes = [b - a for a, b in zip(before, traffic(sim))]
+    return {
+        'benchmark'          : name,
+        'label'              : args.label,
+        'latency'            : args.latency,
+        'baud'               : args.baud,
+        'nplc'               : args.nplc,
+        'points'             : points,
+        'readings'           : readings,
+        'elapsed_s'          : elapsed,
+        'dwell_s'            : dwell,
+        'readings_per_s'     : readings/elapsed if elapsed else None,
+        'overhead_per_step_s': (elapsed - dwell)/points if points else None,
+        'writes_per_point'   : nwrites/float(points) if points else None,
+        'reads_per_point'    : nreads/float(points) if points else None,
+        'transfers_per_point': (nwrites + nreads)/float(points) if points else None,
+        'bytes_per_point'    : nbytes/float(points) if points else None,
+        }
+
+@contextlib.contextmanager
+def quiet():
+    """The acquisition code prints every step, keep that out of the JSON output"""
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+################
+#  Benchmarks  #
+################
+
+def bench_meas_read(args):
+    """Back to back SourceMeterServer.meas()/read() at a fixed bias"""
+    s, sim = make_server(args)
+    s.source_mode('VOLT')
+    s.output_on()
+    s.source_voltage_level(10)
+
+    before = traffic(sim)
+    t0 = time.time()
+    for _ in range(args.readings):
+        s.meas()
+        s.read()
+    elapsed = time.time() - t0
+    result = record('meas_read', args, sim, before, elapsed, args.readings, args.readings)
+    s.output_off()
+    return result
+
+def bench_ivserver(args):
+    """ivServer.setv()/meas() over the 0-stop volt ramp, one reading per step"""
+    from TestStandUI import ivServer
+    sim = SimulatedKeithley2410(latency=args.latency, baud=args.baud, nplc=args.nplc)
+    with quiet():
+        iv = ivServer(None, simulate=sim)
+        voltages = range(0, args.stop + 1, args.step)
+
+        before = traffic(sim)
+        t0 = time.time()
+        for v in voltages:
+            iv.setv(v)
+            time.sleep(args.dwell)
+            iv.meas()
+        elapsed = time.time() - t0
+        n = len(voltages)
+        result = record('ivserver_setv_meas', args, sim, before, elapsed, n, n, dwell=n*args.dwell)
+        iv.s.output_off()
+    return result
+
+def bench_make_iv_curve(args, sweep=False):
+    """MakeIVCurve.makeIVCurve() up to stop and back down"""
+    s, sim = make_server(args)
+    ivc = MakeIVCurve(s)
+
+    before = traffic(sim)
+    t0 = time.time()
+    with quiet():
+        down, up = ivc.makeIVCurve(startV=0, stopV=args.stop, waitT=args.dwell, step=args.step, maxI=args.max_current, sweep=sweep)
+    elapsed = time.time() - t0
+    n = len(up[0]) + len(down[0])
+    return record('make_iv_curve_sweep' if sweep else 'make_iv_curve', args, sim, before, elapsed, n, n, dwell=n*args.dwell)
+
+def bench_make_iv_curve_sweep(args):
+    """MakeIVCurve.makeIVCurve(sweep=True), the ramps timed by the instrument"""
+    return bench_make_iv_curve(args, sweep=True)
+
+BENCHMARKS = {
+    'meas_read'     : bench_meas_read,
+    'ivserver'      : bench_ivserver,
+    'make_iv_curve' : bench_make_iv_curve,
+    'make_iv_curve_sweep' : bench_make_iv_curve_sweep,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS), help='any of: '+', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--label',       default='',     help='tag copied into every record (e.g. before/after)')
+    parser.add_argument('--latency',     default=0.002,  type=float, help='simulated turnaround per transfer (s)')
+    parser.add_argument('--baud',        default=57600,  type=int,   help='simulated RS-232 baud rate, 0 for no per-byte cost')
+    parser.add_argument('--nplc',        default=1.0,    type=float, help='integration time per reading (power line cycles)')
+    parser.add_argument('--readings',    default=200,    type=int,   help='readings for the meas_read benchmark')
+    parser.add_argument('--stop',        default=800,    type=int,   help='ramp stop voltage (V)')
+    parser.add_argument('--step',        default=5,      type=int,   help='ramp step (V)')
+    parser.add_argument('--dwell',       default=0.0,    type=float, help='intended dwell per step (s)')
+    parser.add_argument('--max-current', default=1e-3,   type=float, help='compliance for make_iv_curve (A)')
+    parser.add_argument('--out',         default=None,   help='append records to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        for name in args.benchmarks:
+            if name not in BENCHMARKS:
+                parser.error("Unknown benchmark {}".format(name))
+            try:
+                result = BENCHMARKS[name](args)
+            except ImportError as e:
+                result = {'benchmark': name, 'label': args.label, 'skipped': str(e)}
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,9 @@ import numpy
 import math
 import time
 import os
+import concurrent.futures
+
+from IVData import open_ivb, convert_text, IVBinaryWriter, IV_COLUMNS
 
 DS_ALIASES = {
 	'72_ovn_dry'     : '2018_7_12_11_44_25',
@@ -26,20 +29,33 @@ PATH = os.getcwd()
 
 RAW_DATA_DIR = 'data'
 RAW_DATA_FMT = 'data_{}.txt'
+RAW_BIN_FMT  = 'data_{}.ivb'
 
 def load_raw_data(suffix,mult_current=None):
+	"""The .ivb version of the dataset is memory-mapped (copy on write) if there is one, so slicing
+	it only reads the rows used; otherwise the text file is loaded with numpy.loadtxt"""
 	suffix=proc_suffix(suffix)
-	data = numpy.loadtxt(os.sep.join([PATH,RAW_DATA_DIR,RAW_DATA_FMT.format(suffix)]))
+	path = os.sep.join([PATH,RAW_DATA_DIR,RAW_BIN_FMT.format(suffix)])
+	if os.path.exists(path):
+		data,_ = open_ivb(path,mode='c')
+	else:
+		data = numpy.loadtxt(os.sep.join([PATH,RAW_DATA_DIR,RAW_DATA_FMT.format(suffix)]))
 	if not (mult_current is None):
 		data[...,2]*=mult_current
 	return data
 
+def convert_raw_data(suffix):
+	"""Writes the .ivb version of a text dataset, load_raw_data uses it from then on"""
+	suffix=proc_suffix(suffix)
+	return convert_text(os.sep.join([PATH,RAW_DATA_DIR,RAW_DATA_FMT.format(suffix)]),os.sep.join([PATH,RAW_DATA_DIR,RAW_BIN_FMT.format(suffix)]))
+
 BIN_DIR = os.sep.join(['bins','{}'])
 BIN_A_FMT = 'a_{}v.npy'
 BIN_D_FMT = 'd_{}v.npy'
 BIN_F_FMT = 'f_{}v.npy'
 BIN_L_FMT = 'l_{}v.npy'
 BIN_FMT = {'a':BIN_A_FMT,'d':BIN_D_FMT,'f':BIN_F_FMT,'l':BIN_L_FMT}
+BIN_STORE = os.sep.join([BIN_DIR,'bins.ivb']) # all bins of a dataset, back to back, indexed in the header
 
 BIN_PLOT_DIR = os.sep.join([BIN_DIR,'plots'])
 BIN_PLOT_FMT = '{}v.png'
@@ -71,74 +87,118 @@ def plot_iv_all(suffix,moduleID=None):
 ############
 
 def save_bins(suffix,save_fl=False):
+	"""Writes the dataset's bins to its bin store: one .ivb file holding the bins back to back,
+	with an index of (category, voltage, offset, length) in the header"""
 	suffix=proc_suffix(suffix)
-	f,a,d,l = make_bins(load_raw_data(suffix))
-	av_done = []
-	dv_done = []
+	raw = load_raw_data(suffix)
+	f,a,d,l = make_bins(raw)
 
 	# make bin folder if it doesn't exist yet
 	if not os.path.exists(os.sep.join([PATH,BIN_DIR.format(suffix)])):
 		os.mkdir(os.sep.join([PATH,BIN_DIR.format(suffix)]))
 
-	for bin_ in a:
-		v = int(bin_[0,1])
-		if v in av_done:
-			print("Warning: more than one bin with voltage {} in ascending bin list. All but the first are ignored.".format(v))
-			continue
-		av_done.append(v)
-		numpy.save(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_A_FMT.format(v)]),bin_)
-
-	for bin_ in d:
-		v = int(bin_[0,1])
-		if v in dv_done:
-			print("Warning: more than one bin with voltage {} in descending bin list. All but the first are ignored.".format(v))
-			continue
-		dv_done.append(v)
-		numpy.save(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_D_FMT.format(v)]),bin_)
-
+	bins  = []
+	index = []
+	offset = 0
+	categories = [('a',a,'ascending'),('d',d,'descending')]
 	if save_fl:
-		numpy.save(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_F_FMT.format(int(f[0,1]))]),f)
-		numpy.save(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_L_FMT.format(int(f[0,1]))]),l)
+		categories += [('f',[f],'first'),('l',[l],'last')]
+	for category,bins_,name in categories:
+		done = []
+		for bin_ in bins_:
+			v = int(bin_[0,1])
+			if v in done:
+				print("Warning: more than one bin with voltage {} in {} bin list. All but the first are ignored.".format(v,name))
+				continue
+			done.append(v)
+			bins.append(bin_)
+			index.append([category,v,offset,len(bin_)])
+			offset += len(bin_)
+
+	path = os.sep.join([PATH,BIN_STORE.format(suffix)])
+	with IVBinaryWriter(path+'.part',{'suffix':suffix,'index':index},columns=IV_COLUMNS[:raw.shape[-1]]) as writer:
+		for bin_ in bins:
+			writer.extend(bin_)
+	os.replace(path+'.part',path)
+
+_bin_stores = {} # suffix -> (mtime, data, index) of the bin stores opened so far
+
+def open_bin_store(suffix):
+	"""(data, index) of a dataset's bin store, data memory-mapped, index mapping (category, voltage)
+	to (offset, length). Kept open per dataset until the file changes"""
+	suffix=proc_suffix(suffix)
+	path = os.sep.join([PATH,BIN_STORE.format(suffix)])
+	mtime = os.path.getmtime(path)
+	if suffix not in _bin_stores or _bin_stores[suffix][0] != mtime:
+		data,header = open_ivb(path)
+		index = dict(((c,v),(o,n)) for c,v,o,n in header['metadata']['index'])
+		_bin_stores[suffix] = (mtime,data,index)
+	return _bin_stores[suffix][1:]
+
+def list_bins(suffix,category='a'):
+	"""Sorted voltages of the dataset's bins of a category, without opening any bin"""
+	suffix=proc_suffix(suffix)
+	if os.path.exists(os.sep.join([PATH,BIN_STORE.format(suffix)])):
+		_,index = open_bin_store(suffix)
+		return sorted(v for c,v in index if c == category)
+	# bins saved one .npy per voltage by older versions
+	prefix = BIN_FMT[category].split('{}')[0]
+	names = os.listdir(os.sep.join([PATH,BIN_DIR.format(suffix)]))
+	return sorted(int(_[len(prefix):-len('v.npy')]) for _ in names if _.startswith(prefix) and _.endswith('v.npy'))
+
+BIN_ASC  =  1
+BIN_DESC = -1
+BIN_TABLE_DTYPE = [('offset','i8'),('length','i8'),('voltage','f8'),('direction','i1')]
+
+def segment_bins(raw_data):
+	"""Table of the runs of constant bias voltage (column 1) in raw_data, in order: offset, length,
+	voltage and direction (BIN_ASC/BIN_DESC relative to the run before it, 0 for the first run)"""
+	v = raw_data[...,1]
+	starts = numpy.concatenate([[0],numpy.flatnonzero(v[1:] != v[:-1]) + 1])
+	table = numpy.zeros(len(starts),dtype=BIN_TABLE_DTYPE)
+	table['offset']    = starts
+	table['length']    = numpy.diff(numpy.append(starts,len(v)))
+	table['voltage']   = v[starts]
+	table['direction'][1:] = numpy.where(table['voltage'][1:] > table['voltage'][:-1],BIN_ASC,BIN_DESC)
+	return table
+
+def bin_tables(raw_data,discard_first_point_per_bin=True):
+	"""Offset/length tables for make_bins' first, ascending, descending and last bins.
+	Bins of length 1 between the first and the last are ignored"""
+	table = segment_bins(raw_data)
+	first,middle,last = table[:1].copy(),table[1:-1],table[-1:].copy()
+	short = middle['length'] == 1
+	for _ in range(short.sum()):
+		print("Warning: found bin of length 1. Bins of length 1 are ignored.")
+	middle = middle[~short]
+	asc  = middle[middle['direction'] == BIN_ASC]
+	desc = middle[middle['direction'] == BIN_DESC]
+	if discard_first_point_per_bin:
+		for t in (first,asc,desc,last):
+			t['offset'] += 1
+			t['length'] -= 1
+	return first,asc,desc,last
 
 def make_bins(raw_data,discard_first_point_per_bin=True):
-	asc_bins  = []
-	desc_bins = []
-
-	first_bin    = None
-	last_bin     = None
-	this_bin     = []
-	this_voltage = raw_data[0,1]
-	this_bin_asc = None
-	for data_point in raw_data:
-		if data_point[1] == this_voltage:
-			this_bin.append(data_point)
-		else:
-			if first_bin is None:
-				first_bin = this_bin
-			else:
-				if len(this_bin) == 1:
-					print("Warning: found bin of length 1. Bins of length 1 are ignored.")
-				elif this_bin_asc:
-					asc_bins.append(this_bin)
-				elif not this_bin_asc:
-					desc_bins.append(this_bin)
-
-			if data_point[1] > this_voltage:
-				this_bin_asc = True
-			else:
-				this_bin_asc = False
-
-			this_voltage = data_point[1]
-			this_bin     = [data_point]
-	last_bin = this_bin
-	if discard_first_point_per_bin:
-		return numpy.array(first_bin)[1:],[numpy.array(_)[1:] for _ in asc_bins],[numpy.array(_)[1:] for _ in desc_bins],numpy.array(last_bin)[1:]
-	else:
-		return numpy.array(first_bin),[numpy.array(_) for _ in asc_bins],[numpy.array(_) for _ in desc_bins],numpy.array(last_bin)
+	"""Splits raw_data into bins of constant bias voltage: returns the first bin, the lists of
+	ascending and descending bins, and the last bin, all views into raw_data"""
+	first,asc,desc,last = bin_tables(raw_data,discard_first_point_per_bin)
+	view = lambda row:raw_data[row['offset']:row['offset']+row['length']]
+	return view(first[0]),[view(_) for _ in asc],[view(_) for _ in desc],view(last[0])
 
 def load_bin(suffix,v=0,category='a',normt=True,mult_current=1e6):
+	"""A copy of one bin, sliced out of the dataset's bin store (or its .npy file for older bins).
+	Raises KeyError if the dataset has no such bin"""
 	suffix=proc_suffix(suffix)
-	bin_ = numpy.load(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_FMT[category].format(v)]))
+	if os.path.exists(os.sep.join([PATH,BIN_STORE.format(suffix)])):
+		data,index = open_bin_store(suffix)
+		offset,length = index[(category,int(v))]
+		bin_ = numpy.array(data[offset:offset+length])
+	else:
+		try:
+			bin_ = numpy.load(os.sep.join([PATH,BIN_DIR.format(suffix),BIN_FMT[category].format(v)]))
+		except IOError:
+			raise KeyError((category,v))
 	if not (mult_current is None):
 		bin_[...,2]*=mult_current
 	if normt:
@@ -203,6 +263,127 @@ def do_exponential_fit(xdata,ydata):
 	return popt,numpy.array([A,B,C]),numpy.stack([m1,m2,m3],0)
 
 
+EXP_FIT_DTYPE = [
+	('category','U1'),('voltage','i8'),('n','i8'),
+	('A0','f8'),('B0','f8'),('C0','f8'),   # closed-form guess from the means of the thirds
+	('A','f8'),('B','f8'),('C','f8'),      # curve_fit result
+	('tau','f8'),('settled','f8'),         # 1/B (seconds) and C (the predicted settled current)
+	('rms','f8'),('r2','f8'),              # residuals of the fit
+	('ok','?'),('error','U64'),
+	]
+
+def fit_exp_const_dx_batch(X1,Y1,X2,Y2,X3,Y3):
+	"""fit_exp_const_dx on arrays of points, returns A,B,C arrays and the is_ordered flags
+	(A,B,C are nan where the Y values are not ordered)"""
+	ordered = ((Y1>Y2)&(Y2>Y3)) | ((Y1<Y2)&(Y2<Y3))
+	with numpy.errstate(all='ignore'):
+		dX = (X3-X1)/2.0
+		B = numpy.where(ordered,numpy.log((Y1-Y2)/(Y2-Y3))/dX,numpy.nan)
+		A = (Y1-Y2)/(numpy.exp(-B*X1)-numpy.exp(-B*X2))
+		C = Y1 - A*numpy.exp(-B*X1)
+	return A,B,C,ordered
+
+def _bin_segments(suffix,categories):
+	"""(data, [(category, voltage, offset, length), ...]) of a dataset's bins, from its bin store if it
+	has one, otherwise straight from the raw data (first bin per voltage, like save_bins)"""
+	suffix=proc_suffix(suffix)
+	if os.path.exists(os.sep.join([PATH,BIN_STORE.format(suffix)])):
+		data,index = open_bin_store(suffix)
+		segments = sorted((c,v,o,n) for (c,v),(o,n) in index.items() if c in categories)
+		return data,segments
+	data = load_raw_data(suffix)
+	first,asc,desc,last = bin_tables(data)
+	segments = []
+	for category,table in (('f',first),('a',asc),('d',desc),('l',last)):
+		if category not in categories:
+			continue
+		done = set()
+		for row in table:
+			v = int(row['voltage'])
+			if v not in done:
+				done.add(v)
+				segments.append((category,v,int(row['offset']),int(row['length'])))
+	return data,segments
+
+def _refine_exponential_fit(args):
+	"""curve_fit of one bin from its closed-form guess, run in the fit_exponential_bins process pool"""
+	x,y,p0 = args
+	try:
+		popt,pcov = opt.curve_fit(exponential_fn,x,y,p0=p0)
+	except (RuntimeError,ValueError) as e:
+		return None,str(e)[:64]
+	return popt,''
+
+def fit_exponential_bins(suffix,categories='ad',processes=None,refine=True,mult_current=1e6):
+	"""Exponential settling fits of every bin of a dataset at once. The closed-form guesses of
+	do_exponential_fit are computed for all bins together from cumulative sums, then refined with
+	curve_fit in a pool of processes (processes=0 runs them here, refine=False skips them).
+	Returns an EXP_FIT_DTYPE table, one row per (category, voltage); bins that fail the is_ordered
+	or B<0 checks, or whose fit does not converge, have ok=False and the reason in error"""
+	data,segments = _bin_segments(suffix,categories)
+	table = numpy.zeros(len(segments),dtype=EXP_FIT_DTYPE)
+	for field in ('A0','B0','C0','A','B','C','tau','settled','rms','r2'):
+		table[field] = numpy.nan
+	if not segments:
+		return table
+	table['category'] = [_[0] for _ in segments]
+	table['voltage']  = [_[1] for _ in segments]
+	offset = numpy.array([_[2] for _ in segments])
+	n      = numpy.array([_[3] for _ in segments])
+	table['n'] = n
+
+	# means of the thirds of every bin, time relative to the start of the bin like load_bin
+	k,r = n//3,n%3
+	m1 = offset + k + (r == 2)
+	m2 = offset + 2*k + (r >= 1)
+	end = offset + n
+	t = numpy.concatenate([[0.0],numpy.cumsum(data[...,0])])
+	I = numpy.concatenate([[0.0],numpy.cumsum(data[...,2])])
+	t0 = data[numpy.minimum(offset,len(data)-1),0]
+	with numpy.errstate(all='ignore'):
+		mean = lambda cs,a,b:(cs[b]-cs[a])/(b-a)
+		X1,X2,X3 = [mean(t,a,b)-t0 for a,b in ((offset,m1),(m1,m2),(m2,end))]
+		Y1,Y2,Y3 = [mean(I,a,b)*(mult_current or 1) for a,b in ((offset,m1),(m1,m2),(m2,end))]
+	A,B,C,ordered = fit_exp_const_dx_batch(X1,Y1,X2,Y2,X3,Y3)
+	table['A0'],table['B0'],table['C0'] = A,B,C
+
+	table['ok'] = True
+	for bad,reason in ((n < 3,'fewer than 3 points'),(~ordered & (n >= 3),'Y values not ordered'),(ordered & (B < 0),'Diverging exponential found (B<0)')):
+		table['error'][bad & table['ok']] = reason
+		table['ok'][bad] = False
+	table['A'],table['B'],table['C'] = table['A0'],table['B0'],table['C0']
+
+	good = numpy.flatnonzero(table['ok'])
+	def points(i):
+		x = data[offset[i]:offset[i]+n[i],0] - t0[i]
+		y = data[offset[i]:offset[i]+n[i],2]*(mult_current or 1)
+		return x,y
+	if refine and len(good):
+		jobs = [points(i)+((A[i],B[i],C[i]),) for i in good]
+		if processes == 0:
+			results = list(map(_refine_exponential_fit,jobs))
+		else:
+			with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+				results = list(executor.map(_refine_exponential_fit,jobs,chunksize=max(1,len(jobs)//(4*(processes or os.cpu_count() or 1)))))
+		for i,(popt,error) in zip(good,results):
+			if popt is None:
+				table['ok'][i] = False
+				table['error'][i] = error
+			else:
+				table['A'][i],table['B'][i],table['C'][i] = popt
+
+	for i in numpy.flatnonzero(table['ok']):
+		x,y = points(i)
+		res = y - exponential_fn(x,table['A'][i],table['B'][i],table['C'][i])
+		table['rms'][i] = numpy.sqrt(numpy.mean(res**2))
+		ss = numpy.sum((y - y.mean())**2)
+		table['r2'][i] = 1 - numpy.sum(res**2)/ss if ss else numpy.nan
+	with numpy.errstate(divide='ignore'):
+		table['tau'] = 1.0/table['B']
+	table['settled'] = table['C']
+	return table
+
+
 def do_linear_fit(xdata,ydata):
 	n = len(xdata)
 	if n != len(ydata):
@@ -231,6 +412,41 @@ def do_timed_linear_fit(bin_,tstart,tstop):
 	return do_bin_linear_fit(bin_[istart:istop,...]),istop == bin_.shape[0]
 
 
+LINEAR_FIT_DTYPE = [('m','f8'),('b','f8'),('n','i8'),('residual_var','f8'),('m_err','f8'),('maxed','?')]
+
+def linear_fit_sums(bin_):
+	"""Prefix sums of 1, t, I, t*t, t*I and I*I over a bin (time column 0, current column 2), shape (6, n+1):
+	the least squares line through any run of points [i:j] comes from sums[:,j]-sums[:,i]"""
+	t = bin_[...,0]
+	I = bin_[...,2]
+	sums = numpy.zeros((6,len(t)+1))
+	for row,column in enumerate((numpy.ones_like(t),t,I,t*t,t*I,I*I)):
+		numpy.cumsum(column,out=sums[row,1:])
+	return sums
+
+def timed_linear_fits(bin_,tstart,tstops,sums=None):
+	"""do_timed_linear_fit for every tstop in tstops at once, in O(1) per tstop from linear_fit_sums.
+	Returns a LINEAR_FIT_DTYPE table: slope m, intercept b, number of points, residual variance,
+	standard error of m and whether the window reached the end of the bin"""
+	if sums is None:
+		sums = linear_fit_sums(bin_)
+	tstops = numpy.atleast_1d(tstops)
+	istart = numpy.searchsorted(bin_[...,0],tstart)
+	istop  = numpy.searchsorted(bin_[...,0],tstops)
+	S1,St,SI,Stt,StI,SII = sums[:,istop] - sums[:,istart][:,None]
+	out = numpy.zeros(len(tstops),dtype=LINEAR_FIT_DTYPE)
+	with numpy.errstate(all='ignore'):
+		den = S1*Stt - St*St
+		m = (S1*StI - St*SI)/den
+		b = (SI - m*St)/S1
+		ssr = numpy.maximum(SII - b*SI - m*StI,0.0)
+		var = ssr/(S1 - 2)
+		out['m_err'] = numpy.sqrt(var*S1/den)
+	out['m'],out['b'],out['n'],out['residual_var'] = m,b,S1,var
+	out['maxed'] = istop == bin_.shape[0]
+	return out
+
+
 ##########################
 ##  plotting functions  ##
 ##########################
@@ -265,10 +481,12 @@ def plot_dataset(suffix,suptitle=None,show=True,color='r',x_index=1):
 
 def plot_asc_desc(suffix,suptitle=None,descriptor="",show=True,asc_color='r',desc_color='b',max_points_per_bin=None,plot_means=False,plot_erb=False,skip=None):
 	voltages = range(5,1090,5)
+	asc_voltages  = set(list_bins(suffix,'a'))
+	desc_voltages = set(list_bins(suffix,'d'))
 	first = [1,1]
 	for v in voltages:
 
-		if not (skip == 'a'):
+		if not (skip == 'a') and v in asc_voltages:
 			try:
 				bin_ = load_bin(suffix,v)
 				if not (max_points_per_bin is None):
@@ -293,7 +511,7 @@ def plot_asc_desc(suffix,suptitle=None,descriptor="",show=True,asc_color='r',des
 			except:
 				pass
 
-		if not (skip == 'd'):
+		if not (skip == 'd') and v in desc_voltages:
 			try:
 				bin_ = load_bin(suffix,v,category='d')
 				if not (max_points_per_bin is None):
@@ -338,25 +556,17 @@ def plot_exponential_fit(bin_):
 
 def make_m_of_tstop_plot(datasets,v,tstart,tstop_initial,tstop_final,tstop_steps):
 	bins     = [load_bin(_,v) for _ in datasets]
-	finished = [False for _ in bins]
 	ms       = [[] for _ in bins]
 	bs       = [[] for _ in bins]
 
 	tstops = numpy.linspace(tstop_initial,tstop_final,tstop_steps)
-	for tstop in tstops:
-
-		for i,bin_ in enumerate(bins):
-			popt,maxed = do_timed_linear_fit(bin_,tstart,tstop)
-			#istart,istop = get_time_interval(bin_,tstart,tstop)
-			#maxed = (istop == bin_.shape[0])
-			if maxed:
-				if finished[i]:
-					continue
-				else:
-					finished[i]=True
-			#ms[i].append(bin_[istart:istop,2].mean())
-			ms[i].append(popt[0])
-			bs[i].append(popt[1])
+	for i,bin_ in enumerate(bins):
+		fits = timed_linear_fits(bin_,tstart,tstops)
+		# up to and including the first window that reaches the end of the bin
+		maxed = numpy.flatnonzero(fits['maxed'])
+		count = maxed[0]+1 if len(maxed) else len(tstops)
+		ms[i] = fits['m'][:count]
+		bs[i] = fits['b'][:count]
 
 	for i,bin_ in enumerate(bins):
 		plt.plot(tstops[:len(ms[i])],ms[i],'.',label=datasets[i])
@@ -395,8 +605,9 @@ t2 = 'data_2018_10_5_16_6_17'
 #save_bins(t1)
 #save_bins(t2)
 
-plot_asc_desc(t1,plot_means=True,asc_color='r',desc_color='m',show=False)
-plot_asc_desc(t2,plot_means=True,asc_color='b',desc_color='g')
+if __name__ == '__main__': # not when imported, e.g. by fit_exponential_bins' worker processes
+	plot_asc_desc(t1,plot_means=True,asc_color='r',desc_color='m',show=False)
+	plot_asc_desc(t2,plot_means=True,asc_color='b',desc_color='g')
 
 
 
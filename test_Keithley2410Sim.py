@@ -0,0 +1,265 @@
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+import pytest
+
+from Keithley2410 import SourceMeterServer, MakeIVCurve
+from Keithley2410Sim import SimulatedKeithley2410, SensorModel
+from IVStation import IVJob, IVStation, SafetyPolicy
+from IVData import IVLog, IVBinaryWriter, open_ivb, convert_text
+from DeadlineScheduler import DeadlineScheduler
+from LoopProfiler import LoopProfiler
+
+
+def simulated(**kwargs):
+    sim = SimulatedKeithley2410(nplc=0.01, sleep=lambda seconds: None, **kwargs)
+    return sim, SourceMeterServer(None, simulate=sim)
+
+
+def test_ramp_reaches_100V():
+    """Source autorange is on after *RST, so a python ramp gets past the 21 V range"""
+    sim = SimulatedKeithley2410(nplc=0.01, sleep=lambda seconds: None)
+    s = SourceMeterServer(None, simulate=sim)
+    levels = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        ivc = MakeIVCurve(s)
+        ivc.monitor.wait = lambda seconds: None
+        ivc.monitor.step = lambda vStep, current: levels.append(sim.applied_voltage())
+        rampDown, rampUp = ivc.makeIVCurve(startV=0, stopV=100, step=20, waitT=0, maxI=1e-3)
+    assert list(rampUp[0]) == [0, 20, 40, 60, 80, 100]
+    assert max(levels) == 100.0
+    assert not [e for e in sim.errors if e.startswith('-222')]
+    s.close()
+
+
+def test_station_trip_stops_every_module(tmp_path):
+    """A leaky module trips the policy, the other one stops its ramp up and both end at 0 V, off"""
+    leaky = SimulatedKeithley2410(SensorModel(bulk=1e-5), nplc=0.01, sleep=lambda seconds: None)
+    good = SimulatedKeithley2410(nplc=0.01, sleep=lambda seconds: None)
+    policy = SafetyPolicy(max_current=1e-7, trip_fraction=0.5, ramp_down_wait=0.0)
+    jobs = [IVJob('A', simulate=leaky, stopV=200, step=5, waitT=0.01, maxI=1e-5, output=str(tmp_path/'A.txt')),
+            IVJob('B', simulate=good, stopV=200, step=5, waitT=0.05, maxI=1e-5, output=str(tmp_path/'B.txt'))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = IVStation(policy).run(jobs)
+    assert policy.stopped.is_set()
+    assert policy.tripped[0][0] == 'A'
+    assert [r['error'] for r in results] == [None, None]
+    rampDown, rampUp = results[1]['curve']
+    assert rampUp[0][-1] < 200
+    for sim in (leaky, good):
+        assert not sim.output and sim.applied_voltage() == 0.0
+    for r in results:
+        assert r['output'].endswith('.txt') and os.path.exists(r['output'])
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.part')]
+
+
+def test_station_skips_queued_jobs_once_stopped(tmp_path):
+    sim = SimulatedKeithley2410(SensorModel(bulk=1e-5), nplc=0.01, sleep=lambda seconds: None)
+    policy = SafetyPolicy(max_current=1e-7, trip_fraction=0.5, ramp_down_wait=0.0)
+    jobs = [IVJob(module, simulate=sim, stopV=200, step=5, waitT=0.01, maxI=1e-5, output=str(tmp_path/(module+'.txt')))
+            for module in ('A', 'B')]
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = IVStation(policy).run(jobs)
+    assert policy.tripped[0][0] == 'A'
+    assert results[0]['error'] is None
+    assert results[1]['error'] == 'not run, station stopped'
+
+
+def test_shadow_cache_skips_repeated_writes():
+    sim, s = simulated()
+    s.source_mode('v')
+    n = sim.nwrites
+    s.source_voltage_level(5)
+    s.source_voltage_level(5)
+    assert sim.nwrites == n + 1
+    assert s.source_voltage_level() == 5.0
+    assert s.source_voltage_level() == 5.0
+    assert sim.nwrites == n + 2
+    s.write(":SOUR:VOLT:LEV 7")     # a raw write clears the cache
+    assert s.source_voltage_level() == 7.0
+    s.close()
+
+
+def test_shadow_cache_follows_source_autorange():
+    """The source range autoranges after *RST, its readback is not cached until it is written"""
+    sim, s = simulated()
+    s.reset()
+    s.source_mode('v')
+    s.source_voltage_level(10)
+    assert s.source_voltage_range() == 21.0
+    s.source_voltage_level(100)
+    assert s.source_voltage_range() == 1100.0
+    s.close()
+
+
+def test_shadow_cache_retries_a_rejected_level():
+    sim, s = simulated()
+    s.reset()
+    s.source_mode('v')
+    s.output_on()
+    s.source_voltage_range(21)
+    s.source_voltage_level(100)
+    assert sim.errors[-1].startswith('-222')
+    s.source_voltage_range(1100)
+    s.source_voltage_level(100)
+    assert sim.applied_voltage() == 100.0
+    s.output_off()
+    s.close()
+
+
+def test_batch_is_one_write():
+    sim, s = simulated()
+    s.source_mode('v')
+    n = sim.nwrites
+    with s.batch() as b:
+        s.source_voltage_range(21)
+        s.source_voltage_level(12)
+        s.sense_current_prot(1e-5)
+        b.query(":SOUR:VOLT:LEV?", float)
+    assert sim.nwrites == n + 1
+    assert b.result == 12.0
+    assert s.source_voltage_level() == 12.0
+    assert sim.nwrites == n + 1    # answered from the batch's reply
+    s.close()
+
+
+def test_sweep_stops_at_compliance():
+    """An early compliance stop ends the sweep well before its nominal length"""
+    sim = SimulatedKeithley2410(nplc=0.01)
+    s = SourceMeterServer(None, simulate=sim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ivc = MakeIVCurve(s)
+        t0 = time.time()
+        curve = ivc.sweep_volt(np.arange(0, 200, 5), waitT=0.1, maxI=2e-9)
+        elapsed = time.time() - t0
+    assert 0 < len(curve[0]) < 40
+    assert curve[1][-1] > 0.95*2e-9
+    assert elapsed < 40*0.1/2
+    assert s.source_voltage_mode() == 'FIX'
+    assert s.trigger_count() == 1
+    s.close()
+
+
+def test_meas_samples_restores_trigger_count():
+    sim, s = simulated()
+    s.source_mode('v')
+    s.sense_on('CURR')
+    s.source_voltage_level(5)
+    s.output_on()
+    s.format_data("CURR,VOLT")
+    s.trigger_count(1)
+    readings = s.meas_samples(5)
+    assert len(readings) == 5
+    assert readings.dtype.names == ('VOLT', 'CURR')   # the instrument's order, not the command's
+    assert (readings['VOLT'] == 5.0).all()
+    assert s.trigger_count() == 1
+    assert sim.trig_count == 1
+    s.output_off()
+    s.close()
+
+
+def test_read_step_averages_samples():
+    sim, s = simulated()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ivc = MakeIVCurve(s)
+    s.source_mode('v')
+    s.sense_on('CURR')
+    s.source_voltage_level(5)
+    s.output_on()
+    s.format_data("CURR")
+    s.sense_average(4)
+    assert s.sense_average() == 4
+    current = ivc.read_step(5, samples=3)
+    stats = ivc.step_stats()
+    assert stats['n'][0] == 3 and stats['v'][0] == 5
+    assert current == stats['CURR_mean'][0]
+    s.output_off()
+    s.close()
+
+
+def test_ivlog_finalize(tmp_path):
+    path = str(tmp_path/'run'/'IVdata.txt')
+    log = IVLog(path, {'stopV': 100})
+    log.write(0.0, 5.0, 1e-9, 5.0)
+    log.write(1.0, 10.0, 2e-9, 10.0)
+    assert os.path.exists(path + '.part') and not os.path.exists(path)
+    assert log.finalize() == path
+    assert not os.path.exists(path + '.part')
+    data = np.loadtxt(path)
+    assert data.shape == (2, 4)
+    assert data[1, 2] == 2e-9
+    with open(path) as f:
+        assert '# stopV = 100\n' in f.readlines()
+
+
+def test_ivb_round_trip(tmp_path):
+    rows = np.arange(40, dtype=float).reshape(10, 4)
+    path = str(tmp_path/'run.ivb')
+    with IVBinaryWriter(path, {'module': 'M117'}, chunk=4) as writer:
+        writer.extend(rows[:3])
+        writer.append(*rows[3])
+        writer.extend(rows[4:])
+    data, header = open_ivb(path)
+    assert header['metadata'] == {'module': 'M117'}
+    assert (np.asarray(data) == rows).all()
+
+    text = str(tmp_path/'run.txt')
+    np.savetxt(text, rows, header='a comment')
+    data, header = open_ivb(convert_text(text))
+    assert (np.asarray(data) == rows).all()
+    assert header['metadata']['comments'] == ['a comment']
+
+
+def make_bins_loop(raw_data):
+    """make_bins as it was written before it was vectorized, first point of every bin discarded"""
+    asc_bins, desc_bins = [], []
+    first_bin = None
+    this_bin, this_voltage, this_bin_asc = [], raw_data[0, 1], None
+    for data_point in raw_data:
+        if data_point[1] == this_voltage:
+            this_bin.append(data_point)
+            continue
+        if first_bin is None:
+            first_bin = this_bin
+        elif len(this_bin) > 1:
+            (asc_bins if this_bin_asc else desc_bins).append(this_bin)
+        this_bin_asc = data_point[1] > this_voltage
+        this_voltage = data_point[1]
+        this_bin = [data_point]
+    return (np.array(first_bin)[1:], [np.array(_)[1:] for _ in asc_bins],
+            [np.array(_)[1:] for _ in desc_bins], np.array(this_bin)[1:])
+
+
+def test_make_bins_matches_loop():
+    pytest.importorskip('matplotlib')
+    pytest.importorskip('scipy')
+    import dev
+    voltages = [0]*3 + [5]*4 + [10]*1 + [15]*5 + [10]*3 + [5]*2 + [20]*4
+    raw = np.column_stack([np.arange(len(voltages)), voltages, np.linspace(0, 1, len(voltages)), voltages]).astype(float)
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = make_bins_loop(raw)
+        got = dev.make_bins(raw)
+    assert (got[0] == expected[0]).all() and (got[3] == expected[3]).all()
+    for bins, expected_bins in zip(got[1:3], expected[1:3]):
+        assert len(bins) == len(expected_bins)
+        for b, e in zip(bins, expected_bins):
+            assert (b == e).all()
+
+
+def test_deadline_scheduler_skips_missed_slots():
+    now = [0.0]
+    profiler = LoopProfiler(clock=lambda: now[0])
+    schedule = DeadlineScheduler(clock=lambda: now[0], profiler=profiler)
+    schedule.every('measurement', 1.0)
+    assert schedule.due() == []
+    now[0] = 1.0
+    assert schedule.due() == ['measurement']
+    now[0] = 5.5                       # slots 2, 3, 4 and 5 passed, it runs once
+    assert schedule.due() == ['measurement']
+    assert schedule.deadlines['measurement'].next == 6.0
+    assert schedule.deadlines['measurement'].missed == 3
+    assert profiler.misses == {'measurement': 3}
+    assert schedule.timeout() == 0.5